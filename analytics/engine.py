@@ -0,0 +1,85 @@
+# imports
+import numpy as np
+import pandas as pd
+
+from analytics.products import rank_products
+from analytics.shipments import shipment_counts, shipment_timeliness
+from database.ingestion import read_csv
+
+
+# Public Holiday Orders Per Month
+def holiday_month_totals(dims,order_dates,order_counts) -> dict:
+    """
+    dims: Loaded database.dimensions cache
+    order_dates/order_counts: One entry per order day
+    Returns {month_number: orders placed on public holidays} for all twelve months
+    """
+    order_dates = np.asarray(order_dates,dtype="datetime64[D]")
+    order_counts = np.asarray(order_counts,dtype=np.int64)
+    holidays = dims.holiday_mask(order_dates)
+    month_totals = np.bincount(dims.months(order_dates[holidays]),weights=order_counts[holidays],minlength=13)
+    return {month:int(month_totals[month]) for month in range(1,13)}
+
+
+class memory_engine():
+    """
+    Computes the analytics straight from the downloaded CSVs held as typed dataframes, no staging tables involved
+    Exposes the same lookups as database.state.analytics_state so the analytics tasks run unchanged on either,
+    the cursor arguments are accepted and ignored
+    """
+
+    def __init__(self) -> None:
+        self.orders = None
+        self.reviews = None
+        self.joined = None
+
+
+    # Load Inputs
+    def load(self,orders_path,reviews_path,shipments_path):
+        self.orders = read_csv("orders",orders_path)
+        self.reviews = read_csv("reviews",reviews_path)
+        shipments = read_csv("shipment_deliveries",shipments_path)
+
+        # Hash join on order_id, dates are already datetime64 from the read_csv schema
+        self.joined = self.orders.merge(shipments,on="order_id",how="inner")
+        return self
+
+
+    # Nothing To Fold In, The Frames Are The Whole Input
+    def update(self,cursor,connect,source) -> int:
+        return 0
+
+
+    # Orders Per Day
+    def orders_per_day(self,cursor,since) -> list:
+        order_dates = self.orders["order_date"].dropna()
+        order_dates = order_dates[order_dates >= pd.Timestamp(since)].dt.normalize()
+        daily = order_dates.value_counts(sort=False)
+        return list(zip(daily.index.date,daily.to_numpy(dtype=np.int64)))
+
+
+    # Late And Undelivered Shipments
+    def shipment_counts(self,cursor,today) -> tuple:
+        return shipment_counts(self.joined,today)
+
+
+    # Product Ranking
+    def rank_products(self,cursor,product_names=None):
+        return rank_products(self.reviews,product_names)
+
+
+    # Largest Order For A Product
+    def largest_order_date(self,cursor,product_id):
+        """
+        Returns the order_date of the product's largest order, latest date first on ties, None when it has no orders
+        """
+        orders = self.orders[(self.orders["product_id"] == int(product_id)) & self.orders["quantity"].notna() & self.orders["order_date"].notna()]
+        if len(orders) == 0:
+            return None
+        largest = orders.sort_values(["quantity","order_date"],ascending=[False,False],kind="mergesort").iloc[0]
+        return largest["order_date"].date()
+
+
+    # Early And Late Shipments For A Product
+    def shipment_timeliness(self,cursor,product_id) -> tuple:
+        return shipment_timeliness(self.joined,product_id)
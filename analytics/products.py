@@ -0,0 +1,54 @@
+# imports
+import numpy as np
+import pandas as pd
+
+# Review star buckets
+STARS = (1,2,3,4,5)
+STAR_COLUMNS = ["pct_one_star_review","pct_two_star_review","pct_three_star_review","pct_four_star_review","pct_five_star_review"]
+
+
+# Rank Products By Reviews
+def rank_products(reviews_df,product_names=None):
+    """
+    reviews_df: review data with review and product_id columns
+    product_names: Optional {product_id: product_name} mapping
+    Returns one row per product with review_count, review_sum and star percentages, ranked by
+    review_count then review_sum (highest first) and product_id (lowest first) so ties are deterministic
+    """
+    reviews_df = reviews_df.dropna(subset=["review","product_id"])
+    product_ids = reviews_df["product_id"].to_numpy(dtype=np.int64)
+    stars = reviews_df["review"].to_numpy(dtype=np.int64)
+
+    # Integer codes per product, one bincount per statistic
+    codes,uniques = pd.factorize(product_ids,sort=True)
+    total = len(uniques)
+    review_count = np.bincount(codes,minlength=total)
+    review_sum = np.bincount(codes,weights=stars,minlength=total).astype(np.int64)
+
+    valid = np.isin(stars,STARS)
+    distribution = np.bincount(codes[valid]*len(STARS) + (stars[valid].astype(np.int64) - 1),minlength=total*len(STARS)).reshape(total,len(STARS))
+    return rank_review_counts(uniques,review_count,review_sum,distribution,product_names)
+
+
+# Rank Products From Review Counts
+def rank_review_counts(product_ids,review_count,review_sum,distribution,product_names=None):
+    """
+    product_ids: One entry per product
+    review_count, review_sum: Reviews and review points per product
+    distribution: (products, 5) array of one to five star review counts
+    Ranks pre-aggregated review statistics the same way as rank_products
+    """
+    total = len(product_ids)
+    review_count = np.asarray(review_count,dtype=np.int64)
+    distribution = np.asarray(distribution,dtype=np.int64).reshape(total,len(STARS))
+    pct = distribution/np.maximum(review_count,1)[:,None]*100
+
+    ranking = pd.DataFrame({"product_id":np.asarray(product_ids,dtype=np.int64),"review_count":review_count,"review_sum":np.asarray(review_sum,dtype=np.int64)})
+    for i,column in enumerate(STAR_COLUMNS):
+        ranking[column] = pct[:,i]
+    if product_names != None:
+        ranking.insert(1,"product_name",ranking["product_id"].map(product_names))
+
+    ranking = ranking.sort_values(["review_count","review_sum","product_id"],ascending=[False,False,True],kind="mergesort").reset_index(drop=True)
+    ranking.insert(0,"rank",np.arange(1,total+1))
+    return ranking
@@ -0,0 +1,91 @@
+# imports
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# Shipments at least this many days after the order are late
+LATE_AFTER_DAYS = 6
+# Shipped orders at least this many days old without a delivery are undelivered
+UNDELIVERED_AFTER_DAYS = 15
+
+
+# Parse Date Columns
+def parse_dates(dataframe,columns=("order_date","shipment_date","delivery_date")):
+    """
+    dataframe: orders joined with shipment_deliveries
+    columns: Date columns converted once to datetime64, "-" and empty cells become NaT
+    """
+    dataframe = dataframe.copy()
+    for column in columns:
+        if column in dataframe.columns:
+            dataframe[column] = pd.to_datetime(dataframe[column].where(dataframe[column] != "-"),format="%Y-%m-%d",errors="coerce")
+    return dataframe
+
+
+# Join Orders And Shipments
+def join_orders_shipments(orders_df,shipments_df):
+    """
+    orders_df: orders data as loaded from orders.csv
+    shipments_df: shipment data as loaded from shipment_deliveries.csv
+    """
+    return parse_dates(orders_df.merge(shipments_df,on="order_id",how="inner"))
+
+
+# Whole Days
+def whole_days(delta):
+    """
+    delta: timedelta64 array
+    Returns the whole days as a float array, NaN for NaT. NaT cast straight to float is the int64 minimum, not NaN
+    """
+    days = delta.astype("timedelta64[D]").astype(float)
+    days[np.isnat(delta)] = np.nan
+    return days
+
+
+# Day Differences
+def days_between(start,end):
+    """
+    start,end: datetime64 series
+    Returns the whole day differences as a float array, NaN where either date is missing
+    """
+    return whole_days(end.to_numpy(dtype="datetime64[D]") - start.to_numpy(dtype="datetime64[D]"))
+
+
+# Late And Undelivered Shipments
+def shipment_counts(dataframe,today=None) -> tuple:
+    """
+    dataframe: parsed join of orders and shipment_deliveries
+    today: Date undelivered shipments are measured against, defaults to the current UTC date
+    Returns (late_shipments, undelivered_shipments) for shipped but undelivered orders
+    """
+    if today == None:
+        today = datetime.utcnow().date()
+
+    pending = dataframe[dataframe["shipment_date"].notna() & dataframe["delivery_date"].isna()]
+    order_dates = pending["order_date"].to_numpy(dtype="datetime64[D]")
+
+    shipped_after = days_between(pending["order_date"],pending["shipment_date"])
+    order_age = whole_days(np.datetime64(today,"D") - order_dates)
+
+    late = int(np.sum(shipped_after >= LATE_AFTER_DAYS))
+    undelivered = int(np.sum(order_age >= UNDELIVERED_AFTER_DAYS))
+    return late,undelivered
+
+
+# Early And Late Shipments
+def shipment_timeliness(dataframe,product_id=None) -> tuple:
+    """
+    dataframe: parsed join of orders and shipment_deliveries
+    product_id: Only count shipments of this product when given
+    Returns (pct_early_shipments, pct_late_shipments) over shipped orders
+    """
+    shipped = dataframe[dataframe["shipment_date"].notna()]
+    if product_id != None:
+        shipped = shipped[shipped["product_id"] == int(product_id)]
+
+    total = len(shipped)
+    if total == 0:
+        return 0.0,0.0
+    late = int(np.sum(days_between(shipped["order_date"],shipped["shipment_date"]) >= LATE_AFTER_DAYS))
+    early = total - late
+    return (early/total)*100,(late/total)*100
@@ -0,0 +1,132 @@
+# imports
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# Rows generated and written per chunk, bounds memory independently of the scale
+CHUNK_ROWS = 1000000
+
+# Reviews and shipments per order, close to the ratios of the sample inputs
+REVIEWS_PER_ORDER = 0.72
+UNSHIPPED_RATE = 0.1
+UNDELIVERED_RATE = 0.3
+
+# Output files, named like the bucket objects so they can be uploaded as they are
+FILES = ("orders.csv","reviews.csv","shipment_deliveries.csv","dim_dates.csv","dim_products.csv")
+
+
+# Chunk Bounds
+def chunks(total,chunk_rows):
+    for start in range(0,total,chunk_rows):
+        yield start,min(start + chunk_rows,total)
+
+
+# Date Strings
+def date_strings(dates):
+    strings = np.datetime_as_string(dates,unit="D").astype(object)
+    strings[np.isnat(dates)] = ""
+    return strings
+
+
+# Generate Dimensions
+def generate_dimensions(out_dir,start,days,products,rng):
+    """
+    dim_dates covers the order window with a margin on both sides, about ten weekdays a year are public holidays
+    """
+    calendar_dt = np.arange(np.datetime64(start,"D") - 30,np.datetime64(start,"D") + days + 60)
+    day_of_week = ((calendar_dt.astype(np.int64) + 3) % 7) + 1
+    months = calendar_dt.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    holidays = (day_of_week <= 5) & (rng.random(len(calendar_dt)) < 10/261)
+    pd.DataFrame({
+        "calendar_dt":date_strings(calendar_dt),
+        "day_of_the_week_num":day_of_week,
+        "month_of_the_year_num":months,
+        "working_day":(day_of_week <= 5) & ~holidays
+    }).to_csv(os.path.join(out_dir,"dim_dates.csv"),index=False)
+
+    pd.DataFrame({
+        "product_id":np.arange(1,products+1),
+        "product_name":[f"product_{product_id}" for product_id in range(1,products+1)]
+    }).to_csv(os.path.join(out_dir,"dim_products.csv"),index=False)
+
+
+# Generate Inputs
+def generate(out_dir,rows,seed=0,products=30,customers=None,start="2021-01-01",days=730,chunk_rows=CHUNK_ROWS) -> dict:
+    """
+    out_dir: Folder the CSV files are written to
+    rows: Number of orders, one shipment per order and about REVIEWS_PER_ORDER reviews per order
+    seed: Random seed, the same arguments always produce the same files
+    products/customers: Distinct product and customer ids, customers defaults to rows // 10
+    start/days: Order dates are drawn from days days starting at start
+    Files are written chunk by chunk so 1e8 rows need no more memory than chunk_rows
+    Returns {file name: rows written}
+    """
+    os.makedirs(out_dir,exist_ok=True)
+    rng = np.random.default_rng(seed)
+    customers = customers if customers != None else max(rows//10,1)
+    first_day = np.datetime64(start,"D")
+    unit_prices = rng.integers(10,500,size=products+1)
+
+    generate_dimensions(out_dir,start,days,products,rng)
+    written = {"dim_dates.csv":days + 90,"dim_products.csv":products,"orders.csv":0,"reviews.csv":0,"shipment_deliveries.csv":0}
+
+    reviews = int(rows*REVIEWS_PER_ORDER)
+    paths = {name:os.path.join(out_dir,name) for name in ("orders.csv","reviews.csv","shipment_deliveries.csv")}
+    for name in paths:
+        if os.path.exists(paths[name]):
+            os.remove(paths[name])
+
+    for low,high in chunks(rows,chunk_rows):
+        size = high - low
+        order_id = np.arange(low + 1,high + 1)
+        order_date = first_day + rng.integers(0,days,size=size)
+        product_id = rng.integers(1,products+1,size=size)
+        quantity = rng.integers(1,11,size=size)
+        pd.DataFrame({
+            "order_id":order_id,
+            "customer_id":rng.integers(1,customers+1,size=size),
+            "order_date":date_strings(order_date),
+            "product_id":product_id,
+            "unit_price":unit_prices[product_id],
+            "quantity":quantity,
+            "total_price":unit_prices[product_id]*quantity
+        }).to_csv(paths["orders.csv"],mode="a",header=(low == 0),index=False)
+
+        # Shipments follow their order by up to ten days, some are not shipped or not delivered yet
+        shipment_date = order_date + rng.integers(0,11,size=size)
+        shipment_date[rng.random(size) < UNSHIPPED_RATE] = np.datetime64("NaT")
+        delivery_date = shipment_date + rng.integers(1,11,size=size)
+        delivery_date[rng.random(size) < UNDELIVERED_RATE] = np.datetime64("NaT")
+        pd.DataFrame({
+            "shipment_id":order_id,
+            "order_id":order_id,
+            "shipment_date":date_strings(shipment_date),
+            "delivery_date":date_strings(delivery_date)
+        }).to_csv(paths["shipment_deliveries.csv"],mode="a",header=(low == 0),index=False)
+
+        written["orders.csv"] += size
+        written["shipment_deliveries.csv"] += size
+
+    for low,high in chunks(reviews,chunk_rows):
+        size = high - low
+        pd.DataFrame({
+            "review":rng.choice(np.arange(1,6),size=size,p=[0.1,0.1,0.2,0.3,0.3]),
+            "product_id":rng.integers(1,products+1,size=size)
+        }).to_csv(paths["reviews.csv"],mode="a",header=(low == 0),index=False)
+        written["reviews.csv"] += size
+
+    if reviews == 0:
+        pd.DataFrame(columns=["review","product_id"]).to_csv(paths["reviews.csv"],index=False)
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic orders, reviews, shipments and dimension CSVs")
+    parser.add_argument("--rows",type=float,default=1e4,help="Number of orders, 1e4 to 1e8")
+    parser.add_argument("--out",default="benchmarks/data",help="Output folder")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--products",type=int,default=30)
+    args = parser.parse_args()
+    print(generate(args.out,int(args.rows),seed=args.seed,products=args.products))
@@ -0,0 +1,349 @@
+# imports
+import os
+import sys
+import json
+import time
+import boto3
+import platform
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+# Environment first, the modules below read their settings (DB_*, S3_*, STAGING_SNAPSHOTS) when imported
+load_dotenv(".env")
+os.makedirs("log_files",exist_ok=True)
+
+from s3.s3 import bucket
+from database.db import database
+from database.state import analytics_state
+from database.incremental import watermarks
+from database.dimensions import dimensions
+from database.aggregations import aggregations
+from analytics.engine import memory_engine, holiday_month_totals
+from database.ingestion import SCHEMAS
+from database.snapshots import snapshot_writer, load_snapshot
+from benchmarks.generate import generate
+from main import STAGING_TABLES, STAGING_INDEXES
+
+# Orders written through the row by row write_data path, it is far slower than COPY so only a sample is timed
+WRITE_SAMPLE = int(os.getenv("BENCH_WRITE_SAMPLE",20000))
+
+# Orders read back through the fetch_data and fetch_dataframe paths, they hold the whole result in memory so only a
+# sample is timed, the whole table is read through the server side cursor of stream_data
+READ_SAMPLE = int(os.getenv("BENCH_READ_SAMPLE",100000))
+
+# Dimension tables of the benchmark common schema
+DIMENSION_TABLES = {
+    "dim_dates":"(calendar_dt date PRIMARY KEY, day_of_the_week_num INTEGER, month_of_the_year_num INTEGER, working_day BOOLEAN)",
+    "dim_products":"(product_id INTEGER PRIMARY KEY, product_name VARCHAR)"
+}
+
+# Inputs uploaded to and synced from the S3 stand-in, (file_category, src_name)
+INPUTS = [("orders","orders.csv"),("orders","reviews.csv"),("orders","shipment_deliveries.csv")]
+
+
+class harness():
+    """
+    Times every pipeline stage on generated data against a local Postgres and an optional local S3 stand-in
+    Postgres comes from the usual DB_* variables, point them at a disposable instance (a container or pg_ctl),
+    the benchmark schemas are dropped and recreated on every run. S3 stages run when S3_ENDPOINT_URL and
+    BUCKET_NAME point at a stand-in such as a moto server or MinIO, otherwise they are recorded as skipped
+    rows: Number of generated orders
+    workdir: Folder for the generated and downloaded files
+    prefix: Prefix of the benchmark schemas, {prefix}_staging, {prefix}_analytics and {prefix}_common
+    """
+
+    def __init__(self,rows,workdir="benchmarks/data",prefix="bench",seed=0) -> None:
+        self.rows = int(rows)
+        self.workdir = workdir
+        self.prefix = prefix
+        self.seed = seed
+        self.staging = f"{prefix}_staging"
+        self.analytics = f"{prefix}_analytics"
+        self.common = f"{prefix}_common"
+        self.stages = []
+
+
+    # Time A Stage
+    @contextmanager
+    def stage(self,name,rows=None):
+        """
+        Records the stage's seconds, and rows per second when rows is given or set on the yielded record
+        """
+        record = {"stage":name,"rows":rows}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if record["rows"] != None:
+                record["rows_per_sec"] = record["rows"]/record["seconds"] if record["seconds"] > 0 else None
+            self.stages.append(record)
+            print(f"{name}: {record['seconds']:.3f}s" + (f" {record['rows']} rows" if record["rows"] != None else ""),file=sys.stderr)
+
+
+    # Skipped Stage
+    def skip(self,name,reason):
+        self.stages.append({"stage":name,"skipped":reason})
+
+
+    # Run Metadata
+    def metadata(self,cursor) -> dict:
+        try:
+            commit = subprocess.run(["git","rev-parse","HEAD"],capture_output=True,text=True).stdout.strip() or None
+        except Exception:
+            commit = None
+        cursor.execute("SHOW server_version;")
+        return {
+            "rows":self.rows,
+            "seed":self.seed,
+            "started_at":datetime.utcnow().isoformat(),
+            "git_commit":commit,
+            "python":platform.python_version(),
+            "pandas":pd.__version__,
+            "numpy":np.__version__,
+            "cpu_count":os.cpu_count(),
+            "postgres":cursor.fetchone()[0]
+        }
+
+
+    # Fresh Schemas And Dimensions
+    def setup_database(self,db,cursor,connect):
+        for schemaname in (self.staging,self.analytics,self.common):
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schemaname} CASCADE;")
+            cursor.execute(f"CREATE SCHEMA {schemaname};")
+        connect.commit()
+
+        for tablename,columns in DIMENSION_TABLES.items():
+            db.create_table(cursor,connect,columns,tablename,self.common)
+            with open(os.path.join(self.workdir,f"{tablename}.csv")) as source:
+                column_names = source.readline().strip()
+                cursor.copy_expert(f"COPY {self.common}.{tablename} ({column_names}) FROM STDIN WITH (FORMAT csv)",source)
+        connect.commit()
+
+
+    # Upload And Sync Through The S3 Stand In
+    def run_s3(self,written) -> str:
+        """
+        Returns the folder the inputs are loaded from, the synced downloads when S3 is available
+        """
+        if (os.getenv("S3_ENDPOINT_URL") == None) or (os.getenv("BUCKET_NAME") == None):
+            for name in ("s3_upload","s3_sync","s3_sync_unchanged"):
+                self.skip(name,"S3_ENDPOINT_URL or BUCKET_NAME not set")
+            return self.workdir
+
+        # Bucket setup needs signed requests, the pipeline's own client is unsigned
+        bk = bucket()
+        admin = boto3.client("s3",endpoint_url=bk.endpoint_url)
+        try:
+            admin.create_bucket(Bucket=bk.bucket_name)
+        except Exception:
+            pass
+
+        total = sum([written[src_name] for _,src_name in INPUTS])
+        with self.stage("s3_upload",total):
+            stats = bk.upload_many([(os.path.join(self.workdir,src_name),f"{file_category}_data/{src_name}") for file_category,src_name in INPUTS])
+        if None in stats:
+            raise RuntimeError(f"BenchmarkError: upload to {bk.endpoint_url} failed, see log_files/s3.log")
+
+        # The pipeline reads its inputs unsigned, like the public source bucket
+        for file_category,src_name in INPUTS:
+            admin.put_object_acl(Bucket=bk.bucket_name,Key=f"{file_category}_data/{src_name}",ACL="public-read")
+
+        download_dir = os.path.join(self.workdir,"downloads")
+        os.makedirs(download_dir,exist_ok=True)
+        files = [(file_category,src_name,os.path.join(download_dir,src_name)) for file_category,src_name in INPUTS]
+        manifest_path = os.path.join(download_dir,".manifest.json")
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        with self.stage("s3_sync",total):
+            bk.sync_many(files,manifest_path=manifest_path)
+        missing = [dst_name for _,_,dst_name in files if not os.path.exists(dst_name)]
+        if len(missing) != 0:
+            raise RuntimeError(f"BenchmarkError: sync from {bk.endpoint_url} did not download {missing}, see log_files/s3.log")
+        with self.stage("s3_sync_unchanged"):
+            bk.sync_many(files,manifest_path=manifest_path)
+        return download_dir
+
+
+    # Parse The Inputs Against Reading Their Snapshots
+    def run_snapshots(self,written):
+        folder = os.path.join(self.workdir,"snapshots")
+        for _,src_name in INPUTS:
+            tablename = src_name.replace(".csv","")
+            path = os.path.join(self.workdir,src_name)
+            with self.stage(f"parse_csv_{tablename}",written[src_name]):
+                frame = pd.read_csv(path,dtype=SCHEMAS[tablename]["dtype"],parse_dates=SCHEMAS[tablename]["parse_dates"])
+            with self.stage(f"snapshot_write_{tablename}",written[src_name]):
+                writer = snapshot_writer(tablename,path,folder)
+                writer.append(frame)
+                writer.commit()
+            # copy() pages every column in so the read is compared with a fully parsed frame
+            with self.stage(f"snapshot_read_{tablename}",written[src_name]):
+                load_snapshot(tablename,path,folder=folder).copy()
+
+
+    # Run Every Stage
+    def run(self) -> dict:
+        with self.stage("generate",self.rows) as record:
+            written = generate(self.workdir,self.rows,seed=self.seed)
+            record["rows"] = sum(written.values())
+
+        input_dir = self.run_s3(written)
+        self.run_snapshots(written)
+
+        db = database()
+        db.create_pool()
+        try:
+            with db.pooled() as (connect,cursor):
+                meta = self.metadata(cursor)
+                with self.stage("setup_database"):
+                    self.setup_database(db,cursor,connect)
+
+                marks = watermarks(db,self.staging)
+                state = analytics_state(db,self.staging,self.analytics)
+                dims = dimensions(common=self.common,ttl=0)
+                agg = aggregations(self.staging,common=self.common)
+
+                with self.stage("create_tables"):
+                    for tablename,columns in STAGING_TABLES.items():
+                        db.create_table(cursor,connect,columns,tablename,self.staging)
+                    marks.create(cursor,connect)
+                    state.create(cursor,connect)
+
+                # Loads, first into empty tables then an unchanged rerun that should be skipped
+                for _,src_name in INPUTS:
+                    tablename = src_name.replace(".csv","")
+                    with self.stage(f"ingest_{tablename}",written[src_name]):
+                        marks.ingest(cursor,connect,tablename,os.path.join(input_dir,src_name))
+                    with self.stage(f"index_{tablename}"):
+                        db.create_indexes(cursor,connect,tablename,self.staging,STAGING_INDEXES[tablename])
+                for _,src_name in INPUTS:
+                    tablename = src_name.replace(".csv","")
+                    with self.stage(f"ingest_unchanged_{tablename}"):
+                        marks.ingest(cursor,connect,tablename,os.path.join(input_dir,src_name))
+
+                with self.stage("dimensions_load"):
+                    dims.load(cursor,force=True)
+
+                # Running state, first from the whole history then the (empty) delta of a second run
+                for source in ("orders","reviews","shipment_deliveries"):
+                    with self.stage(f"state_{source}",written[f"{source}.csv"]):
+                        state.update(cursor,connect,source)
+                    with self.stage(f"state_delta_{source}"):
+                        state.update(cursor,connect,source)
+
+                # The three analytics as derived from the running state
+                today = datetime.utcnow().date()
+                with self.stage("agg_public_holiday"):
+                    daily_orders = state.orders_per_day(cursor,today - timedelta(days=365*3))
+                    order_dates = np.array([row[0] for row in daily_orders],dtype="datetime64[D]")
+                    order_counts = np.array([row[1] for row in daily_orders],dtype=np.int64)
+                    holidays = dims.holiday_mask(order_dates)
+                    np.bincount(dims.months(order_dates[holidays]),weights=order_counts[holidays],minlength=13)
+                with self.stage("agg_shipments"):
+                    state.shipment_counts(cursor,today)
+                with self.stage("best_performing_product"):
+                    ranking = state.rank_products(cursor,product_names=dims.product_names)
+                    product_id = int(ranking.iloc[0]["product_id"])
+                    dims.is_public_holiday(state.largest_order_date(cursor,product_id))
+                    state.shipment_timeliness(cursor,product_id)
+
+                # The same analytics from the downloaded CSVs, the ANALYTICS_ENGINE=memory path
+                engine = memory_engine()
+                with self.stage("memory_engine_load",sum([written[src_name] for _,src_name in INPUTS])):
+                    engine.load(*[os.path.join(input_dir,src_name) for _,src_name in INPUTS])
+                with self.stage("memory_agg_public_holiday"):
+                    daily_orders = engine.orders_per_day(None,today - timedelta(days=365*3))
+                    holiday_month_totals(dims,[row[0] for row in daily_orders],[row[1] for row in daily_orders])
+                with self.stage("memory_agg_shipments"):
+                    engine.shipment_counts(None,today)
+                with self.stage("memory_best_performing_product"):
+                    ranking = engine.rank_products(None,product_names=dims.product_names)
+                    product_id = int(ranking.iloc[0]["product_id"])
+                    dims.is_public_holiday(engine.largest_order_date(None,product_id))
+                    engine.shipment_timeliness(None,product_id)
+
+                # The same analytics as full history aggregate queries, for comparison with the running state
+                with self.stage("sql_orders_per_day",written["orders.csv"]):
+                    agg.orders_per_day(cursor,today - timedelta(days=365*3))
+                with self.stage("sql_shipment_counts",written["shipment_deliveries.csv"]):
+                    agg.shipment_counts(cursor,today)
+                with self.stage("sql_top_reviewed_product",written["reviews.csv"]):
+                    agg.top_reviewed_product(cursor)
+
+                # Reading the table back, a sample through the in memory read paths and all of it through server side cursors
+                orders = f"{self.staging}.orders"
+                read_sample = min(READ_SAMPLE,written["orders.csv"])
+                with self.stage("fetch_data_orders",read_sample):
+                    db.fetch_data(cursor,"*",orders,filtered=True,filter="id <= %s",params=(read_sample,))
+                with self.stage("fetch_dataframe_orders",read_sample):
+                    db.fetch_dataframe(cursor,f"SELECT * FROM {orders} WHERE id <= %s",(read_sample,))
+                with self.stage("stream_data_orders",written["orders.csv"]):
+                    for _ in db.stream_data(connect,"*",orders):
+                        pass
+                with self.stage("stream_dataframes_orders",written["orders.csv"]):
+                    for _ in db.stream_dataframes(connect,"*",orders):
+                        pass
+
+                # Writing a sample back through each write path
+                sample = pd.read_csv(os.path.join(input_dir,"orders.csv"),nrows=WRITE_SAMPLE)
+                for tablename in ("orders_write_data","orders_copy_data"):
+                    db.create_table(cursor,connect,STAGING_TABLES["orders"],tablename,self.staging)
+                with self.stage("write_data_orders",len(sample)):
+                    db.write_data(cursor,connect,sample.astype(str).to_dict(orient="records"),"orders_write_data",self.staging,check=False)
+                with self.stage("copy_data_orders",len(sample)):
+                    db.copy_data(cursor,connect,sample,"orders_copy_data",self.staging)
+
+        finally:
+            db.close_pool()
+
+        return {"meta":meta,"stages":self.stages}
+
+
+# Save Results
+def save_results(results,results_dir="benchmarks/results") -> str:
+    os.makedirs(results_dir,exist_ok=True)
+    path = os.path.join(results_dir,f"{results['meta']['rows']}_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json")
+    with open(path,"w") as results_file:
+        json.dump(results,results_file,indent=2,default=str)
+    return path
+
+
+# Compare With A Baseline
+def compare(results,baseline,tolerance=0.2) -> list:
+    """
+    Returns (stage, baseline seconds, seconds) for every stage more than tolerance slower than in the baseline
+    """
+    baseline_seconds = {stage["stage"]:stage["seconds"] for stage in baseline["stages"] if "seconds" in stage}
+    regressions = []
+    for stage in results["stages"]:
+        before = baseline_seconds.get(stage["stage"])
+        if ("seconds" in stage) and (before != None) and (stage["seconds"] > before*(1 + tolerance)):
+            regressions.append((stage["stage"],before,stage["seconds"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on generated data")
+    parser.add_argument("--rows",type=float,default=1e4,help="Number of generated orders, 1e4 to 1e8")
+    parser.add_argument("--workdir",default="benchmarks/data")
+    parser.add_argument("--prefix",default="bench",help="Prefix of the benchmark schemas, they are dropped on every run")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--baseline",help="Earlier results file, exits with 1 when a stage regressed")
+    parser.add_argument("--tolerance",type=float,default=0.2)
+    args = parser.parse_args()
+
+    results = harness(args.rows,workdir=args.workdir,prefix=args.prefix,seed=args.seed).run()
+    print(save_results(results))
+
+    if args.baseline != None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results,json.load(baseline_file),args.tolerance)
+        for name,before,seconds in regressions:
+            print(f"REGRESSION {name}: {before:.3f}s -> {seconds:.3f}s")
+        sys.exit(1 if len(regressions) != 0 else 0)
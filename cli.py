@@ -0,0 +1,86 @@
+# imports
+# Only the standard library is imported up front, main.py and the modules behind each stage are imported once the
+# command is known so a plan or a single stage starts without loading pandas, psycopg2 or boto3 it does not use
+import os
+import sys
+import time
+import argparse
+
+# Input tables, each has a download_, load_ and index_ node
+TABLES = ("orders","reviews","shipment_deliveries")
+
+# Analytics that can be run by name
+ANALYTICS = ("agg_public_holiday","agg_shipments","best_performing_product")
+
+
+# Parse Arguments
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="cli.py",description="Run the pipeline or any stage of it, every stage runs with the stages it depends on unless --no-deps is given")
+    parser.add_argument("--dry-run",action="store_true",help="Print the plan and the resources it needs without running anything")
+    parser.add_argument("--no-deps",action="store_true",help="Only run the selected stages, their inputs must already be in place")
+    parser.add_argument("--env-file",default=".env",help="Environment file loaded before anything else")
+    commands = parser.add_subparsers(dest="command",required=True)
+
+    commands.add_parser("run",help="Every stage")
+    commands.add_parser("plan",help="Same as run --dry-run")
+    download = commands.add_parser("download",help="Download inputs whose S3 object changed")
+    download.add_argument("tables",nargs="*",metavar="table",help=f"Any of {', '.join(TABLES)}, all when none given")
+    load = commands.add_parser("load",help="Load and index staging tables")
+    load.add_argument("tables",nargs="+",choices=TABLES,metavar="table",help=f"Any of {', '.join(TABLES)}")
+    analytics = commands.add_parser("analytics",help="Compute analytics and write their table and export")
+    analytics.add_argument("names",nargs="*",metavar="name",help=f"Any of {', '.join(ANALYTICS)}, all when none given")
+    commands.add_parser("export",help="Upload the exports folder")
+    args = parser.parse_args(argv)
+
+    # Optional lists are checked here, argparse rejects an empty list against choices
+    if args.command == "download":
+        unknown = [tablename for tablename in args.tables if tablename not in TABLES]
+    elif args.command == "analytics":
+        unknown = [name for name in args.names if name not in ANALYTICS]
+    else:
+        unknown = []
+    if len(unknown) != 0:
+        parser.error(f"unknown {args.command} targets {', '.join(unknown)}")
+    return args
+
+
+# Selected Nodes
+def targets(args) -> list:
+    """
+    Returns the pipeline nodes a command selects, None for every node
+    """
+    if args.command in ("run","plan"):
+        return None
+    if args.command == "download":
+        return [f"download_{tablename}" for tablename in (args.tables or TABLES)]
+    if args.command == "load":
+        return [node for tablename in args.tables for node in (f"load_{tablename}",f"index_{tablename}")]
+    if args.command == "analytics":
+        return list(args.names or ANALYTICS)
+    return ["export"]
+
+
+# Entry Point
+def cli(argv=None) -> int:
+    started = time.perf_counter()
+    args = parse_args(argv)
+
+    # Environment first, main.py and the modules it imports read their settings when imported
+    from dotenv import load_dotenv
+    load_dotenv(args.env_file)
+    os.makedirs("log_files",exist_ok=True)
+
+    from main import run_pipeline
+    outcome = run_pipeline(targets(args),with_dependencies=not args.no_deps,dry_run=args.dry_run or args.command == "plan")
+
+    for wave,nodes in enumerate(outcome["plan"],start=1):
+        print(f"wave {wave}: {', '.join(nodes)}")
+    print(f"resources: {', '.join(outcome['resources']) or 'none'}")
+    if "failed" in outcome:
+        print(f"failed: {', '.join(outcome['failed'])}" if len(outcome["failed"]) != 0 else "all stages succeeded")
+    print(f"{time.perf_counter() - started:.3f}s")
+    return 1 if len(outcome.get("failed",[])) != 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,86 @@
+# imports
+import logging
+
+# Setup Logging
+agg_logger = logging.getLogger(__name__)
+agg_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+agg_logger.addHandler(file_handler)
+
+class aggregations():
+    """
+    Full history aggregate queries over the staging tables, only the final numbers leave the database
+    The pipeline reads the running state tables (database.state) instead, the benchmarks time these as the baseline
+    the state tables are measured against
+    staging: Schema holding the orders, reviews and shipment_deliveries tables
+    common: Schema holding dim_dates and dim_products
+    """
+
+    def __init__(self,staging,common="if_common") -> None:
+        self.staging = staging
+        self.common = common
+
+
+    # Run Aggregate Query
+    def run(self,cursor,Query,params=None,one=False):
+        try:
+            agg_logger.debug(f"AggregateQuery: {Query}")
+            cursor.execute(Query,params)
+            if one == True:
+                return cursor.fetchone()
+            return cursor.fetchall()
+
+        except Exception as e:
+            agg_logger.critical(f"AggregateQueryError: Failed to run aggregate query, {e}")
+            raise
+
+
+    # Orders Per Day
+    def orders_per_day(self,cursor,since) -> list:
+        """
+        since: Earliest order_date counted
+        Returns (order_date, order_count) rows, one per day, for joining against a local dim_dates cache
+        """
+        Query = f"""
+            SELECT o.order_date, COUNT(*)
+            FROM {self.staging}.orders o
+            WHERE o.order_date >= %s
+            GROUP BY o.order_date;"""
+        return self.run(cursor,Query,(since,))
+
+
+    # Late And Undelivered Shipments
+    def shipment_counts(self,cursor,today) -> tuple:
+        """
+        today: Date undelivered shipments are measured against
+        Returns (late_shipments, undelivered_shipments) for shipped but undelivered orders
+        """
+        Query = f"""
+            SELECT
+                COUNT(*) FILTER (WHERE NULLIF(s.shipment_date,'-')::date - o.order_date >= 6),
+                COUNT(*) FILTER (WHERE %s::date - o.order_date >= 15)
+            FROM {self.staging}.orders o
+            INNER JOIN {self.staging}.shipment_deliveries s ON s.order_id = o.order_id
+            WHERE s.delivery_date = '-' AND s.shipment_date != '-';"""
+        late,undelivered = self.run(cursor,Query,(today,),one=True)
+        return late,undelivered
+
+
+    # Most Reviewed Product
+    def top_reviewed_product(self,cursor) -> tuple:
+        """
+        Returns (product_id, product_name, review_sum, pct_one_star, ..., pct_five_star)
+        Ties on review count go to the product reviewed first
+        """
+        star_columns = ",".join([f"100.0 * COUNT(*) FILTER (WHERE r.review = {star}) / COUNT(*)" for star in range(1,6)])
+        Query = f"""
+            SELECT r.product_id, p.product_name, SUM(r.review), {star_columns}
+            FROM {self.staging}.reviews r
+            LEFT JOIN {self.common}.dim_products p ON p.product_id = r.product_id
+            GROUP BY r.product_id, p.product_name
+            ORDER BY COUNT(*) DESC, MIN(r.id)
+            LIMIT 1;"""
+        row = self.run(cursor,Query,one=True)
+        return (row[0],row[1],int(row[2])) + tuple(float(pct) for pct in row[3:])
@@ -1,15 +1,40 @@
 # imports
+import io
 import os
+import time
+import uuid
+import weakref
+import hashlib
 import logging
 import psycopg2
-from datetime import datetime
+import pandas as pd
+import threading
+from psycopg2 import pool
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
 from concurrent.futures import ThreadPoolExecutor
 
+from pipeline.metrics import metrics
+
+# pandas dtypes for Postgres type oids read back by fetch_dataframe, unlisted types stay as strings
+PG_DTYPES = {
+    16:"boolean",
+    20:"Int64",
+    21:"Int16",
+    23:"Int32",
+    700:"float32",
+    701:"float64",
+    1700:"float64"
+}
+
+# Postgres date and timestamp type oids, parsed into datetime64 columns
+PG_DATES = (1082,1114,1184)
+
 # Setup Logging
 db_logger = logging.getLogger(__name__)
 db_logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
-file_handler = logging.FileHandler("log_files/db.log")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
 file_handler.setFormatter(formatter)
 db_logger.addHandler(file_handler)
 
@@ -21,6 +46,11 @@ class database():
         self.username = os.getenv("DB_USER")
         self.port = os.getenv("DB_PORT")
         self.db_name = os.getenv("DB_NAME")
+        self.pool = None
+        self.pool_slots = None
+        self.pool_lock = threading.Lock()
+        self.prepared = weakref.WeakKeyDictionary()
+        self.prepared_lock = threading.Lock()
 
 
     # Create DB Connection
@@ -33,6 +63,95 @@ class database():
             db_logger.critical(f"DBConnectError: Failed to create database connection {e}.")
 
 
+    # Create Connection Pool
+    def create_pool(self,minconn=1,maxconn=None) -> bool:
+        """
+        minconn: Number of connections opened up front
+        maxconn: Maximum number of connections handed out at once, defaults to DB_POOL_SIZE or 8
+        Threads racing to create the pool share the first one, an existing pool is kept
+        """
+        try:
+            if maxconn == None:
+                maxconn = int(os.getenv("DB_POOL_SIZE",8))
+            with self.pool_lock:
+                if self.pool != None:
+                    return True
+                self.pool_slots = threading.BoundedSemaphore(maxconn)
+                self.pool = pool.ThreadedConnectionPool(minconn,maxconn,dbname=self.db_name,user=self.username,password=self.password,host=self.host,port=self.port)
+            db_logger.info(f"CreatePool: opened pool with max size {maxconn}")
+            return True
+
+        except Exception as e:
+            db_logger.critical(f"CreatePoolError: Failed to create connection pool {e}.")
+            return False
+
+
+    # Check Connection Health
+    def is_healthy(self,connect) -> bool:
+        try:
+            if connect.closed:
+                return False
+            cursor = connect.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchone()
+            cursor.close()
+            connect.rollback()
+            return True
+
+        except Exception as e:
+            db_logger.warning(f"HealthCheckError: Pooled connection failed health check {e}")
+            return False
+
+
+    # Checkout Pooled Connection
+    def checkout(self):
+        """
+        Blocks until a connection is free, replacing connections that fail the health check
+        """
+        if (self.pool == None) and (self.create_pool() == False):
+            raise RuntimeError("CheckoutError: no connection pool")
+
+        self.pool_slots.acquire()
+        try:
+            connect = self.pool.getconn()
+            if not self.is_healthy(connect):
+                self.pool.putconn(connect,close=True)
+                connect = self.pool.getconn()
+            return connect
+
+        except Exception as e:
+            # The slot is released here only, the caller never gets a connection to check back in
+            self.pool_slots.release()
+            db_logger.critical(f"CheckoutError: Failed to checkout pooled connection {e}.")
+            raise
+
+
+    # Checkin Pooled Connection
+    def checkin(self,connect,discard=False):
+        try:
+            if not connect.closed and connect.status != psycopg2.extensions.STATUS_READY:
+                connect.rollback()
+            self.pool.putconn(connect,close=discard or bool(connect.closed))
+
+        except Exception as e:
+            db_logger.warning(f"CheckinError: Failed to checkin pooled connection {e}")
+
+        finally:
+            self.pool_slots.release()
+
+
+    # Pooled Connection And Cursor
+    @contextmanager
+    def pooled(self):
+        connect = self.checkout()
+        cursor = self.create_cursor(connect)
+        try:
+            yield connect,cursor
+        finally:
+            self.close(cursor=cursor)
+            self.checkin(connect)
+
+
     # Create Cursor
     def create_cursor(self,connect):
         try:
@@ -44,7 +163,7 @@ class database():
 
 
     # Create Table
-    def create_table(self,cursor,connect,columns_data,tablename,schemaname) -> bool:
+    def create_table(self,cursor,connect,columns_data,tablename,schemaname,partition_by=None) -> bool:
         """
         connect: Database connection
         cursor: Database connection cursor
@@ -52,9 +171,12 @@ class database():
         tablename: Name of table getting created
         columns_data: The name of each column along with their characters 
             sample: (id SERIAL PRIMARY KEY, name VARCHAR)
+        partition_by: Optional partition key, sample: RANGE (order_date)
         """
         try:
             Query = f"CREATE TABLE IF NOT EXISTS {schemaname}.{tablename} {columns_data}"
+            if partition_by != None:
+                Query = f"{Query} PARTITION BY {partition_by}"
             cursor.execute(Query)
             connect.commit()
             return True
@@ -64,40 +186,298 @@ class database():
             return False
 
 
-    # Fetch From DB
-    def fetch_data(self,cursor,columns_name,tablename,secondary_tablename="",all=True,one=False,filtered=False,filter=None,join=False,join_condition=None):
+    # Create Yearly Range Partitions
+    def create_partitions(self,cursor,connect,tablename,schemaname,first_year,last_year) -> bool:
+        """
+        Creates one partition per year from first_year to last_year of a table created with partition_by RANGE,
+        plus a default partition catching rows outside that range
+        """
         try:
-            # Queries
-            if (filtered == True) and (join == True):
-                Query = f"SELECT {columns_name} FROM {tablename} INNER JOIN {secondary_tablename} ON {join_condition} WHERE {filter} ORDER BY {tablename}.id;"
+            for year in range(first_year,last_year+1):
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {schemaname}.{tablename}_{year} PARTITION OF {schemaname}.{tablename}
+                    FOR VALUES FROM ('{year}-01-01') TO ('{year+1}-01-01');""")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {schemaname}.{tablename}_default PARTITION OF {schemaname}.{tablename} DEFAULT;")
+            connect.commit()
+            return True
 
-            elif (filtered == False) and (join == True):
-                Query = f"SELECT {columns_name} FROM {tablename} INNER JOIN {secondary_tablename} ON {join_condition} ORDER BY {tablename}.id;"
+        except Exception as e:
+            connect.rollback()
+            db_logger.critical(f"CreatePartitionError: Failed to partition database table {tablename} {e}.")
+            return False
 
-            elif filtered == True:
-                Query = f"SELECT {columns_name} from {tablename} WHERE {filter};"
-                
-            elif (filtered == False) and (join == False):
-                Query = f"SELECT {columns_name} from {tablename};"
 
-            db_logger.debug(f"FetchDataQuery: {Query}")
-            
-            # Execute Query
-            cursor.execute(Query)
+    # Create Indexes
+    def create_indexes(self,cursor,connect,tablename,schemaname,indexes) -> bool:
+        """
+        indexes: Column lists indexed on the table, sample: ["order_id", "product_id, order_date"]
+        Meant to run after bulk loads, each index is built once and then maintained by later incremental loads.
+        The table is analyzed afterwards so the planner sees the new rows and indexes
+        """
+        try:
+            for columns in indexes:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.index_name(tablename,columns)} ON {schemaname}.{tablename} ({columns});")
+            connect.commit()
+            self.analyze(cursor,connect,tablename,schemaname)
+            db_logger.info(f"CreateIndexes: {tablename} indexed on {indexes}")
+            return True
+
+        except Exception as e:
+            connect.rollback()
+            db_logger.critical(f"CreateIndexError: Failed to index database table {tablename} {e}.")
+            return False
+
+
+    # Drop Indexes
+    def drop_indexes(self,cursor,connect,tablename,schemaname,indexes) -> bool:
+        """
+        indexes: Column lists of indexes built by create_indexes that are no longer wanted
+        """
+        try:
+            for columns in indexes:
+                cursor.execute(f"DROP INDEX IF EXISTS {schemaname}.{self.index_name(tablename,columns)};")
+            connect.commit()
+            if len(indexes) != 0:
+                db_logger.info(f"DropIndexes: {tablename} indexes on {indexes} dropped")
+            return True
+
+        except Exception as e:
+            connect.rollback()
+            db_logger.critical(f"DropIndexError: Failed to drop indexes of database table {tablename} {e}.")
+            return False
+
+    def index_name(self,tablename,columns) -> str:
+        return f"{tablename}_{'_'.join([column.strip() for column in columns.split(',')])}_idx"
+
+
+    # Analyze Table
+    def analyze(self,cursor,connect,tablename,schemaname):
+        cursor.execute(f"ANALYZE {schemaname}.{tablename};")
+        connect.commit()
+
+
+    # Explain Query
+    def explain(self,cursor,connect,Query,params=None) -> dict:
+        """
+        Returns the plan the planner picks for the query under its normal costing, without running it
+        """
+        try:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {Query}",params)
+            plan = cursor.fetchone()[0]
+            return plan[0]["Plan"]
+
+        finally:
+            connect.rollback()
+
+
+    # Plan Scans
+    def plan_scans(self,plan) -> dict:
+        """
+        Returns {relation: set of scan node types} for every table scanned in an explain plan
+        """
+        scans = {}
+        if "Relation Name" in plan:
+            scans.setdefault(plan["Relation Name"],set()).add(plan["Node Type"])
+        for child in plan.get("Plans",[]):
+            for relation,node_types in self.plan_scans(child).items():
+                scans.setdefault(relation,set()).update(node_types)
+        return scans
+
+
+    # Build Select Query
+    def build_query(self,columns_name,tablename,secondary_tablename="",filtered=False,filter=None,join=False,join_condition=None):
+        if (filtered == True) and (join == True):
+            Query = f"SELECT {columns_name} FROM {tablename} INNER JOIN {secondary_tablename} ON {join_condition} WHERE {filter} ORDER BY {tablename}.id;"
+
+        elif (filtered == False) and (join == True):
+            Query = f"SELECT {columns_name} FROM {tablename} INNER JOIN {secondary_tablename} ON {join_condition} ORDER BY {tablename}.id;"
+
+        elif filtered == True:
+            Query = f"SELECT {columns_name} from {tablename} WHERE {filter};"
+
+        elif (filtered == False) and (join == False):
+            Query = f"SELECT {columns_name} from {tablename};"
+
+        return Query
+
+
+    # Query Shape
+    def query_shape(self,Query) -> str:
+        """
+        Name derived from the query text, shared by every call with the same SQL whatever its bound values
+        """
+        return f"stmt_{hashlib.md5(Query.encode()).hexdigest()[:16]}"
+
+
+    # Prepare Statement
+    def prepare(self,cursor,Query) -> str:
+        """
+        Query: SQL with %s bind placeholders
+        Prepares the query once per connection under a name derived from its text, so every later call with the
+        same query shape skips parsing and planning. Returns the statement name
+        """
+        name = self.query_shape(Query)
+        with self.prepared_lock:
+            prepared = self.prepared.setdefault(cursor.connection,set())
+        if name not in prepared:
+            parts = Query.rstrip().rstrip(";").split("%s")
+            statement = parts[0] + "".join([f"${i}{part}" for i,part in enumerate(parts[1:],start=1)])
+            cursor.execute(f"PREPARE {name} AS {statement};")
+            prepared.add(name)
+            db_logger.debug(f"PrepareQuery: {name} => {statement}")
+        return name
+
+
+    # Run Query With Bind Parameters
+    def query(self,cursor,Query,params=None,all=True,one=False,prepared=True):
+        """
+        Query: SQL with %s bind placeholders, values are never formatted into the text
+        params: Sequence of values bound to the placeholders
+        prepared: Run through a per connection prepared statement cached by query shape
+        Returns fetchone() when one is set, fetchall() when all is set and the query returns rows, otherwise None
+        """
+        params = tuple(params) if params != None else ()
+        shape = self.query_shape(Query)
+        metrics.describe("query",shape,Query)
+        with metrics.timer("db_query",query=shape):
+            if prepared == True:
+                name = self.prepare(cursor,Query)
+                if len(params) == 0:
+                    cursor.execute(f"EXECUTE {name};")
+                else:
+                    cursor.execute(f"EXECUTE {name} ({','.join(['%s']*len(params))});",params)
+            else:
+                cursor.execute(Query,params if len(params) != 0 else None)
 
-            # Fetch
-            if(one == True):
-                data = cursor.fetchone()
+            if cursor.description == None:
+                return None
+            if one == True:
+                row = cursor.fetchone()
+                metrics.inc("db_rows_fetched",int(row != None),query=shape)
+                return row
+            if all == True:
+                rows = cursor.fetchall()
+                metrics.inc("db_rows_fetched",len(rows),query=shape)
+                return rows
 
-            elif(all == True):
-                data = cursor.fetchall()
 
-            # Response
-            return data
+    # Fetch From DB
+    def fetch_data(self,cursor,columns_name,tablename,secondary_tablename="",all=True,one=False,filtered=False,filter=None,join=False,join_condition=None,params=None,prepared=False):
+        """
+        filter/join_condition: SQL conditions, values go in as %s placeholders bound from params
+            sample: filter="product_id = %s", params=(product_id,)
+        prepared: Reuse a prepared statement for repeated lookups of the same shape
+        """
+        try:
+            # Queries
+            Query = self.build_query(columns_name,tablename,secondary_tablename,filtered,filter,join,join_condition)
+
+            db_logger.debug(f"FetchDataQuery: {Query} {params}")
+
+            # Execute Query And Fetch
+            start = time.perf_counter()
+            result = self.query(cursor,Query,params,all=all,one=one,prepared=prepared)
+            rows = len(result) if (one == False) and (result != None) else int(result != None)
+            db_logger.debug(f"FetchData: {rows} rows in {time.perf_counter() - start:.3f}s ({self.query_shape(Query)})")
+            return result
 
         except Exception as e:
             db_logger.critical(f"FetchDataError: Failed to fetch data from database table {tablename}, {e}")
     
+    # Stream From DB
+    def stream_data(self,connect,columns_name,tablename,secondary_tablename="",filtered=False,filter=None,join=False,join_condition=None,itersize=None,params=None):
+        """
+        connect: Database connection, the server side cursor lives in its own transaction on it
+        itersize: Number of rows held in memory per batch, defaults to DB_ITERSIZE or 5000
+        Yields (column_names, rows) batches instead of loading the whole result like fetch_data
+        """
+        if itersize == None:
+            itersize = int(os.getenv("DB_ITERSIZE",5000))
+
+        Query = self.build_query(columns_name,tablename,secondary_tablename,filtered,filter,join,join_condition)
+        db_logger.debug(f"StreamDataQuery: {Query}")
+
+        shape = self.query_shape(Query)
+        metrics.describe("query",shape,Query)
+        cursor = connect.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = itersize
+        try:
+            cursor.execute(Query,params)
+            column_names = None
+            while True:
+                # Only the time spent fetching is counted, not the time the consumer holds each batch
+                with metrics.timer("db_stream_fetch",query=shape):
+                    rows = cursor.fetchmany(itersize)
+                metrics.inc("db_rows_fetched",len(rows),query=shape)
+                if column_names == None:
+                    column_names = [column[0] for column in cursor.description]
+                if len(rows) == 0:
+                    break
+                yield column_names,rows
+
+        except Exception as e:
+            db_logger.critical(f"StreamDataError: Failed to stream data from database table {tablename}, {e}")
+            raise
+
+        finally:
+            self.close(cursor=cursor)
+            connect.rollback()
+
+    # Stream DataFrames From DB
+    def stream_dataframes(self,connect,columns_name,tablename,column_names=None,**kwargs):
+        """
+        column_names: Optional dataframe column names, defaults to the names returned by the query
+        Yields one dataframe per stream_data batch
+        """
+        for names,rows in self.stream_data(connect,columns_name,tablename,**kwargs):
+            yield pd.DataFrame(rows,columns=column_names if column_names != None else names)
+
+    # Describe Query
+    def describe(self,cursor,Query,params=None) -> list:
+        """
+        Returns (column_name, type_oid) for every column of the query without fetching any rows
+        """
+        cursor.execute(f"SELECT * FROM ({Query.rstrip().rstrip(';')}) AS described LIMIT 0;",params)
+        return [(column.name,column.type_code) for column in cursor.description]
+
+
+    # Fetch DataFrame Through COPY
+    def fetch_dataframe(self,cursor,Query,params=None,dtype=None,parse_dates=None) -> pd.DataFrame:
+        """
+        Query: SELECT whose result is copied out, values go in as %s placeholders bound from params
+        dtype/parse_dates: Optional read_csv schema, derived from the query's column types when not given
+        Runs COPY (query) TO STDOUT into an in-memory buffer and parses it with the pandas C reader,
+        so a large result is one bulk transfer instead of one Python tuple per row.
+        Column names come from the query
+        """
+        try:
+            if dtype == None:
+                columns = self.describe(cursor,Query,params)
+                dtype = {name:PG_DTYPES[type_code] for name,type_code in columns if type_code in PG_DTYPES}
+                if parse_dates == None:
+                    parse_dates = [name for name,type_code in columns if type_code in PG_DATES]
+
+            # The shape comes from the query before its values are bound, so every value shares one metrics label
+            shape = self.query_shape(Query)
+            metrics.describe("query",shape,Query)
+            Query = cursor.mogrify(Query.rstrip().rstrip(";"),params).decode() if params != None else Query.rstrip().rstrip(";")
+            buffer = io.StringIO()
+            start = time.perf_counter()
+            cursor.copy_expert(f"COPY ({Query}) TO STDOUT WITH (FORMAT csv, HEADER true)",buffer)
+            buffer.seek(0)
+
+            dataframe = pd.read_csv(buffer,dtype=dtype,parse_dates=parse_dates or [],true_values=["t"],false_values=["f"])
+            seconds = time.perf_counter() - start
+            db_logger.debug(f"FetchDataFrame: {len(dataframe)} rows in {seconds:.2f}s")
+            metrics.observe("db_fetch_dataframe_seconds",seconds,query=shape)
+            metrics.inc("db_rows_fetched",len(dataframe),query=shape)
+            return dataframe
+
+        except Exception as e:
+            db_logger.critical(f"FetchDataFrameError: Failed to copy query results, {e}")
+            raise
+
+
     # Write To DB
     def Thread_write(self,cursor,connect,dict_data,tablename,schemaname):
         try:
@@ -116,10 +496,11 @@ class database():
                 else:
                     cleaned_values.append("-")
             column_values = tuple(cleaned_values)
-            Query = f"INSERT INTO {schemaname}.{tablename} ({column_names}) VALUES {column_values};"
-            cursor.execute(Query)
+            Query = f"INSERT INTO {schemaname}.{tablename} ({column_names}) VALUES ({','.join(['%s']*len(column_values))});"
+            self.query(cursor,Query,column_values)
             connect.commit()
         except Exception as e:
+            connect.rollback()
             db_logger.critical(f"ThreadWriteToDBError: failed to write to {tablename}, {e}")
 
     def write_data(self,cursor,connect,columns_data,tablename,schemaname,check=True,check_row="id"):
@@ -130,35 +511,176 @@ class database():
         tablename: Name of table where data is written into
         columns_data: The name of each column along with their values
             sample: ({"column_name":"column_value",...,"column_name":"column_value"},...,{"column_name":"column_value"})
+        check_row: "id" skips as many rows as the table holds, a natural key column only writes rows above its highest value
+        check: Resume from what the table holds. Both resumes need the rows written in order, so only unchecked writes
+            are spread over the pool, in contiguous ranges, one pooled connection each
         """
         try:
             db_logger.debug(f"{tablename}: total => {len(columns_data)}")
 
-            # Preprocess for existing Data
-            if check == True:
-                res = self.fetch_data(cursor,check_row,f"{schemaname}.{tablename}")
-                db_logger.debug(f"{tablename}: written => {len(res)}")
-            else:
-                res = ()
-
-            if len(res) != 0:
-                count = len(res)
+            # Preprocess for existing Data, one aggregate query instead of fetching every id
+            if (check == True) and (check_row == "id"):
+                count = self.fetch_data(cursor,"COUNT(*)",f"{schemaname}.{tablename}",all=False,one=True)[0]
+                db_logger.debug(f"{tablename}: written => {count}")
                 columns_data = columns_data[count:len(columns_data)]
 
+            # Natural keys are resumed from the highest key written, so file order does not matter
+            elif check == True:
+                high_water = self.fetch_data(cursor,f"COALESCE(MAX({check_row}),0)",f"{schemaname}.{tablename}",all=False,one=True)[0]
+                db_logger.debug(f"{tablename}: written up to {check_row} {high_water}")
+                columns_data = [dict_data for dict_data in columns_data if int(float(dict_data[check_row])) > high_water]
+
             db_logger.debug(f"{tablename}:pending {len(columns_data)}")
 
             if len(columns_data) != 0:
                 # Actual Write to DB
                 db_logger.info(f"{tablename}: Writing Data")
-                for dict_data in columns_data:
-                    with ThreadPoolExecutor() as executor:
-                        executor.submit(self.Thread_write,cursor,connect,dict_data,tablename,schemaname)
-                db_logger.info(f"{tablename}: Write Complete")
+                start = time.perf_counter()
+                if (self.pool != None) and (check == False):
+                    # Each worker writes one contiguous range of rows on its own pooled connection, a failed checkout
+                    # or write in any of them is raised here
+                    workers = self.pool.maxconn
+                    size = -(-len(columns_data)//workers)
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = [executor.submit(self.pooled_write,columns_data[start:start+size],tablename,schemaname) for start in range(0,len(columns_data),size)]
+                        for future in futures:
+                            future.result()
+                else:
+                    for dict_data in columns_data:
+                        self.Thread_write(cursor,connect,dict_data,tablename,schemaname)
+                seconds = time.perf_counter() - start
+                rate = len(columns_data)/seconds if seconds > 0 else float(len(columns_data))
+                db_logger.info(f"{tablename}: Write Complete, {len(columns_data)} rows in {seconds:.2f}s ({rate:.0f} rows/sec)")
+                metrics.observe("db_write_seconds",seconds,table=tablename,method="insert")
+                metrics.inc("db_rows_written",len(columns_data),table=tablename,method="insert")
 
         except Exception as e:
             db_logger.critical(f"WriteDataError: Failed to write data to table {tablename}, {e}")
 
 
+    # Write Rows On A Pooled Connection
+    def pooled_write(self,columns_data,tablename,schemaname):
+        with self.pooled() as (connect,cursor):
+            for dict_data in columns_data:
+                self.Thread_write(cursor,connect,dict_data,tablename,schemaname)
+
+
+    # Clean DataFrame Values
+    def clean_frame(self,dataframe):
+        """
+        dataframe: pandas dataframe getting written to the database
+        Stringifies every value like Thread_write does and replaces missing values ("nan") with "-"
+        """
+        cleaned = dataframe.astype(str)
+        cleaned = cleaned.mask(dataframe.isna(),"-")
+        cleaned = cleaned.replace("nan","-")
+        return cleaned
+
+    # Bulk Write To DB
+    def copy_data(self,cursor,connect,dataframe,tablename,schemaname,batch_size=5000,use_copy=True,commit=True):
+        """
+        connect: Database connection
+        cursor: Database connection cursor
+        schemaname: Name of schema where table is located
+        tablename: Name of table where data is written into
+        dataframe: pandas dataframe whose columns match the table columns
+        batch_size: Number of rows sent and committed per transaction
+        use_copy: Stream rows with COPY FROM STDIN, falls back to batched multi-row inserts on failure
+        commit: Commit after each batch, False leaves the transaction open for the caller and wraps each COPY in a
+            savepoint, so falling back to inserts only undoes the failed batch and not the caller's uncommitted rows
+        """
+        try:
+            total = len(dataframe)
+            if total == 0:
+                return 0
+
+            column_names = ",".join(dataframe.columns)
+            cleaned = self.clean_frame(dataframe)
+
+            db_logger.info(f"{tablename}: Bulk Writing Data")
+            start = time.perf_counter()
+            written = 0
+            for offset in range(0,total,batch_size):
+                batch = cleaned.iloc[offset:offset+batch_size]
+
+                if use_copy == True:
+                    try:
+                        if commit == False:
+                            cursor.execute("SAVEPOINT copy_batch;")
+                        buffer = io.StringIO()
+                        batch.to_csv(buffer,index=False,header=False)
+                        buffer.seek(0)
+                        cursor.copy_expert(f"COPY {schemaname}.{tablename} ({column_names}) FROM STDIN WITH (FORMAT csv)",buffer)
+                        if commit == False:
+                            cursor.execute("RELEASE SAVEPOINT copy_batch;")
+                    except Exception as e:
+                        db_logger.warning(f"CopyDataError: COPY into {tablename} failed, falling back to batched inserts, {e}")
+                        if commit == False:
+                            cursor.execute("ROLLBACK TO SAVEPOINT copy_batch;")
+                        else:
+                            connect.rollback()
+                        use_copy = False
+
+                if use_copy == False:
+                    Query = f"INSERT INTO {schemaname}.{tablename} ({column_names}) VALUES %s"
+                    execute_values(cursor,Query,list(batch.itertuples(index=False,name=None)),page_size=batch_size)
+
+                if commit == True:
+                    connect.commit()
+                written += len(batch)
+
+            elapsed = time.perf_counter() - start
+            rate = written/elapsed if elapsed > 0 else float(written)
+            db_logger.info(f"{tablename}: Bulk Write Complete, {written} rows in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+            metrics.observe("db_write_seconds",elapsed,table=tablename,method="copy" if use_copy == True else "execute_values")
+            metrics.inc("db_rows_written",written,table=tablename,method="copy" if use_copy == True else "execute_values")
+            return written
+
+        except Exception as e:
+            connect.rollback()
+            db_logger.critical(f"CopyDataError: Failed to bulk write data to table {tablename}, {e}")
+
+
+    # Stream CSV Into DB
+    def copy_stream(self,cursor,connect,normalizer,tablename,schemaname):
+        """
+        connect: Database connection
+        cursor: Database connection cursor
+        schemaname: Name of schema where table is located
+        tablename: Name of table where data is written into
+        normalizer: database.streams.csv_normalizer wrapping the source stream, its header names the columns
+        Copies the whole stream in one transaction with constant memory
+        """
+        try:
+            column_names = ",".join(normalizer.header)
+            db_logger.info(f"{tablename}: Streaming Data")
+            start = time.perf_counter()
+            cursor.copy_expert(f"COPY {schemaname}.{tablename} ({column_names}) FROM STDIN WITH (FORMAT csv)",normalizer)
+            connect.commit()
+
+            elapsed = time.perf_counter() - start
+            rate = normalizer.rows/elapsed if elapsed > 0 else float(normalizer.rows)
+            db_logger.info(f"{tablename}: Stream Complete, {normalizer.rows} rows in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+            metrics.observe("db_write_seconds",elapsed,table=tablename,method="copy_stream")
+            metrics.inc("db_rows_written",normalizer.rows,table=tablename,method="copy_stream")
+            return normalizer.rows
+
+        except Exception as e:
+            connect.rollback()
+            db_logger.critical(f"CopyStreamError: Failed to stream data into table {tablename}, {e}")
+
+
+    # Close Connection Pool
+    def close_pool(self):
+        if self.pool != None:
+            try:
+                self.pool.closeall()
+                self.pool = None
+
+            except Exception as e:
+                db_logger.critical(f"ClosePoolError: Failed to close connection pool {e}.")
+
+
     # Close Connections
     def close(self,connect=None, cursor=None):
 
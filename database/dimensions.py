@@ -0,0 +1,235 @@
+# imports
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+# Setup Logging
+dim_logger = logging.getLogger(__name__)
+dim_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+dim_logger.addHandler(file_handler)
+
+class dimensions():
+    """
+    Local cache of if_common.dim_dates and if_common.dim_products
+    dim_dates is held as compact arrays indexed by days since the first calendar date, dim_products as an id -> name map
+    common: Schema holding the dimension tables
+    ttl: Seconds a loaded cache is trusted before its version is checked again, defaults to DIM_CACHE_TTL or 3600
+    snapshot_path: Optional .npz file the cache is saved to and restored from when the version still matches,
+    ".npz" is appended when missing as np.savez would otherwise write a file the snapshot is never loaded from
+    """
+
+    def __init__(self,common="if_common",ttl=None,snapshot_path=None) -> None:
+        self.common = common
+        self.ttl = ttl if ttl != None else int(os.getenv("DIM_CACHE_TTL",3600))
+        self.snapshot_path = snapshot_path if snapshot_path != None else os.getenv("DIM_SNAPSHOT")
+        if (self.snapshot_path != None) and (not self.snapshot_path.endswith(".npz")):
+            self.snapshot_path = f"{self.snapshot_path}.npz"
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+        self.start = None
+        self.known = np.zeros(0,dtype=bool)
+        self.working_day = np.zeros(0,dtype=bool)
+        self.day_of_week = np.zeros(0,dtype=np.int8)
+        self.month = np.zeros(0,dtype=np.int8)
+        self.product_names = {}
+
+
+    # Dimension Version
+    def fetch_version(self,cursor) -> list:
+        """
+        Row counts and an md5 of the contents of both tables, so rows edited in place (e.g. a day newly marked as a
+        holiday in working_day) change the version as well as added rows. Both tables are a few thousand rows
+        """
+        cursor.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM {self.common}.dim_dates),
+                (SELECT md5(COALESCE(string_agg(d::text,',' ORDER BY d.calendar_dt),'')) FROM {self.common}.dim_dates d),
+                (SELECT COUNT(*) FROM {self.common}.dim_products),
+                (SELECT md5(COALESCE(string_agg(p::text,',' ORDER BY p.product_id),'')) FROM {self.common}.dim_products p);""")
+        return list(cursor.fetchone())
+
+
+    # Load Cache Without The Database
+    def restore(self) -> bool:
+        """
+        Restores the snapshot whatever version it was saved for, for runs that never touch the database.
+        Like a loaded cache it is only trusted for ttl seconds after its version was last checked against the
+        database, an older snapshot returns False so the caller loads (and re-saves) the dimensions instead
+        """
+        with self.lock:
+            if self.loaded_at != None:
+                return True
+            if (self.snapshot_path == None) or (not os.path.exists(self.snapshot_path)):
+                return False
+            age = time.time() - os.path.getmtime(self.snapshot_path)
+            if age >= self.ttl:
+                dim_logger.info(f"DimensionCache: snapshot {self.snapshot_path} last checked {age:.0f}s ago, reloading")
+                return False
+            if self.load_snapshot(None) == False:
+                return False
+            self.loaded_at = time.time()
+            dim_logger.info(f"DimensionCache: restored snapshot {self.snapshot_path} offline, version {self.version}")
+            return True
+
+
+    # Load Cache
+    def load(self,cursor,force=False):
+        """
+        cursor: Database connection cursor, only used when the cache is missing, stale or force is set
+        Reuses the cache while it is younger than ttl, then reuses it or the snapshot while the version is unchanged
+        """
+        with self.lock:
+            if (force == False) and (self.loaded_at != None) and (time.time() - self.loaded_at < self.ttl):
+                return self
+
+            try:
+                version = self.fetch_version(cursor)
+                if (force == False) and (version == self.version):
+                    self.loaded_at = time.time()
+                    return self
+
+                if (force == False) and (self.load_snapshot(version) == True):
+                    # The snapshot matched the database, restore() may trust it for another ttl
+                    os.utime(self.snapshot_path)
+                    dim_logger.info(f"DimensionCache: restored snapshot {self.snapshot_path}")
+                else:
+                    self.fetch(cursor)
+                    self.version = version
+                    self.save_snapshot()
+
+                self.loaded_at = time.time()
+                dim_logger.info(f"DimensionCache: {int(self.known.sum())} dates, {len(self.product_names)} products, version {self.version}")
+
+            except Exception as e:
+                dim_logger.critical(f"DimensionCacheError: Failed to load dimension tables, {e}")
+                raise
+
+        return self
+
+
+    # Fetch Dimensions
+    def fetch(self,cursor):
+        cursor.execute(f"SELECT calendar_dt, day_of_the_week_num, working_day, month_of_the_year_num FROM {self.common}.dim_dates;")
+        rows = cursor.fetchall()
+        self.build_dates(
+            np.array([row[0] for row in rows],dtype="datetime64[D]"),
+            np.array([row[1] for row in rows],dtype=np.int8),
+            np.array([row[2] for row in rows],dtype=bool),
+            np.array([row[3] for row in rows],dtype=np.int8))
+
+        cursor.execute(f"SELECT product_id, product_name FROM {self.common}.dim_products;")
+        self.product_names = {int(product_id):product_name for product_id,product_name in cursor.fetchall()}
+
+
+    # Build Date Arrays
+    def build_dates(self,calendar_dt,day_of_week,working_day,month):
+        if len(calendar_dt) == 0:
+            self.start = None
+            return
+        self.start = calendar_dt.min()
+        offsets = (calendar_dt - self.start).astype(np.int64)
+        size = int(offsets.max()) + 1
+
+        self.known = np.zeros(size,dtype=bool)
+        self.working_day = np.ones(size,dtype=bool)
+        self.day_of_week = np.zeros(size,dtype=np.int8)
+        self.month = np.zeros(size,dtype=np.int8)
+
+        self.known[offsets] = True
+        self.working_day[offsets] = working_day
+        self.day_of_week[offsets] = day_of_week
+        self.month[offsets] = month
+
+
+    # Date Offsets
+    def offsets(self,dates):
+        """
+        dates: Array like of dates
+        Returns (offsets, found) where found marks dates present in dim_dates
+        """
+        dates = np.asarray(dates,dtype="datetime64[D]")
+        if self.start == None:
+            return np.zeros(dates.shape,dtype=np.int64),np.zeros(dates.shape,dtype=bool)
+        offsets = (dates - self.start).astype(np.int64)
+        inside = (offsets >= 0) & (offsets < len(self.known))
+        offsets = np.where(inside,offsets,0)
+        return offsets,inside & self.known[offsets]
+
+
+    # Public Holiday Mask
+    def holiday_mask(self,dates):
+        """
+        A public holiday is a weekday (day_of_the_week_num 1 to 5) that is not a working day
+        """
+        offsets,found = self.offsets(dates)
+        if self.start == None:
+            return found
+        day_of_week = self.day_of_week[offsets]
+        return found & (day_of_week >= 1) & (day_of_week <= 5) & ~self.working_day[offsets]
+
+    def is_public_holiday(self,date) -> bool:
+        return bool(self.holiday_mask([date])[0])
+
+    def months(self,dates):
+        offsets,found = self.offsets(dates)
+        if self.start == None:
+            return np.zeros(offsets.shape,dtype=np.int8)
+        return np.where(found,self.month[offsets],0)
+
+
+    # Product Name
+    def product_name(self,product_id):
+        return self.product_names.get(int(product_id))
+
+
+    # Save Snapshot
+    def save_snapshot(self):
+        if self.snapshot_path == None:
+            return
+        try:
+            np.savez(
+                self.snapshot_path,
+                start=np.array([self.start if self.start != None else np.datetime64("NaT")],dtype="datetime64[D]"),
+                known=self.known,
+                working_day=self.working_day,
+                day_of_week=self.day_of_week,
+                month=self.month,
+                meta=np.array(json.dumps({"version":self.version,"product_names":self.product_names})))
+
+        except Exception as e:
+            dim_logger.warning(f"DimensionSnapshotError: Failed to save snapshot {self.snapshot_path}, {e}")
+
+
+    # Load Snapshot
+    def load_snapshot(self,version) -> bool:
+        """
+        Restores the snapshot only when it was saved for the given version, None accepts any version
+        """
+        if (self.snapshot_path == None) or (not os.path.exists(self.snapshot_path)):
+            return False
+        try:
+            with np.load(self.snapshot_path) as snapshot:
+                meta = json.loads(str(snapshot["meta"]))
+                if (version != None) and (meta["version"] != version):
+                    return False
+                start = snapshot["start"][0]
+                self.start = None if np.isnat(start) else start
+                self.known = snapshot["known"]
+                self.working_day = snapshot["working_day"]
+                self.day_of_week = snapshot["day_of_week"]
+                self.month = snapshot["month"]
+            self.product_names = {int(product_id):product_name for product_id,product_name in meta["product_names"].items()}
+            self.version = meta["version"]
+            return True
+
+        except Exception as e:
+            dim_logger.warning(f"DimensionSnapshotError: Failed to load snapshot {self.snapshot_path}, {e}")
+            return False
@@ -0,0 +1,301 @@
+# imports
+import hashlib
+import logging
+from psycopg2.extras import RealDictCursor
+
+from database.ingestion import read_csv, rows_hash, CHUNK_SIZE
+from database.sharded import sharded_ingest, LOAD_SHARDS
+from pipeline.prefetch import prefetch
+
+# Setup Logging
+inc_logger = logging.getLogger(__name__)
+inc_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+inc_logger.addHandler(file_handler)
+
+# Natural key of each staging table, None when rows can only be told apart by position
+NATURAL_KEYS = {
+    "orders":"order_id",
+    "shipment_deliveries":"shipment_id",
+    "reviews":None
+}
+
+WATERMARK_COLUMNS = """(
+    tablename VARCHAR PRIMARY KEY,
+    source VARCHAR NOT NULL,
+    high_water BIGINT NOT NULL,
+    rows_loaded BIGINT NOT NULL,
+    source_hash VARCHAR NOT NULL,
+    prefix_hash VARCHAR NOT NULL,
+    generation BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )"""
+
+
+# Source File Hash
+def file_hash(path,block_size=1024*1024) -> str:
+    digest = hashlib.sha256()
+    with open(path,"rb") as source:
+        for block in iter(lambda: source.read(block_size),b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class watermarks():
+    """
+    Incremental staging loads keyed on each table's natural key
+    A persisted watermark per table records the source file hash, the highest key loaded and a hash of the rows at or
+    below it, so an unchanged file costs one primary key lookup and an appended file only writes rows above the key
+    db: database instance used to write rows
+    schemaname: Schema holding the staging tables and the load_watermarks table
+    """
+
+    def __init__(self,db,schemaname,tablename="load_watermarks") -> None:
+        self.db = db
+        self.schemaname = schemaname
+        self.tablename = tablename
+
+
+    # Create Watermark Table
+    def create(self,cursor,connect) -> bool:
+        return self.db.create_table(cursor,connect,WATERMARK_COLUMNS,self.tablename,self.schemaname)
+
+
+    # Read Watermark
+    def get(self,connect,tablename):
+        cursor = connect.cursor(cursor_factory=RealDictCursor)
+        try:
+            cursor.execute(f"SELECT * FROM {self.schemaname}.{self.tablename} WHERE tablename = %s;",(tablename,))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+
+    # Save Watermark
+    def save(self,cursor,connect,tablename,source,high_water,rows_loaded,source_hash,prefix_hash):
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.{self.tablename} (tablename,source,high_water,rows_loaded,source_hash,prefix_hash,updated_at)
+            VALUES (%s,%s,%s,%s,%s,%s,now())
+            ON CONFLICT (tablename) DO UPDATE SET
+                source = EXCLUDED.source,
+                high_water = EXCLUDED.high_water,
+                rows_loaded = EXCLUDED.rows_loaded,
+                source_hash = EXCLUDED.source_hash,
+                prefix_hash = EXCLUDED.prefix_hash,
+                updated_at = EXCLUDED.updated_at;""",(tablename,source,int(high_water),int(rows_loaded),source_hash,str(prefix_hash)))
+        connect.commit()
+
+
+    # Bump Generation
+    def bump_generation(self,cursor,tablename):
+        """
+        Marks that rows already loaded were deleted or replaced, so state built from earlier rows is rebuilt
+        Runs inside the caller's transaction. A table without a watermark yet (e.g. loaded in stream mode) gets a
+        placeholder row that claims no source, so the bump is never lost and the next load still writes the file
+        """
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.{self.tablename} AS t (tablename,source,high_water,rows_loaded,source_hash,prefix_hash,generation,updated_at)
+            VALUES (%s,'',0,0,'','0',1,now())
+            ON CONFLICT (tablename) DO UPDATE SET generation = t.generation + 1, updated_at = now();""",(tablename,))
+
+
+    # Highest Loaded Key
+    def high_water(self,cursor,tablename,key) -> int:
+        """
+        One indexed MAX query on the natural key, correct even when a previous load stopped part way
+        """
+        cursor.execute(f"SELECT COALESCE(MAX({key}),0) FROM {self.schemaname}.{tablename};")
+        return int(cursor.fetchone()[0])
+
+
+    # Rows In Table
+    def row_count(self,cursor,tablename) -> int:
+        cursor.execute(f"SELECT COUNT(*) FROM {self.schemaname}.{tablename};")
+        return int(cursor.fetchone()[0])
+
+
+    # Write Rows
+    def copy_rows(self,cursor,connect,dataframe,tablename,batch_size,commit=True) -> int:
+        """
+        copy_data that raises instead of returning None, so a failed write never lets the watermark move forward
+        """
+        written = self.db.copy_data(cursor,connect,dataframe,tablename,self.schemaname,batch_size=batch_size,commit=commit)
+        if written == None:
+            raise RuntimeError(f"failed to copy {len(dataframe)} rows into {tablename}")
+        return written
+
+
+    # Empty Table
+    def is_empty(self,cursor,tablename) -> bool:
+        cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {self.schemaname}.{tablename});")
+        return cursor.fetchone()[0]
+
+
+    # Stage Rows
+    def stage_rows(self,cursor,connect,cleaned,tablename):
+        """
+        Copies the rows into the incoming_rows temp table, shaped like the staging table and dropped on commit
+        """
+        column_names = ",".join(cleaned.columns)
+        cursor.execute(f"CREATE TEMP TABLE incoming_rows ON COMMIT DROP AS SELECT {column_names} FROM {self.schemaname}.{tablename} LIMIT 0;")
+        if self.db.copy_data(cursor,connect,cleaned,"incoming_rows","pg_temp",batch_size=len(cleaned),commit=False) == None:
+            raise RuntimeError(f"failed to stage {len(cleaned)} rows of {tablename}")
+
+
+    # Insert Staged Rows Whose Key Is Not Loaded
+    def insert_staged(self,cursor,tablename,columns,key) -> int:
+        column_names = ",".join(columns)
+        source = ",".join([f"s.{column}" for column in columns])
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.{tablename} ({column_names})
+            SELECT {source} FROM incoming_rows s
+            WHERE NOT EXISTS (SELECT 1 FROM {self.schemaname}.{tablename} t WHERE t.{key} = s.{key});""")
+        return cursor.rowcount
+
+
+    # Write Missing Rows
+    def insert_missing(self,cursor,connect,cleaned,tablename,key) -> int:
+        """
+        Writes only the rows whose key is not in the table yet, an anti join instead of a key range so rows left
+        behind by a load that stopped part way through an unsorted file are found wherever they sit in it
+        """
+        if len(cleaned) == 0:
+            return 0
+        self.stage_rows(cursor,connect,cleaned,tablename)
+        inserted = self.insert_staged(cursor,tablename,list(cleaned.columns),key)
+        connect.commit()
+        return inserted
+
+
+    # Rewrite Changed Rows
+    def merge_changed(self,cursor,connect,cleaned,tablename,key):
+        """
+        Stages rows at or below the watermark in a temp table and replaces only those that differ from the table
+        """
+        columns = list(cleaned.columns)
+        target = ",".join([f"t.{column}" for column in columns])
+        source = ",".join([f"s.{column}" for column in columns])
+
+        self.stage_rows(cursor,connect,cleaned,tablename)
+        cursor.execute(f"DELETE FROM {self.schemaname}.{tablename} t USING incoming_rows s WHERE t.{key} = s.{key} AND ({target}) IS DISTINCT FROM ({source});")
+        changed = cursor.rowcount
+        if changed != 0:
+            self.bump_generation(cursor,tablename)
+        self.insert_staged(cursor,tablename,columns,key)
+        connect.commit()
+        return changed
+
+
+    # Incremental Load
+    def ingest(self,cursor,connect,tablename,path,chunksize=None,shards=None) -> int:
+        """
+        connect: Database connection
+        cursor: Database connection cursor
+        tablename: Staging table loaded, its natural key comes from NATURAL_KEYS
+        path: CSV file loaded into the table
+        shards: Worker processes for the first load into an empty table, defaults to LOAD_SHARDS
+        Returns the number of rows written
+        """
+        if chunksize == None:
+            chunksize = CHUNK_SIZE
+        if shards == None:
+            shards = LOAD_SHARDS
+        key = NATURAL_KEYS.get(tablename)
+
+        source_hash = file_hash(path)
+        mark = self.get(connect,tablename)
+        if (mark != None) and (mark["source_hash"] == source_hash):
+            inc_logger.info(f"{tablename}: {path} unchanged since last load, skipping")
+            return 0
+
+        # A first load into an empty table is split across processes, later loads only write the delta
+        if (mark == None) and (shards > 1) and (self.is_empty(cursor,tablename) == True):
+            totals = sharded_ingest(cursor,connect,tablename,self.schemaname,path,key=key,shards=shards,chunksize=chunksize)
+            self.save(cursor,connect,tablename,path,totals["high"] if key != None else totals["rows"],totals["rows"],source_hash,totals["hash"])
+            return totals["rows"]
+
+        previous_high = mark["high_water"] if mark != None else 0
+        previous_rows = mark["rows_loaded"] if mark != None else 0
+        previous_prefix = int(mark["prefix_hash"]) if mark != None else 0
+
+        if key != None:
+            return self.ingest_keyed(cursor,connect,tablename,path,key,chunksize,source_hash,previous_high,previous_prefix)
+        return self.ingest_positional(cursor,connect,tablename,path,chunksize,source_hash,previous_rows,previous_prefix)
+
+
+    def ingest_keyed(self,cursor,connect,tablename,path,key,chunksize,source_hash,previous_high,previous_prefix):
+        loaded_high = self.high_water(cursor,tablename,key)
+
+        # Rows above the stored watermark are new, the rows at or below it are only hashed. Keys above the watermark
+        # already in the table were committed by a load that stopped part way, the file need not be sorted by key so
+        # those rows can sit anywhere in it and are matched by key rather than by MAX(key)
+        resumed = loaded_high > previous_high
+        if resumed == True:
+            inc_logger.warning(f"{tablename}: {key} {loaded_high} loaded above the watermark {previous_high}, resuming an interrupted load")
+        written = 0
+        seen = 0
+        high = loaded_high
+        prefix = 0
+        total = 0
+        for chunk in prefetch(read_csv(tablename,path,chunksize=chunksize),name=tablename):
+            seen += len(chunk)
+            if len(chunk) != 0:
+                high = max(high,int(chunk[key].max()))
+            new_rows = chunk[chunk[key] > previous_high]
+            if resumed == True:
+                written += self.insert_missing(cursor,connect,self.db.clean_frame(new_rows),tablename,key)
+            else:
+                written += self.copy_rows(cursor,connect,new_rows,tablename,chunksize)
+            prefix = rows_hash(self.db.clean_frame(chunk[chunk[key] <= previous_high]),prefix)
+            total = rows_hash(self.db.clean_frame(chunk),total)
+
+        # Rows already loaded are only revisited when the file changed below the watermark
+        changed = 0
+        if (previous_high > 0) and (prefix != previous_prefix):
+            inc_logger.warning(f"{tablename}: {path} changed at or below {key} {previous_high}, replacing changed rows")
+            for chunk in read_csv(tablename,path,chunksize=chunksize):
+                old_rows = chunk[chunk[key] <= previous_high]
+                if len(old_rows) != 0:
+                    changed += self.merge_changed(cursor,connect,self.db.clean_frame(old_rows),tablename,key)
+
+        self.save(cursor,connect,tablename,path,high,seen,source_hash,total)
+        inc_logger.info(f"{tablename}: wrote {written} new rows above {key} {previous_high}, replaced {changed} changed rows, watermark now {high}")
+        return written + changed
+
+
+    def ingest_positional(self,cursor,connect,tablename,path,chunksize,source_hash,previous_rows,previous_prefix):
+        # Without a natural key rows are matched by position, so the first rows_loaded rows must be unchanged
+        seen = 0
+        prefix = 0
+        total = 0
+        for chunk in read_csv(tablename,path,chunksize=chunksize):
+            prefix = rows_hash(self.db.clean_frame(chunk.iloc[:max(previous_rows - seen,0)]),prefix)
+            total = rows_hash(self.db.clean_frame(chunk),total)
+            seen += len(chunk)
+
+        # The table must hold exactly the rows the watermark covers, anything else was not written by a completed chunk
+        loaded_rows = self.row_count(cursor,tablename)
+        skip_rows = previous_rows
+        if (previous_rows > seen) or (prefix != previous_prefix) or (loaded_rows != previous_rows):
+            inc_logger.warning(f"{tablename}: {path} changed before row {previous_rows} or the table holds {loaded_rows} rows, reloading the table")
+            cursor.execute(f"TRUNCATE {self.schemaname}.{tablename};")
+            self.bump_generation(cursor,tablename)
+            connect.commit()
+            skip_rows = 0
+            prefix = 0
+
+        # Each chunk commits together with a watermark covering it, a load that stops part way resumes after the last
+        # committed chunk. The source hash is only recorded once the whole file is in
+        written = 0
+        loaded = skip_rows
+        for chunk in prefetch(read_csv(tablename,path,chunksize=chunksize,skip_rows=skip_rows),name=tablename):
+            written += self.copy_rows(cursor,connect,chunk,tablename,chunksize,commit=False)
+            loaded += len(chunk)
+            prefix = rows_hash(self.db.clean_frame(chunk),prefix)
+            self.save(cursor,connect,tablename,path,loaded,loaded,"",prefix)
+
+        self.save(cursor,connect,tablename,path,seen,seen,source_hash,total)
+        inc_logger.info(f"{tablename}: wrote {written} rows after row {skip_rows}")
+        return written
@@ -0,0 +1,88 @@
+# imports
+import os
+import numpy as np
+import pandas as pd
+
+from database.snapshots import load_snapshot, open_writer
+
+# Explicit read_csv schemas for the staging inputs, nullable integers keep gaps without falling back to float
+SCHEMAS = {
+    "orders":{
+        "dtype":{"order_id":"Int32","customer_id":"Int32","product_id":"Int16","unit_price":"Int32","quantity":"Int16","total_price":"Int32"},
+        "parse_dates":["order_date"]
+    },
+    "reviews":{
+        "dtype":{"review":"Int8","product_id":"Int16"},
+        "parse_dates":[]
+    },
+    "shipment_deliveries":{
+        "dtype":{"shipment_id":"Int32","order_id":"Int32"},
+        "parse_dates":["shipment_date","delivery_date"]
+    }
+}
+
+# Rows read and written per chunk
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE",50000))
+
+
+# Read CSV With Schema
+def read_csv(tablename,path,chunksize=None,skip_rows=0):
+    """
+    tablename: Staging table whose schema is applied, one of SCHEMAS
+    path: CSV file with a header row
+    chunksize: Rows per dataframe, returns an iterator of dataframes when given
+    skip_rows: Number of data rows skipped after the header
+    With STAGING_SNAPSHOTS set, a file path is read from its memory mapped columnar snapshot when the CSV is unchanged,
+    otherwise a full parse of the file also writes the snapshot for the next run
+    """
+    if isinstance(path,str):
+        snapshot = load_snapshot(tablename,path,skip_rows)
+        if snapshot is not None:
+            if chunksize == None:
+                return snapshot
+            return (snapshot.iloc[start:start+chunksize] for start in range(0,len(snapshot),chunksize))
+
+    schema = SCHEMAS[tablename]
+    frames = pd.read_csv(
+        path,
+        dtype=schema["dtype"],
+        parse_dates=schema["parse_dates"],
+        skiprows=range(1,skip_rows+1),
+        chunksize=chunksize)
+
+    writer = open_writer(tablename,path) if (isinstance(path,str)) and (skip_rows == 0) else None
+    if writer == None:
+        return frames
+    if chunksize == None:
+        writer.append(frames)
+        writer.commit()
+        return frames
+    return snapshot_chunks(frames,writer)
+
+
+# Snapshot Chunks As They Are Read
+def snapshot_chunks(frames,writer):
+    """
+    The snapshot is only committed once every chunk was read, a reader that stops early leaves none behind
+    """
+    try:
+        for frame in frames:
+            writer.append(frame)
+            yield frame
+        writer.commit()
+
+    finally:
+        if writer.released == False:
+            writer.discard()
+
+
+# Order Independent Row Hash
+def rows_hash(cleaned,start=0) -> int:
+    """
+    cleaned: dataframe as cleaned by database.clean_frame
+    start: Hash of the rows before this chunk
+    Sums the per row hashes modulo 2**64 so the digest depends on neither row order nor how the rows are chunked
+    """
+    if len(cleaned) == 0:
+        return start
+    return (start + int(pd.util.hash_pandas_object(cleaned,index=False).to_numpy(dtype=np.uint64).sum(dtype=np.uint64))) % 2**64
@@ -0,0 +1,144 @@
+# imports
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from database.db import database
+from database.ingestion import read_csv, rows_hash, CHUNK_SIZE
+
+# Setup Logging
+shard_logger = logging.getLogger(__name__)
+shard_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+shard_logger.addHandler(file_handler)
+
+# Worker processes used for a sharded load, 1 keeps loads in the calling process
+LOAD_SHARDS = int(os.getenv("LOAD_SHARDS",1))
+
+
+# Split CSV By Byte Range
+def byte_ranges(path,shards) -> tuple:
+    """
+    Returns (header, [(start, end), ...]) splitting the data rows of the file into up to shards byte ranges,
+    every range starts at the beginning of a line. Rows must not contain quoted line breaks
+    """
+    size = os.path.getsize(path)
+    with open(path,"rb") as source:
+        header = source.readline()
+        body_start = source.tell()
+        bounds = [body_start]
+        for shard in range(1,shards):
+            source.seek(body_start + (size - body_start)*shard//shards)
+            source.readline()
+            bounds.append(max(source.tell(),bounds[-1]))
+        bounds.append(size)
+    return header,[(start,end) for start,end in zip(bounds,bounds[1:]) if end > start]
+
+
+class shard_reader():
+    """
+    Binary file like view of one byte range of a CSV with the header row in front, read by pandas.read_csv
+    """
+
+    def __init__(self,path,header,start,end) -> None:
+        self.source = open(path,"rb")
+        self.source.seek(start)
+        self.header = header
+        self.remaining = end - start
+
+    def read(self,size=-1):
+        if self.header != b"":
+            chunk,self.header = self.header,b""
+            return chunk
+        if (size == None) or (size < 0) or (size > self.remaining):
+            size = self.remaining
+        chunk = self.source.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.source.close()
+
+
+# Load One Shard
+def load_shard(tablename,schemaname,shard_table,path,header,start,end,key,chunksize) -> dict:
+    """
+    Runs in a worker process with its own connection, COPYs its byte range into the shard table and commits it
+    Returns the rows written, their order independent hash and the highest natural key seen
+    """
+    db = database()
+    connect = db.conn()
+    cursor = connect.cursor()
+    reader = shard_reader(path,header,start,end)
+    result = {"rows":0,"hash":0,"high":0}
+    try:
+        for chunk in read_csv(tablename,reader,chunksize=chunksize):
+            if (key != None) and (len(chunk) != 0):
+                result["high"] = max(result["high"],int(chunk[key].max()))
+            result["hash"] = rows_hash(db.clean_frame(chunk),result["hash"])
+            written = db.copy_data(cursor,connect,chunk,shard_table,schemaname,batch_size=chunksize,commit=False)
+            if written == None:
+                raise RuntimeError(f"failed to copy rows {start}-{end} of {path}")
+            result["rows"] += written
+        connect.commit()
+        return result
+
+    finally:
+        reader.close()
+        db.close(connect,cursor)
+
+
+# Sharded Load
+def sharded_ingest(cursor,connect,tablename,schemaname,path,key=None,shards=None,chunksize=None) -> dict:
+    """
+    connect: Coordinating database connection
+    cursor: Coordinating database connection cursor
+    key: Natural key column whose highest value is reported, None for tables without one
+    shards: Worker processes, defaults to LOAD_SHARDS
+    Splits the CSV by byte range across a process pool, each worker parses and COPYs its range into an unlogged
+    shard table on its own connection. Once every shard is in, one coordinating transaction moves the rows into
+    the table and drops the shard table, so the table either gains the whole file or nothing
+    Returns {"rows", "hash", "high"} totals over all shards
+    """
+    if shards == None:
+        shards = LOAD_SHARDS
+    if chunksize == None:
+        chunksize = CHUNK_SIZE
+
+    shard_table = f"{tablename}_shards"
+    header,ranges = byte_ranges(path,shards)
+    totals = {"rows":0,"hash":0,"high":0}
+    start = time.perf_counter()
+
+    # Shard rows take their ids from the table's own sequence through the copied defaults
+    cursor.execute(f"DROP TABLE IF EXISTS {schemaname}.{shard_table};")
+    cursor.execute(f"CREATE UNLOGGED TABLE {schemaname}.{shard_table} (LIKE {schemaname}.{tablename} INCLUDING DEFAULTS);")
+    connect.commit()
+
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges) or 1) as executor:
+            futures = [executor.submit(load_shard,tablename,schemaname,shard_table,path,header,range_start,range_end,key,chunksize) for range_start,range_end in ranges]
+            for future in futures:
+                result = future.result()
+                totals["rows"] += result["rows"]
+                totals["hash"] = (totals["hash"] + result["hash"]) % 2**64
+                totals["high"] = max(totals["high"],result["high"])
+
+        cursor.execute(f"INSERT INTO {schemaname}.{tablename} SELECT * FROM {schemaname}.{shard_table} ORDER BY id;")
+        cursor.execute(f"DROP TABLE {schemaname}.{shard_table};")
+        connect.commit()
+
+        elapsed = time.perf_counter() - start
+        rate = totals["rows"]/elapsed if elapsed > 0 else float(totals["rows"])
+        shard_logger.info(f"{tablename}: Sharded Load Complete, {totals['rows']} rows over {len(ranges)} shards in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+        return totals
+
+    except Exception as e:
+        connect.rollback()
+        cursor.execute(f"DROP TABLE IF EXISTS {schemaname}.{shard_table};")
+        connect.commit()
+        shard_logger.critical(f"ShardedLoadError: Failed to load {path} into {tablename}, nothing was written, {e}")
+        raise
@@ -0,0 +1,189 @@
+# imports
+import os
+import json
+import shutil
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+# Setup Logging
+snapshot_logger = logging.getLogger(__name__)
+snapshot_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+snapshot_logger.addHandler(file_handler)
+
+# Folder holding one columnar snapshot per parsed input CSV, unset disables snapshots
+STAGING_SNAPSHOTS = os.getenv("STAGING_SNAPSHOTS")
+
+# Snapshot folders being written, a second reader of the same input parses without writing
+writing = set()
+writing_lock = threading.Lock()
+
+
+# Source Fingerprint
+def source_stamp(path) -> dict:
+    """
+    Size and modification time of the CSV a snapshot was parsed from, a re-downloaded file gets a new stamp
+    """
+    stat = os.stat(path)
+    return {"size":stat.st_size,"mtime_ns":stat.st_mtime_ns}
+
+
+# Snapshot Folder
+def snapshot_dir(tablename,folder=None):
+    folder = folder if folder != None else STAGING_SNAPSHOTS
+    if folder == None:
+        return None
+    return os.path.join(folder,tablename)
+
+
+class snapshot_writer():
+    """
+    Writes parsed chunks of one input as raw column files (<column>.bin, plus <column>.mask for nullable integers),
+    meta.json is written last by commit so a half written snapshot is never read back
+    tablename: Staging table the input belongs to
+    path: Source CSV
+    folder: Snapshot folder, defaults to STAGING_SNAPSHOTS
+    """
+
+    def __init__(self,tablename,path,folder=None) -> None:
+        self.tablename = tablename
+        self.path = path
+        self.directory = snapshot_dir(tablename,folder)
+        self.stamp = source_stamp(path)
+        self.columns = None
+        self.rows = 0
+        self.failed = False
+        self.released = False
+
+        shutil.rmtree(self.directory,ignore_errors=True)
+        os.makedirs(self.directory)
+
+
+    # Column Layout
+    def layout(self,frame) -> dict:
+        """
+        Returns {column: {"kind", "dtype"}}, kind is "int" for nullable integers, "datetime" for dates and "numpy" for
+        plain numpy dtypes, dtype is the raw dtype of the column file
+        """
+        columns = {}
+        for column,dtype in frame.dtypes.items():
+            if isinstance(dtype,pd.core.arrays.integer.IntegerDtype):
+                columns[column] = {"kind":"int","dtype":str(dtype.numpy_dtype)}
+            elif pd.api.types.is_datetime64_ns_dtype(dtype) and not isinstance(dtype,pd.DatetimeTZDtype):
+                columns[column] = {"kind":"datetime","dtype":"int64"}
+            elif (dtype.kind in "biuf") and isinstance(dtype,np.dtype):
+                columns[column] = {"kind":"numpy","dtype":str(dtype)}
+            else:
+                raise TypeError(f"column {column} of type {dtype} cannot be snapshotted")
+        return columns
+
+
+    # Append Chunk
+    def append(self,frame):
+        if self.failed == True:
+            return
+        try:
+            if self.columns == None:
+                self.columns = self.layout(frame)
+            for column,spec in self.columns.items():
+                values = frame[column]
+                with open(os.path.join(self.directory,f"{column}.bin"),"ab") as out:
+                    if spec["kind"] == "int":
+                        values.to_numpy(dtype=spec["dtype"],na_value=0).tofile(out)
+                        with open(os.path.join(self.directory,f"{column}.mask"),"ab") as mask:
+                            values.isna().to_numpy().tofile(mask)
+                    elif spec["kind"] == "datetime":
+                        values.to_numpy(dtype="datetime64[ns]").view(np.int64).tofile(out)
+                    else:
+                        values.to_numpy(dtype=spec["dtype"]).tofile(out)
+            self.rows += len(frame)
+
+        except Exception as e:
+            self.failed = True
+            snapshot_logger.warning(f"SnapshotError: {self.tablename} snapshot of {self.path} abandoned, {e}")
+
+
+    # Commit
+    def commit(self) -> bool:
+        try:
+            if (self.failed == True) or (self.columns == None):
+                shutil.rmtree(self.directory,ignore_errors=True)
+                return False
+            meta = {"tablename":self.tablename,"source":self.stamp,"rows":self.rows,"columns":self.columns}
+            with open(os.path.join(self.directory,"meta.json"),"w") as out:
+                json.dump(meta,out)
+            snapshot_logger.info(f"Snapshot: saved {self.rows} {self.tablename} rows of {self.path} to {self.directory}")
+            return True
+
+        finally:
+            self.release()
+
+
+    # Abandon
+    def discard(self):
+        shutil.rmtree(self.directory,ignore_errors=True)
+        self.release()
+
+    def release(self):
+        self.released = True
+        with writing_lock:
+            writing.discard(self.directory)
+
+
+# Open Writer
+def open_writer(tablename,path,folder=None):
+    """
+    Returns a snapshot_writer for the input, None when snapshots are disabled or another thread is writing this snapshot
+    """
+    directory = snapshot_dir(tablename,folder)
+    if directory == None:
+        return None
+    with writing_lock:
+        if directory in writing:
+            return None
+        writing.add(directory)
+    try:
+        return snapshot_writer(tablename,path,folder)
+    except Exception as e:
+        with writing_lock:
+            writing.discard(directory)
+        snapshot_logger.warning(f"SnapshotError: cannot write the {tablename} snapshot to {directory}, {e}")
+        return None
+
+
+# Load Snapshot
+def load_snapshot(tablename,path,skip_rows=0,folder=None):
+    """
+    skip_rows: Number of leading rows left out
+    Returns the input as a dataframe whose columns are memory mapped from the snapshot, typed like read_csv returns them,
+    None when snapshots are disabled, missing or older than the CSV
+    """
+    directory = snapshot_dir(tablename,folder)
+    if (directory == None) or (not os.path.exists(os.path.join(directory,"meta.json"))):
+        return None
+    try:
+        with open(os.path.join(directory,"meta.json")) as source:
+            meta = json.load(source)
+        if meta["source"] != source_stamp(path):
+            return None
+
+        rows = meta["rows"]
+        columns = {}
+        for column,spec in meta["columns"].items():
+            values = np.memmap(os.path.join(directory,f"{column}.bin"),dtype=spec["dtype"],mode="r",shape=(rows,)) if rows != 0 else np.zeros(0,dtype=spec["dtype"])
+            if spec["kind"] == "int":
+                mask = np.memmap(os.path.join(directory,f"{column}.mask"),dtype=bool,mode="r",shape=(rows,)) if rows != 0 else np.zeros(0,dtype=bool)
+                columns[column] = pd.arrays.IntegerArray(values[skip_rows:],mask[skip_rows:])
+            elif spec["kind"] == "datetime":
+                columns[column] = values[skip_rows:].view("datetime64[ns]")
+            else:
+                columns[column] = values[skip_rows:]
+        return pd.DataFrame(columns,copy=False)
+
+    except Exception as e:
+        snapshot_logger.warning(f"SnapshotError: failed to read the {tablename} snapshot in {directory}, {e}")
+        return None
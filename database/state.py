@@ -0,0 +1,248 @@
+# imports
+import logging
+import numpy as np
+
+from analytics.products import rank_review_counts
+
+# Setup Logging
+state_logger = logging.getLogger(__name__)
+state_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/db.log",delay=True)
+file_handler.setFormatter(formatter)
+state_logger.addHandler(file_handler)
+
+# Running aggregate tables, each one is fed by a single staging table
+STATE_TABLES = {
+    "state_progress":"""(
+        source VARCHAR PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        generation BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )""",
+    "state_orders_per_day":"""(
+        order_date date PRIMARY KEY,
+        orders BIGINT NOT NULL
+        )""",
+    "state_product_orders":"""(
+        product_id INTEGER PRIMARY KEY,
+        quantity INTEGER NOT NULL,
+        order_date date NOT NULL
+        )""",
+    "state_product_reviews":"""(
+        product_id INTEGER PRIMARY KEY,
+        review_count BIGINT NOT NULL,
+        review_sum BIGINT NOT NULL,
+        one_star BIGINT NOT NULL,
+        two_star BIGINT NOT NULL,
+        three_star BIGINT NOT NULL,
+        four_star BIGINT NOT NULL,
+        five_star BIGINT NOT NULL
+        )""",
+    "state_open_shipments":"""(
+        shipment_id INTEGER PRIMARY KEY,
+        order_id INTEGER,
+        order_date date,
+        shipment_date date NOT NULL
+        )""",
+    "state_product_shipments":"""(
+        product_id INTEGER PRIMARY KEY,
+        early BIGINT NOT NULL,
+        late BIGINT NOT NULL
+        )"""
+}
+
+# State tables rebuilt from scratch when their staging table is rewritten
+SOURCES = {
+    "orders":["state_orders_per_day","state_product_orders"],
+    "reviews":["state_product_reviews"],
+    "shipment_deliveries":["state_open_shipments","state_product_shipments"]
+}
+
+STAR_NAMES = ["one_star","two_star","three_star","four_star","five_star"]
+
+
+class analytics_state():
+    """
+    Running aggregates behind agg_public_holiday, agg_shipments and best_performing_product
+    Each staging table is consumed by its SERIAL id, so a run only aggregates the rows added since the last run and
+    the exported rows are derived from the small state tables. A staging table whose loaded rows were replaced
+    (its load_watermarks generation moved on) has its state rebuilt from the whole table
+    db: database instance used to create the state tables and run the prepared lookups
+    staging: Schema holding the staging tables and load_watermarks
+    schemaname: Schema holding the state tables
+    """
+
+    def __init__(self,db,staging,schemaname,watermark_table="load_watermarks") -> None:
+        self.db = db
+        self.staging = staging
+        self.schemaname = schemaname
+        self.watermark_table = watermark_table
+
+
+    # Create State Tables
+    def create(self,cursor,connect):
+        for tablename,columns in STATE_TABLES.items():
+            self.db.create_table(cursor,connect,columns,tablename,self.schemaname)
+
+
+    # Source Generation
+    def generation(self,cursor,source) -> int:
+        cursor.execute(f"SELECT generation FROM {self.staging}.{self.watermark_table} WHERE tablename = %s;",(source,))
+        row = cursor.fetchone()
+        return int(row[0]) if row != None else 0
+
+
+    # Update State From New Rows
+    def update(self,cursor,connect,source) -> int:
+        """
+        source: Staging table whose new rows are folded into its state tables, one of SOURCES
+        Runs in one transaction holding the source's progress row, so concurrent tasks never apply a delta twice
+        Returns the number of staging ids consumed
+        """
+        try:
+            cursor.execute(f"INSERT INTO {self.schemaname}.state_progress (source) VALUES (%s) ON CONFLICT (source) DO NOTHING;",(source,))
+            cursor.execute(f"SELECT last_id, generation FROM {self.schemaname}.state_progress WHERE source = %s FOR UPDATE;",(source,))
+            last_id,generation = cursor.fetchone()
+            current_generation = self.generation(cursor,source)
+            cursor.execute(f"SELECT COALESCE(MAX(id),0) FROM {self.staging}.{source};")
+            high = int(cursor.fetchone()[0])
+
+            # Rows already folded in were replaced or removed, start over from the whole table
+            if (current_generation != generation) or (high < last_id):
+                state_logger.warning(f"AnalyticsState: {source} was rewritten, rebuilding {SOURCES[source]}")
+                cursor.execute(f"TRUNCATE {','.join([f'{self.schemaname}.{tablename}' for tablename in SOURCES[source]])};")
+                last_id = 0
+
+            if high > last_id:
+                getattr(self,f"apply_{source}")(cursor,last_id,high)
+
+            cursor.execute(f"UPDATE {self.schemaname}.state_progress SET last_id = %s, generation = %s, updated_at = now() WHERE source = %s;",(high,current_generation,source))
+            connect.commit()
+            state_logger.info(f"AnalyticsState: {source} ids {last_id} to {high} applied")
+            return high - last_id
+
+        except Exception as e:
+            connect.rollback()
+            state_logger.critical(f"AnalyticsStateError: Failed to update state from {source}, {e}")
+            raise
+
+
+    # Orders Delta
+    def apply_orders(self,cursor,low,high):
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.state_orders_per_day AS t (order_date,orders)
+            SELECT o.order_date, COUNT(*)
+            FROM {self.staging}.orders o
+            WHERE o.id > %s AND o.id <= %s AND o.order_date IS NOT NULL
+            GROUP BY o.order_date
+            ON CONFLICT (order_date) DO UPDATE SET orders = t.orders + EXCLUDED.orders;""",(low,high))
+
+        # Largest order per product, latest date first on ties
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.state_product_orders AS t (product_id,quantity,order_date)
+            SELECT DISTINCT ON (o.product_id) o.product_id, o.quantity, o.order_date
+            FROM {self.staging}.orders o
+            WHERE o.id > %s AND o.id <= %s AND o.product_id IS NOT NULL AND o.quantity IS NOT NULL AND o.order_date IS NOT NULL
+            ORDER BY o.product_id, o.quantity DESC, o.order_date DESC
+            ON CONFLICT (product_id) DO UPDATE SET quantity = EXCLUDED.quantity, order_date = EXCLUDED.order_date
+            WHERE (EXCLUDED.quantity,EXCLUDED.order_date) > (t.quantity,t.order_date);""",(low,high))
+
+
+    # Reviews Delta
+    def apply_reviews(self,cursor,low,high):
+        stars = ",".join([f"COUNT(*) FILTER (WHERE r.review = {star})" for star in range(1,6)])
+        updates = ",".join([f"{column} = t.{column} + EXCLUDED.{column}" for column in ["review_count","review_sum"] + STAR_NAMES])
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.state_product_reviews AS t (product_id,review_count,review_sum,{','.join(STAR_NAMES)})
+            SELECT r.product_id, COUNT(*), SUM(r.review), {stars}
+            FROM {self.staging}.reviews r
+            WHERE r.id > %s AND r.id <= %s AND r.product_id IS NOT NULL AND r.review IS NOT NULL
+            GROUP BY r.product_id
+            ON CONFLICT (product_id) DO UPDATE SET {updates};""",(low,high))
+
+
+    # Shipments Delta
+    def apply_shipment_deliveries(self,cursor,low,high):
+        """
+        Shipments are matched to the orders loaded so far, an order is expected to be loaded no later than its shipment
+        """
+        # Shipped but undelivered shipments join the open set, delivered ones leave it
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.state_open_shipments (shipment_id,order_id,order_date,shipment_date)
+            SELECT s.shipment_id, s.order_id, o.order_date, NULLIF(s.shipment_date,'-')::date
+            FROM {self.staging}.shipment_deliveries s
+            INNER JOIN {self.staging}.orders o ON o.order_id = s.order_id
+            WHERE s.id > %s AND s.id <= %s AND s.delivery_date = '-' AND s.shipment_date != '-'
+            ON CONFLICT (shipment_id) DO NOTHING;""",(low,high))
+        cursor.execute(f"""
+            DELETE FROM {self.schemaname}.state_open_shipments t
+            USING {self.staging}.shipment_deliveries s
+            WHERE s.id > %s AND s.id <= %s AND s.shipment_id = t.shipment_id AND s.delivery_date != '-';""",(low,high))
+
+        # Early and late shipments per product
+        cursor.execute(f"""
+            INSERT INTO {self.schemaname}.state_product_shipments AS t (product_id,early,late)
+            SELECT o.product_id,
+                COUNT(*) FILTER (WHERE NULLIF(s.shipment_date,'-')::date - o.order_date < 6),
+                COUNT(*) FILTER (WHERE NULLIF(s.shipment_date,'-')::date - o.order_date >= 6)
+            FROM {self.staging}.shipment_deliveries s
+            INNER JOIN {self.staging}.orders o ON o.order_id = s.order_id
+            WHERE s.id > %s AND s.id <= %s AND s.shipment_date != '-' AND o.product_id IS NOT NULL
+            GROUP BY o.product_id
+            ON CONFLICT (product_id) DO UPDATE SET early = t.early + EXCLUDED.early, late = t.late + EXCLUDED.late;""",(low,high))
+
+
+    # Orders Per Day
+    def orders_per_day(self,cursor,since) -> list:
+        """
+        since: Earliest order_date counted
+        Returns (order_date, order_count) rows, one per day
+        """
+        return self.db.query(cursor,f"SELECT order_date, orders FROM {self.schemaname}.state_orders_per_day WHERE order_date >= %s;",(since,))
+
+
+    # Late And Undelivered Shipments
+    def shipment_counts(self,cursor,today) -> tuple:
+        """
+        today: Date undelivered shipments are measured against
+        Returns (late_shipments, undelivered_shipments) over the open shipment set
+        """
+        late,undelivered = self.db.query(cursor,f"""
+            SELECT
+                COUNT(*) FILTER (WHERE shipment_date - order_date >= 6),
+                COUNT(*) FILTER (WHERE %s::date - order_date >= 15)
+            FROM {self.schemaname}.state_open_shipments;""",(today,),one=True)
+        return late,undelivered
+
+
+    # Product Ranking
+    def rank_products(self,cursor,product_names=None):
+        """
+        Returns the same ranking as analytics.products.rank_products, built from the per product review counts
+        """
+        counts = self.db.fetch_dataframe(cursor,f"SELECT product_id, review_count, review_sum, {','.join(STAR_NAMES)} FROM {self.schemaname}.state_product_reviews;")
+        return rank_review_counts(counts["product_id"],counts["review_count"],counts["review_sum"],counts[STAR_NAMES].to_numpy(dtype=np.int64),product_names)
+
+
+    # Largest Order For A Product
+    def largest_order_date(self,cursor,product_id):
+        """
+        Returns the date of the product's largest order, None when the product has no orders
+        """
+        row = self.db.query(cursor,f"SELECT order_date FROM {self.schemaname}.state_product_orders WHERE product_id = %s;",(product_id,),one=True)
+        return row[0] if row != None else None
+
+
+    # Early And Late Shipments For A Product
+    def shipment_timeliness(self,cursor,product_id) -> tuple:
+        """
+        Returns (pct_early_shipments, pct_late_shipments) over the product's shipped orders, zeros when it has none
+        """
+        row = self.db.query(cursor,f"SELECT early, late FROM {self.schemaname}.state_product_shipments WHERE product_id = %s;",(product_id,),one=True)
+        if row == None:
+            return 0.0,0.0
+        early,late = row
+        if early + late == 0:
+            return 0.0,0.0
+        return (early/(early + late))*100,(late/(early + late))*100
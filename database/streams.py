@@ -0,0 +1,75 @@
+# imports
+import io
+import csv
+import codecs
+
+# Cells written as "-", matching the "nan" -> "-" cleaning done by copy_data and Thread_write
+MISSING_VALUES = ("","nan")
+
+class csv_normalizer():
+    """
+    File like object that reads CSV rows from a binary stream (an S3 StreamingBody or an open file),
+    replaces missing cells with "-" and hands the rows out as CSV text through read(), so it can be
+    passed straight to cursor.copy_expert without the file ever being held in memory or written to disk
+    stream: Binary stream of CSV text with a header row
+    skip_rows: Number of data rows dropped after the header, used to resume partially loaded tables
+    key_column: Optional natural key column, rows whose key is at or below high_water are dropped
+    """
+
+    def __init__(self,stream,encoding="utf-8",skip_rows=0,missing="-",read_size=64*1024,key_column=None,high_water=0) -> None:
+        self.reader = csv.reader(codecs.getreader(encoding)(stream))
+        self.header = next(self.reader,[])
+        self.missing = missing
+        self.read_size = read_size
+        self.rows = 0
+        self.buffer = ""
+        self.output = io.StringIO()
+        self.writer = csv.writer(self.output,lineterminator="\n")
+        self.key_index = self.header.index(key_column) if key_column != None else None
+        self.high_water = high_water
+
+        for _ in range(skip_rows):
+            if next(self.reader,None) == None:
+                break
+
+
+    # Normalize Rows Until Enough Text Is Buffered
+    def fill(self,size):
+        while len(self.buffer) < size:
+            for row in self.reader:
+                if (self.key_index != None) and (row[self.key_index] != "") and (int(row[self.key_index]) <= self.high_water):
+                    continue
+                self.writer.writerow([self.missing if cell in MISSING_VALUES else cell for cell in row])
+                self.rows += 1
+                if self.output.tell() >= size:
+                    break
+
+            text = self.output.getvalue()
+            if text == "":
+                break
+            self.buffer = self.buffer + text
+            self.output.seek(0)
+            self.output.truncate()
+
+
+    # File Like Read
+    def read(self,size=-1):
+        if (size == None) or (size < 0):
+            chunks = []
+            while True:
+                chunk = self.read(self.read_size)
+                if chunk == "":
+                    return "".join(chunks)
+                chunks.append(chunk)
+
+        self.fill(size)
+        chunk,self.buffer = self.buffer[:size],self.buffer[size:]
+        return chunk
+
+    def readline(self,size=-1):
+        self.fill(1)
+        end = self.buffer.find("\n") + 1
+        if end == 0:
+            end = len(self.buffer)
+        line,self.buffer = self.buffer[:end],self.buffer[end:]
+        return line
@@ -1,252 +1,355 @@
 # imports
+# pandas, psycopg2 and boto3 are imported by the tasks that use them, so planning a run or running a single
+# stage does not pay for the modules it never touches. The environment is loaded by cli.py before this import
+import sys
+
+# python main.py runs the whole pipeline through the CLI, see cli.py for running single stages. The CLI loads .env
+# and imports this module as "main", so the hand off comes before any setup below: otherwise the __main__ copy would
+# read its settings before .env and add a second handler to the "main" logger, writing every line twice
+if __name__ == "__main__":
+    from cli import cli
+    sys.exit(cli(sys.argv[1:] or ["run"]))
+
 import os
-import math
 import logging
-import pandas as pd
-
 
-from s3.s3 import bucket
-from dotenv import load_dotenv
-from database.db import database
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
-
-load_dotenv(".env")
+from pipeline.dag import dag
+from pipeline.metrics import metrics
 
 # Setup Logging
 main_logger = logging.getLogger("main")
 main_logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
-file_handler = logging.FileHandler("log_files/main.log")
+file_handler = logging.FileHandler("log_files/main.log",delay=True)
 file_handler.setFormatter(formatter)
 main_logger.addHandler(file_handler)
 
+# Rows committed per transaction when bulk loading
+BATCH_SIZE = int(os.getenv("BATCH_SIZE",5000))
+
+# "csv" downloads the inputs and loads them from dataframes, "stream" pipes the S3 objects straight into COPY
+LOAD_MODE = os.getenv("LOAD_MODE","csv")
+
+# "state" computes the analytics from the running state tables, "memory" straight from the downloaded CSVs (LOAD_MODE=csv only)
+# so the exports no longer wait for the staging loads
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE","state")
+
+# Compare the memory engine with the state tables once both are ready, PARITY_CHECK=1
+PARITY_CHECK = os.getenv("PARITY_CHECK") == "1"
+
+# Format of the files written to exports/ and uploaded, "csv", "csv.gz" or "parquet" (needs pyarrow, falls back to csv.gz)
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT","csv")
+EXPORT_FORMATS = ("csv","csv.gz","parquet")
+
+# Run report written after every run, JSON and a Prometheus textfile (point METRICS_TEXTFILE into the node_exporter textfile directory)
+METRICS_JSON = os.getenv("METRICS_JSON","log_files/metrics.json")
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE","log_files/metrics.prom")
+
+# Analytics nodes of the pipeline, each writes one analytics table and export
+ANALYTIC_NODES = ("agg_public_holiday","agg_shipments","best_performing_product")
+
+# Number of products reported in the review ranking
+TOP_N = int(os.getenv("TOP_N",5))
+
+# Inputs downloaded from the bucket, (file_category, src_name, dst_name)
+INPUT_FILES = [
+    ("orders","orders.csv","downloads/orders.csv"),
+    ("orders","reviews.csv","downloads/reviews.csv"),
+    ("orders","shipment_deliveries.csv","downloads/shipment_deliveries.csv")
+]
+
+# Staging tables
+STAGING_TABLES = {
+    "orders":"(id SERIAL PRIMARY KEY, order_id INTEGER, customer_id INTEGER, order_date date, product_id INTEGER, unit_price INTEGER, quantity INTEGER, total_price INTEGER)",
+    "reviews":"(id SERIAL PRIMARY KEY, review INTEGER, product_id INTEGER)",
+    "shipment_deliveries":"(id SERIAL PRIMARY KEY, shipment_id INTEGER, order_id INTEGER, shipment_date VARCHAR, delivery_date VARCHAR)"
+}
+
+# Staging indexes, built after the first bulk load and kept up to date by the incremental loads after it. The natural
+# keys serve the high water and key lookups of the incremental loads and orders(order_id) the shipments join of the
+# state deltas, the deltas themselves read id ranges through the primary keys
+STAGING_INDEXES = {
+    "orders":["order_id"],
+    "reviews":[],
+    "shipment_deliveries":["shipment_id"]
+}
+
+# Indexes built by earlier versions that no pipeline query reads, dropped so incremental loads stop maintaining them
+RETIRED_INDEXES = {
+    "orders":["product_id","order_date"],
+    "reviews":["product_id"],
+    "shipment_deliveries":["order_id"]
+}
+
+# Optional yearly range partitions of orders by order_date, "first_year:last_year" e.g. 2020:2030
+ORDERS_PARTITION_YEARS = os.getenv("ORDERS_PARTITION_YEARS")
+
+# A partitioned table's primary key must include the partition key
+PARTITIONED_ORDERS_COLUMNS = "(id SERIAL, order_id INTEGER, customer_id INTEGER, order_date date, product_id INTEGER, unit_price INTEGER, quantity INTEGER, total_price INTEGER, PRIMARY KEY (id, order_date))"
+
+# Statements the pipeline runs against the staging tables, whose plans are checked under normal costing,
+# (name, table expected to be read through an index, query, params). The incremental loads' high water and key
+# lookups (database.incremental) and the id range reads of the state deltas (database.state apply_*), each delta
+# over the last PLAN_CHECK_IDS ids of its table like an incremental run
+PLAN_CHECKS = [
+    ("orders_high_water","orders","SELECT COALESCE(MAX(order_id),0) FROM {staging}.orders;",None),
+    ("shipments_high_water","shipment_deliveries","SELECT COALESCE(MAX(shipment_id),0) FROM {staging}.shipment_deliveries;",None),
+    ("orders_key_lookup","orders","SELECT 1 FROM {staging}.orders t WHERE t.order_id = %s;",(1,)),
+    ("shipments_key_lookup","shipment_deliveries","SELECT 1 FROM {staging}.shipment_deliveries t WHERE t.shipment_id = %s;",(1,)),
+    ("orders_delta","orders","SELECT o.order_date, COUNT(*) FROM {staging}.orders o WHERE o.id > %s AND o.id <= %s AND o.order_date IS NOT NULL GROUP BY o.order_date;","orders"),
+    ("reviews_delta","reviews","SELECT r.product_id, COUNT(*), SUM(r.review) FROM {staging}.reviews r WHERE r.id > %s AND r.id <= %s AND r.product_id IS NOT NULL AND r.review IS NOT NULL GROUP BY r.product_id;","reviews"),
+    ("shipments_delta","shipment_deliveries","SELECT s.shipment_id FROM {staging}.shipment_deliveries s WHERE s.id > %s AND s.id <= %s AND s.delivery_date != '-';","shipment_deliveries"),
+    ("shipments_join_orders","orders","SELECT o.product_id, o.order_date FROM {staging}.shipment_deliveries s INNER JOIN {staging}.orders o ON o.order_id = s.order_id WHERE s.id > %s AND s.id <= %s AND s.shipment_date != '-';","shipment_deliveries")
+]
+
+# Ids in the delta range of the PLAN_CHECKS state deltas
+PLAN_CHECK_IDS = int(os.getenv("PLAN_CHECK_IDS",BATCH_SIZE))
+
+# Analytics tables
+AGG_PUBLIC_HOLIDAY_COLUMNS = """(
+    ingestion_date date NOT NULL, 
+    tt_order_hol_jan int NOT NULL, 
+    tt_order_hol_feb int NOT NULL, 
+    tt_order_hol_mar int NOT NULL, 
+    tt_order_hol_apr int NOT NULL, 
+    tt_order_hol_may int NOT NULL, 
+    tt_order_hol_jun int NOT NULL, 
+    tt_order_hol_jul int NOT NULL, 
+    tt_order_hol_aug int NOT NULL,
+    tt_order_hol_sep int NOT NULL,
+    tt_order_hol_oct int NOT NULL,
+    tt_order_hol_nov int NOT NULL,
+    tt_order_hol_dec int NOT NULL
+    )"""
+
+AGG_SHIPMENTS_COLUMNS = """(
+    ingestion_date date NOT NULL,
+    tt_late_shipments int NOT NULL,
+    tt_undelivered_items int NOT NULL
+    )"""
+
+BEST_PERFORMING_PRODUCT_COLUMNS = """(
+    ingestion_date date NOT NULL,
+    product_name varchar NOT NULL,
+    most_ordered_day date NOT NULL,
+    is_public_holiday bool NOT NULL,
+    tt_review_points int NOT NULL,
+    pct_one_star_review float NOT NULL,
+    pct_two_star_review float NOT NULL,
+    pct_three_star_review float NOT NULL,
+    pct_four_star_review float NOT NULL,
+    pct_five_star_review float NOT NULL,
+    pct_early_shipments float NOT NULL,
+    pct_late_shipments float NOT NULL
+)"""
+
 
 # functions
-def add_dataframe_to_table(db,dataframe,db_cursor,db_conn,tablename,schemaname,check=True):
+def add_dataframe_to_table(db,dataframe,db_cursor,db_conn,tablename,schemaname,check=True,batch_size=BATCH_SIZE):
     try:
-        column_names = tuple(dataframe.columns)
-        data = dataframe.to_dict()
-        data_list = list()
-        for i in range(len(dataframe)):
-            dict_data = {f"{j}":f"{data[j][i]}" for j in column_names}
-            data_list.append(dict_data)
+        # Skip rows already written on a previous run
         if check == True:
-            db.write_data(db_cursor,db_conn,data_list,tablename,schemaname)
-        else:
-            db.write_data(db_cursor,db_conn,data_list,tablename,schemaname,check=False)
+            written = db.fetch_data(db_cursor,"COUNT(*)",f"{schemaname}.{tablename}",all=False,one=True)[0]
+            dataframe = dataframe.iloc[written:]
+
+        db.copy_data(db_cursor,db_conn,dataframe,tablename,schemaname,batch_size=batch_size)
     except Exception as e:
         main_logger.critical(f"AddDataframeToTableError: failed to add dataframe to {tablename}, {e}")
 
-def best_performing_product():
-    # Fetch review data
-    review_data = db.fetch_data(db_cursor,"*",f"{staging}.reviews")
-
-    review_count_dict = {}
-    review_points_sum = {}
-    review_points_distribution = {}
-
-    for review in review_data:
-        if f"id_{review[2]}" in review_count_dict.keys():
-            review_count_dict[f"id_{review[2]}"] = review_count_dict[f"id_{review[2]}"] + 1
-        else:
-            review_count_dict[f"id_{review[2]}"] = 1
-
-        if f"id_{review[2]}" in review_points_sum.keys():
-            review_points_sum[f"id_{review[2]}"] = review_points_sum[f"id_{review[2]}"] + review[1]
-        else:
-            review_points_sum[f"id_{review[2]}"] = review[1]
-
-        if f"id_{review[2]}_{review[1]}" in review_points_distribution.keys():
-            review_points_distribution[f"id_{review[2]}_{review[1]}"] = review_points_distribution[f"id_{review[2]}_{review[1]}"] + 1
-        else:
-            review_points_distribution[f"id_{review[2]}_{review[1]}"] = 1
-
-    # Highest Reviewed Product
-    index = list(review_count_dict.values()).index(max(list(review_count_dict.values())))
-    highest_reviewed = list(review_count_dict.keys())[index]
-    highest_reviewed_id = highest_reviewed.split("_")[-1]
-    review_sum = review_points_sum[highest_reviewed]
-    pct_one_star = (review_points_distribution[f"{highest_reviewed}_1"]/review_count_dict[highest_reviewed])*100
-    pct_two_star = (review_points_distribution[f"{highest_reviewed}_2"]/review_count_dict[highest_reviewed])*100
-    pct_three_star = (review_points_distribution[f"{highest_reviewed}_3"]/review_count_dict[highest_reviewed])*100
-    pct_four_star = (review_points_distribution[f"{highest_reviewed}_4"]/review_count_dict[highest_reviewed])*100
-    pct_five_star = (review_points_distribution[f"{highest_reviewed}_5"]/review_count_dict[highest_reviewed])*100
-    product_data = db.fetch_data(db_cursor,"product_name","if_common.dim_products",filtered=True,filter=f"product_id = {highest_reviewed_id}",all=False,one=True)
-    product_name = product_data[0]
-    return(highest_reviewed_id,product_name,review_sum,pct_one_star,pct_two_star,pct_three_star,pct_four_star,pct_five_star)
-
-
-# Data Processing
-if __name__ == "__main__":
-
-    # Connect to database
-    db = database()
-    db_conn = db.conn()
-    db_cursor = db.create_cursor(db_conn)
-    staging = os.getenv("STAGING")
-    analytics = os.getenv("ANALYTICS")
+def write_export(dataframe,name,folder="exports",fmt=None) -> str:
+    # Write an export without the dataframe index in EXPORT_FORMAT, copies of it in the other formats are removed so only this one is uploaded
+    fmt = fmt if fmt != None else EXPORT_FORMAT
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format {fmt}, expected one of {EXPORT_FORMATS}")
 
-    # Connect to bucket and download files
-    bk = bucket()
-    os.makedirs("downloads", exist_ok=True)
-    bk.download(file_category="orders",src_name="orders.csv",dst_name="downloads/orders.csv")
-    bk.download(file_category="orders",src_name="reviews.csv",dst_name="downloads/reviews.csv")
-    bk.download(file_category="orders",src_name="shipment_deliveries.csv",dst_name="downloads/shipment_deliveries.csv")
+    path = f"{folder}/{name}.{fmt}"
+    if fmt == "parquet":
+        try:
+            dataframe.to_parquet(path,index=False,compression="snappy")
+        except ImportError as e:
+            main_logger.warning(f"ExportFormat: parquet needs pyarrow, writing {name}.csv.gz instead, {e}")
+            return write_export(dataframe,name,folder,"csv.gz")
+    else:
+        dataframe.to_csv(path,index=False,compression="infer")
 
-    # load csv
-    orders_df = pd.read_csv("downloads/orders.csv")
-    reviews_df = pd.read_csv("downloads/reviews.csv")
-    shipments_df = pd.read_csv("downloads/shipment_deliveries.csv")
+    for other in EXPORT_FORMATS:
+        if (other != fmt) and (os.path.exists(f"{folder}/{name}.{other}")):
+            os.remove(f"{folder}/{name}.{other}")
+    return path
 
-    # Create csv tables
+def ingest_table(db,marks,path,tablename,schemaname):
+    # Load only new or changed rows of the CSV in typed chunks, tracked by the table's watermark
     try:
-        orders_columns = "(id SERIAL PRIMARY KEY, order_id INTEGER, customer_id INTEGER, order_date date, product_id INTEGER, unit_price INTEGER, quantity INTEGER, total_price INTEGER)"
-        reviews_columns = "(id SERIAL PRIMARY KEY, review INTEGER, product_id INTEGER)"
-        shipments_columns = "(id SERIAL PRIMARY KEY, shipment_id INTEGER, order_id INTEGER, shipment_date VARCHAR, delivery_date VARCHAR)"
-        db.create_table(db_cursor,db_conn,orders_columns,"orders",staging)
-        db.create_table(db_cursor,db_conn,reviews_columns,"reviews",staging)
-        db.create_table(db_cursor,db_conn,shipments_columns,"shipment_deliveries",staging)
+        with db.pooled() as (conn,cursor):
+            marks.ingest(cursor,conn,tablename,path)
     except Exception as e:
-        main_logger.critical(f"CreateTableError: failed to create tables, {e}")
-
-
-    # Write to csv tables
+        main_logger.critical(f"IngestTableError: failed to ingest {path} into {tablename}, {e}")
+        raise
+
+def stream_table(db,bk,marks,file_category,src_name,tablename,schemaname):
+    # Pipe the S3 object through the normalizer into COPY without touching disk
+    from database.streams import csv_normalizer
+    from database.incremental import NATURAL_KEYS
+    body = None
     try:
-        with ThreadPoolExecutor() as executor:
-            executor.submit(add_dataframe_to_table,db,orders_df,db_cursor,db_conn,"orders",staging)
-        with ThreadPoolExecutor() as executor:
-            executor.submit(add_dataframe_to_table,db,reviews_df,db_cursor,db_conn,"reviews",staging)
-        with ThreadPoolExecutor() as executor:
-            executor.submit(add_dataframe_to_table,db,shipments_df,db_cursor,db_conn,"shipment_deliveries",staging)
+        body = bk.stream(file_category,src_name)
+        key = NATURAL_KEYS.get(tablename)
+        with db.pooled() as (conn,cursor):
+            if key != None:
+                normalizer = csv_normalizer(body,key_column=key,high_water=marks.high_water(cursor,tablename,key))
+            else:
+                written = db.fetch_data(cursor,"COUNT(*)",f"{schemaname}.{tablename}",all=False,one=True)[0]
+                normalizer = csv_normalizer(body,skip_rows=written)
+            db.copy_stream(cursor,conn,normalizer,tablename,schemaname)
     except Exception as e:
-        main_logger.critical(f"WriteTableError: failed to write tables, {e}")
+        main_logger.critical(f"StreamTableError: failed to stream {src_name} into {tablename}, {e}")
+        raise
+    finally:
+        # Closing records the streamed bytes when the load stopped before the end of the object
+        if body != None:
+            body.close()
+
+# Pipeline Tasks
+def download_input(bk,file_category,src_name,dst_name):
+    # Only files whose ETag, size or LastModified changed are downloaded again, each file is handed to its load as soon as it lands
+    if LOAD_MODE == "stream":
+        return {dst_name:True}
+    os.makedirs("downloads", exist_ok=True)
+    return bk.sync_many([(file_category,src_name,dst_name)])
 
+def create_staging_tables(db,marks,state,staging):
+    try:
+        with db.pooled() as (conn,cursor):
+            for tablename,columns in STAGING_TABLES.items():
+                if (tablename == "orders") and (ORDERS_PARTITION_YEARS != None):
+                    first_year,last_year = [int(year) for year in ORDERS_PARTITION_YEARS.split(":")]
+                    db.create_table(cursor,conn,PARTITIONED_ORDERS_COLUMNS,tablename,staging,partition_by="RANGE (order_date)")
+                    db.create_partitions(cursor,conn,tablename,staging,first_year,last_year)
+                else:
+                    db.create_table(cursor,conn,columns,tablename,staging)
+            marks.create(cursor,conn)
+            state.create(cursor,conn)
+    except Exception as e:
+        main_logger.critical(f"CreateTableError: failed to create tables, {e}")
+        raise
+
+def load_dimensions(db,dims):
+    # dim_dates and dim_products are read at most once per run, the memory engine settles for the DIM_SNAPSHOT file when there is one
+    if (ANALYTICS_ENGINE == "memory") and (LOAD_MODE == "csv") and (dims.restore() == True):
+        return
+    with db.pooled() as (conn,cursor):
+        dims.load(cursor)
+
+def load_frames(engine):
+    # Typed dataframes of the downloaded inputs for the memory engine
+    engine.load(*[dst_name for _,_,dst_name in INPUT_FILES])
+
+def load_input(db,bk,marks,runner,file_category,src_name,dst_name,staging):
+    tablename = src_name.replace(".csv","")
+    if LOAD_MODE == "stream":
+        stream_table(db,bk,marks,file_category,src_name,tablename,staging)
+    # Without a download in this run (cli.py --no-deps) the local file is loaded, its watermark skips it when unchanged
+    elif (runner.results.get(f"download_{tablename}",{}).get(dst_name,True) == True) or (os.getenv("FORCE_LOAD") == "1"):
+        ingest_table(db,marks,dst_name,tablename,staging)
+    else:
+        main_logger.info(f"LoadTable: {tablename} input unchanged, skipping load")
+
+def index_table(db,tablename,staging):
+    # Indexes are created once the table holds its bulk load, then the planner statistics are refreshed
+    with db.pooled() as (conn,cursor):
+        if db.drop_indexes(cursor,conn,tablename,staging,RETIRED_INDEXES.get(tablename,[])) == False:
+            raise RuntimeError(f"failed to drop the retired indexes of {tablename}")
+        if db.create_indexes(cursor,conn,tablename,staging,STAGING_INDEXES[tablename]) == False:
+            raise RuntimeError(f"failed to index {tablename}")
+
+def check_query_plans(db,staging) -> dict:
+    # EXPLAIN every pipeline statement under normal costing and warn when the planner does not read its table through an index.
+    # A delta's params name the table whose last PLAN_CHECK_IDS ids it reads
+    results = {}
+    with db.pooled() as (conn,cursor):
+        for name,tablename,Query,params in PLAN_CHECKS:
+            if isinstance(params,str):
+                cursor.execute(f"SELECT COALESCE(MAX(id),0) FROM {staging}.{params};")
+                high = int(cursor.fetchone()[0])
+                params = (max(high - PLAN_CHECK_IDS,0),high)
+            scans = db.plan_scans(db.explain(cursor,conn,Query.format(staging=staging),params))
+            node_types = set().union(*[types for relation,types in scans.items() if relation == tablename or relation.startswith(f"{tablename}_")])
+            results[name] = len(node_types & {"Index Scan","Index Only Scan","Bitmap Heap Scan"}) != 0
+            if results[name] == True:
+                main_logger.info(f"QueryPlan: {name} reads {tablename} through {sorted(node_types)}")
+            else:
+                main_logger.warning(f"QueryPlanWarning: the planner does not read {tablename} through an index for {name}, scans {scans}")
+    return results
+
+def public_holiday_months(source,cursor,dims,since) -> dict:
+    # Orders per day from the analytics source, summed per month over the public holidays in the local dim_dates cache
+    from analytics.engine import holiday_month_totals
+    daily_orders = source.orders_per_day(cursor,since)
+    return holiday_month_totals(dims,[row[0] for row in daily_orders],[row[1] for row in daily_orders])
+
+def task_public_holiday(db,source,dims,analytics):
+    import pandas as pd
     # Total number of orders placed on a public holiday every month, for the past year.
     try:
-        # Fetch Data
-        data = db.fetch_data(db_cursor,"*",f"{staging}.orders",secondary_tablename="if_common.dim_dates",all=True,filtered=True,filter="if_common.dim_dates.working_day = False AND 1 <= if_common.dim_dates.day_of_the_week_num AND 5 >= if_common.dim_dates.day_of_the_week_num",join=True,join_condition=f"if_common.dim_dates.calendar_dt = {staging}.orders.order_date")
-
-        # Create Data Columns
-        data_columns = ["db_id"] + list(orders_df.columns) + ["calendar_dt","year_num","month_of_the_year_num","day_of_the_month_num","day_of_the_week_num","working_day"]
-
-        # Create DataFrame
-        data_df = pd.DataFrame(data,columns=data_columns)
-
         # Get last year limit
         todays_date = datetime.utcnow().date()
         last_year_limit = todays_date - timedelta(days=365)
 
-        # Remove unwanted data
-        for i in range(len(data)):
-            if (data_df["order_date"][i] < last_year_limit):
-                data_df.drop(i,inplace=True)
-        data_df = data_df.reset_index(drop=True)
-
-        # Aggrigate public holiday sales
-        months = {1:0,2:0,3:0,4:0,5:0,6:0,7:0,8:0,9:0,10:0,11:0,12:0}
-        for i in range(len(data_df)):
-            monthKey = int(data_df["month_of_the_year_num"][i])
-            months[monthKey] = months[data_df["month_of_the_year_num"][i]] + 1
-        main_logger.debug(f"AggPublicHolidaySales: {months}")
-
-        # Create/Update Table
-        agg_pub_columns = """(
-            ingestion_date date NOT NULL, 
-            tt_order_hol_jan int NOT NULL, 
-            tt_order_hol_feb int NOT NULL, 
-            tt_order_hol_mar int NOT NULL, 
-            tt_order_hol_apr int NOT NULL, 
-            tt_order_hol_may int NOT NULL, 
-            tt_order_hol_jun int NOT NULL, 
-            tt_order_hol_jul int NOT NULL, 
-            tt_order_hol_aug int NOT NULL,
-            tt_order_hol_sep int NOT NULL,
-            tt_order_hol_oct int NOT NULL,
-            tt_order_hol_nov int NOT NULL,
-            tt_order_hol_dec int NOT NULL
-            )"""
-
-        db.create_table(db_cursor,db_conn,agg_pub_columns,"agg_public_holiday",analytics)
-        mnths = {
-                "ingestion_date":[todays_date],
-                "tt_order_hol_jan":[months[1]],
-                "tt_order_hol_feb":[months[2]],
-                "tt_order_hol_mar":[months[3]],
-                "tt_order_hol_apr":[months[4]],
-                "tt_order_hol_may":[months[5]],
-                "tt_order_hol_jun":[months[6]],
-                "tt_order_hol_jul":[months[7]],
-                "tt_order_hol_aug":[months[8]],
-                "tt_order_hol_sep":[months[9]],
-                "tt_order_hol_oct":[months[10]],
-                "tt_order_hol_nov":[months[11]],
-                "tt_order_hol_dec":[months[12]]
-                }
-        
-        # Create transformation dataframe
-        df_dict = pd.DataFrame.from_dict(mnths)
-
-        # Export to csv
-        df_dict.to_csv("exports/agg_public_holiday.csv")
-
-        # Write result to db
-        with ThreadPoolExecutor() as executor:
-            executor.submit(add_dataframe_to_table,db,df_dict,db_cursor,db_conn,"agg_public_holiday",analytics,check=False)
+        with db.pooled() as (db_conn,db_cursor):
+            # Aggrigate public holiday sales from the per day order counts
+            source.update(db_cursor,db_conn,"orders")
+            months = public_holiday_months(source,db_cursor,dims,last_year_limit)
+            main_logger.debug(f"AggPublicHolidaySales: {months}")
+
+            # Create/Update Table
+            db.create_table(db_cursor,db_conn,AGG_PUBLIC_HOLIDAY_COLUMNS,"agg_public_holiday",analytics)
+            mnths = {
+                    "ingestion_date":[todays_date],
+                    "tt_order_hol_jan":[months[1]],
+                    "tt_order_hol_feb":[months[2]],
+                    "tt_order_hol_mar":[months[3]],
+                    "tt_order_hol_apr":[months[4]],
+                    "tt_order_hol_may":[months[5]],
+                    "tt_order_hol_jun":[months[6]],
+                    "tt_order_hol_jul":[months[7]],
+                    "tt_order_hol_aug":[months[8]],
+                    "tt_order_hol_sep":[months[9]],
+                    "tt_order_hol_oct":[months[10]],
+                    "tt_order_hol_nov":[months[11]],
+                    "tt_order_hol_dec":[months[12]]
+                    }
+
+            # Create transformation dataframe
+            df_dict = pd.DataFrame.from_dict(mnths)
+
+            # Export
+            write_export(df_dict,"agg_public_holiday")
+
+            # Write result to db
+            add_dataframe_to_table(db,df_dict,db_cursor,db_conn,"agg_public_holiday",analytics,check=False)
 
         main_logger.debug(f"AggPublicHolidaySales: {mnths}")
     except Exception as e:
         main_logger.critical(f"TaskError:AggPublicHolidaySales: failed to complete task, {e}")
+        raise
 
+def task_shipments(db,source,analytics):
+    import pandas as pd
     # Total number of late and undelivered shipments
     try:
-        # Fetch data
-        task2_data = db.fetch_data(db_cursor,"*",f"{staging}.orders",secondary_tablename=f"{staging}.shipment_deliveries",all=True,join=True,join_condition=f"{staging}.shipment_deliveries.order_id = {staging}.orders.order_id",filtered=True,filter=f"{staging}.shipment_deliveries.delivery_date = '-' AND {staging}.shipment_deliveries.shipment_date != '-'")
-        task3_data = db.fetch_data(db_cursor,"*",f"{staging}.orders",secondary_tablename=f"{staging}.shipment_deliveries",all=True,join=True,join_condition=f"{staging}.shipment_deliveries.order_id = {staging}.orders.order_id",filtered=True,filter=f"{staging}.shipment_deliveries.delivery_date = '-' AND {staging}.shipment_deliveries.shipment_date = '-'")
-
-        # Data columns
-        data_columns = ["oid"] + list(orders_df.columns) + ["sid","shipment_id","order_id","shipment_date","delivery_date"]
-
-        # Dataframes
-        task2_data_df = pd.DataFrame(task2_data,columns=data_columns)
-        task3_data_df = pd.DataFrame(task3_data,columns=data_columns)
-
-        # Late shipment counter
-        late_shipment_counter = 0
-        for i in range(len(task2_data_df)):
-            order_date = task2_data_df["order_date"][i]
-            shipment_date_str = task2_data_df["shipment_date"][i]
-            shipment_date = datetime.strptime(shipment_date_str,"%Y-%m-%d").date()
-            diff = shipment_date - order_date
-            if diff >= timedelta(days=6):
-                late_shipment_counter += 1
-
-        main_logger.debug(f"LateShipmentCount: {late_shipment_counter}")
-
-        # Undelivered shipment counter
-        undelivered_shipment_counter = 0
-        for i in range(len(task2_data_df)):
-            order_date = task2_data_df["order_date"][i]
-            todays_date = datetime.utcnow().date()
-            diff = todays_date - order_date
-            if diff >= timedelta(days=15):
-                undelivered_shipment_counter += 1
+        todays_date = datetime.utcnow().date()
 
-        main_logger.debug(f"UndeliveredShipmentCount: {undelivered_shipment_counter}")
-        
-    except Exception as e:
-        main_logger.critical(f"TaskError:Late&UndeliveredShipments: failed while fetching data {e}")
+        with db.pooled() as (db_conn,db_cursor):
+            # Late and undelivered shipment counters over the open shipment set
+            source.update(db_cursor,db_conn,"shipment_deliveries")
+            late_shipment_counter,undelivered_shipment_counter = source.shipment_counts(db_cursor,todays_date)
 
-    else:
-        try:
-            # Create table if not exists
-            agg_shp_columns = """(
-                ingestion_date date NOT NULL,
-                tt_late_shipments int NOT NULL,
-                tt_undelivered_items int NOT NULL
-                )"""
+            main_logger.debug(f"LateShipmentCount: {late_shipment_counter}")
+            main_logger.debug(f"UndeliveredShipmentCount: {undelivered_shipment_counter}")
 
-            db.create_table(db_cursor,db_conn,agg_shp_columns,"agg_shipments",analytics)
+            # Create table if not exists
+            db.create_table(db_cursor,db_conn,AGG_SHIPMENTS_COLUMNS,"agg_shipments",analytics)
 
             shipments_analytics = {
                 "ingestion_date":[todays_date],
@@ -258,106 +361,54 @@ if __name__ == "__main__":
             # Create transformation dataframe
             df_dict = pd.DataFrame.from_dict(shipments_analytics)
 
-            # Export to csv
-            df_dict.to_csv("exports/agg_shipments.csv")
+            # Export
+            write_export(df_dict,"agg_shipments")
 
             # Write late and Undelivered shipments to db
-            with ThreadPoolExecutor() as executor:
-                executor.submit(add_dataframe_to_table,db,df_dict,db_cursor,db_conn,"agg_shipments",analytics,check=False)
+            add_dataframe_to_table(db,df_dict,db_cursor,db_conn,"agg_shipments",analytics,check=False)
 
-        except Exception as e:
-            main_logger.critical(F"TaskError:Late&UndeliveredSipments: failed while writing data, {e}")
+    except Exception as e:
+        main_logger.critical(f"TaskError:Late&UndeliveredShipments: failed to complete task, {e}")
+        raise
 
-        # Best Performing Product
-        try:
-            with ThreadPoolExecutor() as executor:
-                process_thread = executor.submit(best_performing_product)
-            data = process_thread.result()
-            
-            # Fetch order data for best performing product
-            highest_reviewed_id = data[0]
-            order_data = db.fetch_data(db_cursor,"*",f"{staging}.orders",filtered=True,filter=f"product_id = {highest_reviewed_id}")
-
-            # Find date of highest data
-            highest_order_date = datetime.strptime("0001-01-01","%Y-%m-%d").date()
-            highest_order = 0
-            for order in order_data:
-                if (order[6] >= highest_order) and (order[3] >= highest_order_date):
-                    highest_order_date = order[3]
-                    highest_order = order[6]
-
-            # Check date is public holiday or not with dim_dates
-            calender_data = db.fetch_data(db_cursor,"day_of_the_week_num,working_day","if_common.dim_dates",filtered=True,filter=f"calendar_dt = '{highest_order_date}'")
-            day_of_the_week,working_day = calender_data[0]
-
-            if (day_of_the_week in range(1,6)):
-                if (working_day == True):
-                    is_public_holiday = False
-                else:
-                    is_public_holiday = True
+def task_best_performing_product(db,source,dims,analytics):
+    import pandas as pd
+    # Best Performing Product
+    try:
+        with db.pooled() as (db_conn,db_cursor):
+            # Fold the new staging rows into the running per product counts
+            for tablename in ("reviews","orders","shipment_deliveries"):
+                source.update(db_cursor,db_conn,tablename)
+
+            # Rank every product from its review counts, then name the top N from the cached dim_products
+            ranking = source.rank_products(db_cursor,product_names=dims.product_names).head(TOP_N)
+            main_logger.debug(f"ProductRanking:{ranking.to_dict(orient='records')}")
+            write_export(ranking,"product_ranking")
+            data = ranking.iloc[0]
+
+            # Most ordered day for best performing product and whether it was a public holiday
+            highest_reviewed_id = int(data["product_id"])
+            highest_order_date = source.largest_order_date(db_cursor,highest_reviewed_id)
+            is_public_holiday = dims.is_public_holiday(highest_order_date)
 
             # Early and late shipments
-            shipments_data = db.fetch_data(
-                db_cursor,
-                "*",
-                f"{staging}.orders",
-                secondary_tablename=f"{staging}.shipment_deliveries",
-                all=True,
-                join=True,
-                join_condition=f"{staging}.shipment_deliveries.order_id = {staging}.orders.order_id",
-                filtered=True,
-                filter=f"{staging}.shipment_deliveries.shipment_date != '-' AND {staging}.orders.product_id = {highest_reviewed_id}")
-
-            data_columns = ["oid"] + list(orders_df.columns) + ["sid","shipment_id","order_id","shipment_date","delivery_date"]
-            shipments_data_df = pd.DataFrame(shipments_data,columns=data_columns)
-
-            total_shipments = len(shipments_data)
-            early_shipment_count = 0
-            late_shipment_count = 0
-
-            for i in range(total_shipments):
-                order_date = shipments_data_df["order_date"][i]
-                shipment_date_str = shipments_data_df["shipment_date"][i]
-                shipment_date = datetime.strptime(shipment_date_str,"%Y-%m-%d").date()
-                diff = shipment_date - order_date
-                if diff >= timedelta(days=6):
-                    late_shipment_count += 1
-                else:
-                    early_shipment_count += 1
-
-            pct_late_shipment = (late_shipment_count/total_shipments)*100
-            pct_early_shipment = (early_shipment_count/total_shipments)*100
+            pct_early_shipment,pct_late_shipment = source.shipment_timeliness(db_cursor,highest_reviewed_id)
             todays_date = datetime.utcnow().date()
 
             # Create/Update Database
-            best_performing_product_columns = """(
-                ingestion_date date NOT NULL,
-                product_name varchar NOT NULL,
-                most_ordered_day date NOT NULL,
-                is_public_holiday bool NOT NULL,
-                tt_review_points int NOT NULL,
-                pct_one_star_review float NOT NULL,
-                pct_two_star_review float NOT NULL,
-                pct_three_star_review float NOT NULL,
-                pct_four_star_review float NOT NULL,
-                pct_five_star_review float NOT NULL,
-                pct_early_shipments float NOT NULL,
-                pct_late_shipments float NOT NULL
-            )"""
-
-            db.create_table(db_cursor,db_conn,best_performing_product_columns,"best_performing_product",analytics)
+            db.create_table(db_cursor,db_conn,BEST_PERFORMING_PRODUCT_COLUMNS,"best_performing_product",analytics)
 
             best_performing_product_db = {
                 "ingestion_date":[todays_date],
-                "product_name":[data[1]],
+                "product_name":[data["product_name"]],
                 "most_ordered_day":[highest_order_date],
                 "is_public_holiday":[is_public_holiday],
-                "tt_review_points":[data[2]],
-                "pct_one_star_review":[data[3]],
-                "pct_two_star_review":[data[4]],
-                "pct_three_star_review":[data[5]],
-                "pct_four_star_review":[data[6]],
-                "pct_five_star_review":[data[7]],
+                "tt_review_points":[data["review_sum"]],
+                "pct_one_star_review":[data["pct_one_star_review"]],
+                "pct_two_star_review":[data["pct_two_star_review"]],
+                "pct_three_star_review":[data["pct_three_star_review"]],
+                "pct_four_star_review":[data["pct_four_star_review"]],
+                "pct_five_star_review":[data["pct_five_star_review"]],
                 "pct_early_shipments":[pct_early_shipment],
                 'pct_late_shipments':[pct_late_shipment]
             }
@@ -366,19 +417,174 @@ if __name__ == "__main__":
             # Create transformation dataframe
             bpp_dict = pd.DataFrame.from_dict(best_performing_product_db)
 
-            # Export to csv
-            bpp_dict.to_csv("exports/best_performing_products.csv")
+            # Export
+            write_export(bpp_dict,"best_performing_products")
 
             # Write result to db
-            with ThreadPoolExecutor() as executor:
-                executor.submit(add_dataframe_to_table,db,bpp_dict,db_cursor,db_conn,"best_performing_product",analytics,check=False)
-
-        except Exception as e:
-            main_logger.critical(f"TaskError:BestPerformingProduct: failed to complete task, {e}")
-    
-    # Close Database Connection
-    db.close(db_conn)
+            add_dataframe_to_table(db,bpp_dict,db_cursor,db_conn,"best_performing_product",analytics,check=False)
 
+    except Exception as e:
+        main_logger.critical(f"TaskError:BestPerformingProduct: failed to complete task, {e}")
+        raise
+
+def check_parity(db,state,engine,dims) -> list:
+    # Every analytic computed by the memory engine and from the state tables, mismatches are logged and returned
+    from analytics.products import STAR_COLUMNS
+    todays_date = datetime.utcnow().date()
+    with db.pooled() as (db_conn,db_cursor):
+        for tablename in ("orders","reviews","shipment_deliveries"):
+            state.update(db_cursor,db_conn,tablename)
+
+        results = {
+            "agg_public_holiday":[public_holiday_months(source,db_cursor,dims,todays_date - timedelta(days=365)) for source in (state,engine)],
+            "agg_shipments":[tuple(source.shipment_counts(db_cursor,todays_date)) for source in (state,engine)]
+        }
+        rankings = [source.rank_products(db_cursor,product_names=dims.product_names).head(TOP_N) for source in (state,engine)]
+        columns = ["product_id","review_count","review_sum"] + STAR_COLUMNS
+        results["product_ranking"] = [ranking[columns].round(9).to_dict(orient="records") for ranking in rankings]
+
+        product_id = int(rankings[0].iloc[0]["product_id"])
+        results["most_ordered_day"] = [source.largest_order_date(db_cursor,product_id) for source in (state,engine)]
+        results["shipment_timeliness"] = [tuple(round(pct,9) for pct in source.shipment_timeliness(db_cursor,product_id)) for source in (state,engine)]
+
+    mismatches = [name for name,(from_state,from_memory) in results.items() if from_state != from_memory]
+    for name in mismatches:
+        main_logger.warning(f"ParityMismatch: {name} state {results[name][0]} memory {results[name][1]}")
+    main_logger.info(f"ParityCheck: {len(results) - len(mismatches)}/{len(results)} analytics match")
+    return mismatches
+
+def export_results(bk):
     # Export Data
     user_id = os.getenv("DB_USER")
-    bk.upload(user_id=user_id,src_folder="exports",dst_name="analytics_export")
\ No newline at end of file
+    bk.upload(user_id=user_id,src_folder="exports",dst_name="analytics_export")
+
+
+# Pipeline
+def build_pipeline(db,bk,state,dims,marks,staging,analytics,engine=None,use_engine=None):
+    """
+    download -> load -> index per table -> each analytic -> export
+    Each file is loaded as soon as its own download finished while the other downloads continue, and within a load the
+    next chunk is parsed while the current one is written (pipeline.prefetch, bounded by LOAD_QUEUE_DEPTH).
+    Each analytic starts as soon as the tables it reads are loaded, and runs on its own pooled connection
+    engine: analytics.engine.memory_engine, the analytics then read the downloaded CSVs and only wait for the downloads,
+    the staging loads keep running off the critical path
+    use_engine: Wire the nodes for the memory engine, defaults to whether engine is given. Lets a plan be built
+    before anything is created
+    """
+    if use_engine == None:
+        use_engine = engine != None
+
+    runner = dag(max_workers=int(os.getenv("DB_POOL_SIZE",8)))
+    runner.add("create_tables",create_staging_tables,args=(db,marks,state,staging))
+    runner.add("dimensions",load_dimensions,args=(db,dims))
+    for file_category,src_name,dst_name in INPUT_FILES:
+        tablename = src_name.replace(".csv","")
+        runner.add(f"download_{tablename}",download_input,args=(bk,file_category,src_name,dst_name))
+        runner.add(f"load_{tablename}",load_input,depends_on=(f"download_{tablename}","create_tables"),args=(db,bk,marks,runner,file_category,src_name,dst_name,staging))
+        runner.add(f"index_{tablename}",index_table,depends_on=(f"load_{tablename}",),args=(db,tablename,staging))
+    runner.add("check_plans",check_query_plans,depends_on=("index_orders","index_reviews","index_shipment_deliveries"),args=(db,staging))
+
+    if use_engine == True:
+        downloads = tuple(f"download_{src_name.replace('.csv','')}" for _,src_name,_ in INPUT_FILES)
+        runner.add("load_frames",load_frames,depends_on=downloads,args=(engine,))
+        runner.add("agg_public_holiday",task_public_holiday,depends_on=("load_frames","dimensions"),args=(db,engine,dims,analytics))
+        runner.add("agg_shipments",task_shipments,depends_on=("load_frames",),args=(db,engine,analytics))
+        runner.add("best_performing_product",task_best_performing_product,depends_on=("load_frames","dimensions"),args=(db,engine,dims,analytics))
+        if PARITY_CHECK == True:
+            runner.add("check_parity",check_parity,depends_on=("index_orders","index_reviews","index_shipment_deliveries","load_frames","dimensions"),args=(db,state,engine,dims))
+    else:
+        runner.add("agg_public_holiday",task_public_holiday,depends_on=("index_orders","dimensions"),args=(db,state,dims,analytics))
+        runner.add("agg_shipments",task_shipments,depends_on=("index_orders","index_shipment_deliveries"),args=(db,state,analytics))
+        runner.add("best_performing_product",task_best_performing_product,depends_on=("index_orders","index_reviews","index_shipment_deliveries","dimensions"),args=(db,state,dims,analytics))
+    runner.add("export",export_results,depends_on=ANALYTIC_NODES,args=(bk,))
+    return runner
+
+
+# Memory Engine Switch
+def memory_engine_enabled() -> bool:
+    # The memory engine reads the downloaded CSVs, so it needs LOAD_MODE=csv
+    return (ANALYTICS_ENGINE == "memory") and (LOAD_MODE == "csv")
+
+
+# Node Resources
+def node_resources(name) -> set:
+    """
+    Returns what a pipeline node uses out of "database", "bucket" and "engine", so a run only creates those
+    """
+    if (name.startswith("download_")) or (name == "export"):
+        return {"bucket"}
+    if name == "load_frames":
+        return {"engine"}
+    if (name.startswith("load_")) and (LOAD_MODE == "stream"):
+        return {"database","bucket"}
+    if (name in ANALYTIC_NODES + ("check_parity",)) and (memory_engine_enabled() == True):
+        return {"database","engine"}
+    return {"database"}
+
+
+# Open Resources
+def open_resources(needed) -> dict:
+    """
+    needed: Resources from node_resources
+    Creates only the needed objects, their modules (psycopg2, boto3, pandas) are imported here. The database pool
+    is opened before the dag starts, so its first wave never races to create it
+    Returns the keyword arguments of build_pipeline, None for everything not needed
+    """
+    resources = {"db":None,"bk":None,"state":None,"dims":None,"marks":None,"engine":None,"staging":os.getenv("STAGING"),"analytics":os.getenv("ANALYTICS")}
+    if "database" in needed:
+        from database.db import database
+        from database.incremental import watermarks
+        from database.dimensions import dimensions
+        from database.state import analytics_state
+        resources["db"] = database()
+        resources["db"].create_pool()
+        resources["dims"] = dimensions()
+        resources["marks"] = watermarks(resources["db"],resources["staging"])
+        resources["state"] = analytics_state(resources["db"],resources["staging"],resources["analytics"])
+    if "bucket" in needed:
+        from s3.s3 import bucket
+        resources["bk"] = bucket()
+    if "engine" in needed:
+        from analytics.engine import memory_engine
+        resources["engine"] = memory_engine()
+    return resources
+
+
+# Run The Pipeline Or Part Of It
+def run_pipeline(targets=None,with_dependencies=True,dry_run=False) -> dict:
+    """
+    targets: Names of the nodes to run, None runs every node
+    with_dependencies: Also run every node the targets depend on, False assumes their inputs are already in place
+    dry_run: Only work out the plan, nothing is imported, opened or run
+    Returns {"plan", "resources"} and for real runs also {"results", "failed"}
+    """
+    use_engine = memory_engine_enabled()
+    if (ANALYTICS_ENGINE == "memory") and (use_engine == False):
+        main_logger.warning(f"AnalyticsEngine: memory engine needs LOAD_MODE=csv, LOAD_MODE={LOAD_MODE} falls back to the state tables")
+
+    # The plan is worked out on a pipeline wired with placeholders, so it costs no imports or connections
+    planned = build_pipeline(None,None,None,None,None,None,None,use_engine=use_engine)
+    if targets != None:
+        planned = planned.subset(targets,with_dependencies)
+    plan = planned.plan()
+    needed = set().union(*[node_resources(name) for name in planned.nodes])
+    if dry_run == True:
+        return {"plan":plan,"resources":sorted(needed)}
+
+    resources = open_resources(needed)
+    runner = build_pipeline(**resources,use_engine=use_engine).subset(list(planned.nodes),with_dependencies=False)
+    main_logger.info(f"PipelinePlan: {plan}")
+    try:
+        runner.run()
+
+    finally:
+        # Run report, written even when a stage failed
+        metrics.write_json(METRICS_JSON)
+        metrics.write_prometheus(METRICS_TEXTFILE)
+        main_logger.info(f"MetricsReport: {METRICS_JSON}, {METRICS_TEXTFILE}")
+
+        # Close Database Connection
+        if resources["db"] != None:
+            resources["db"].close_pool()
+
+    return {"plan":plan,"resources":sorted(needed),"results":runner.results,"failed":sorted(runner.failed)}
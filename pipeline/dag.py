@@ -0,0 +1,192 @@
+# imports
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pipeline.metrics import metrics
+
+# Setup Logging
+dag_logger = logging.getLogger(__name__)
+dag_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/main.log",delay=True)
+file_handler.setFormatter(formatter)
+dag_logger.addHandler(file_handler)
+
+class dag():
+    """
+    Small dependency aware task runner, every node starts as soon as all the nodes it depends on finished
+    max_workers: Number of nodes run at once
+    """
+
+    def __init__(self,max_workers=None) -> None:
+        self.max_workers = max_workers
+        self.nodes = {}
+        self.results = {}
+        self.timings = {}
+        self.failed = set()
+
+
+    # Add Node
+    def add(self,name,func,depends_on=(),args=(),kwargs=None):
+        """
+        name: Unique node name
+        func: Callable run for the node, its return value is kept in results[name]
+        depends_on: Names of nodes that must finish first
+        """
+        if name in self.nodes:
+            raise ValueError(f"DAGError: node {name} already exists")
+        for dependency in depends_on:
+            if dependency not in self.nodes:
+                raise ValueError(f"DAGError: node {name} depends on unknown node {dependency}")
+        self.nodes[name] = {"func":func,"depends_on":tuple(depends_on),"args":args,"kwargs":kwargs or {}}
+
+
+    # Execution Plan
+    def plan(self) -> list:
+        """
+        Returns the nodes grouped in waves, each wave only depends on earlier waves
+        """
+        done = set()
+        waves = []
+        while len(done) != len(self.nodes):
+            wave = [name for name,node in self.nodes.items() if name not in done and set(node["depends_on"]) <= done]
+            waves.append(wave)
+            done.update(wave)
+        return waves
+
+
+    # Select Nodes
+    def subset(self,targets,with_dependencies=True):
+        """
+        targets: Names of the nodes to keep
+        with_dependencies: Also keep every node the targets depend on, directly or not. Without them the targets
+        run on their own and only keep the dependencies between each other
+        Returns a new dag holding the selected nodes in their original order, it shares results with this dag so
+        nodes given this dag as an argument still see the results of the nodes that ran
+        """
+        unknown = [name for name in targets if name not in self.nodes]
+        if len(unknown) != 0:
+            raise ValueError(f"DAGError: unknown nodes {unknown}")
+
+        selected = set(targets)
+        pending = list(targets) if with_dependencies == True else []
+        while len(pending) != 0:
+            for dependency in self.nodes[pending.pop()]["depends_on"]:
+                if dependency not in selected:
+                    selected.add(dependency)
+                    pending.append(dependency)
+
+        runner = dag(max_workers=self.max_workers)
+        runner.results = self.results
+        for name,node in self.nodes.items():
+            if name in selected:
+                depends_on = [dependency for dependency in node["depends_on"] if dependency in selected]
+                runner.add(name,node["func"],depends_on=depends_on,args=node["args"],kwargs=node["kwargs"])
+        return runner
+
+
+    # Run Node
+    def run_node(self,name):
+        node = self.nodes[name]
+        start = time.perf_counter()
+        try:
+            with metrics.stage(name):
+                return node["func"](*node["args"],**node["kwargs"])
+        finally:
+            self.timings[name] = (start,time.perf_counter())
+
+
+    # Run All Nodes
+    def run(self) -> dict:
+        """
+        Runs every node once its dependencies finished, nodes downstream of a failed node are skipped
+        Returns the results of all nodes that ran
+        """
+        self.started = time.perf_counter()
+        pending = dict(self.nodes)
+        running = {}
+        finished = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(pending) != 0 or len(running) != 0:
+
+                # Submit every node whose dependencies are done, skip those whose dependencies failed
+                for name in list(pending):
+                    depends_on = set(pending[name]["depends_on"])
+                    if depends_on & self.failed:
+                        dag_logger.warning(f"DAGNodeSkipped: {name}, dependency failed")
+                        self.failed.add(name)
+                        del pending[name]
+                    elif depends_on <= finished:
+                        running[executor.submit(self.run_node,name)] = name
+                        del pending[name]
+
+                if len(running) == 0:
+                    continue
+
+                done,_ = wait(running,return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        finished.add(name)
+                    except Exception as e:
+                        self.failed.add(name)
+                        dag_logger.critical(f"DAGNodeError: {name} failed, {e}")
+
+        self.report()
+        return self.results
+
+
+    # Critical Path
+    def critical_path(self) -> tuple:
+        """
+        Returns (node names, seconds) of the chain of dependencies that finished last
+        """
+        if len(self.timings) == 0:
+            return [],0.0
+
+        name = max(self.timings,key=lambda node: self.timings[node][1])
+        end = self.timings[name][1]
+        path = [name]
+        while True:
+            depends_on = [dependency for dependency in self.nodes[name]["depends_on"] if dependency in self.timings]
+            if len(depends_on) == 0:
+                break
+            name = max(depends_on,key=lambda node: self.timings[node][1])
+            path.insert(0,name)
+        return path,end - self.timings[path[0]][0]
+
+
+    # Stage Overlap
+    def overlap(self) -> dict:
+        """
+        Returns {node: seconds it ran while at least one other node was running}
+        """
+        overlaps = {}
+        for name,(start,end) in self.timings.items():
+            intervals = sorted([(max(start,other_start),min(end,other_end)) for other,(other_start,other_end) in self.timings.items() if other != name and other_start < end and other_end > start])
+            seconds = 0.0
+            covered = start
+            for interval_start,interval_end in intervals:
+                interval_start = max(interval_start,covered)
+                if interval_end > interval_start:
+                    seconds += interval_end - interval_start
+                    covered = interval_end
+            overlaps[name] = seconds
+        return overlaps
+
+
+    # Report Timings
+    def report(self):
+        overlaps = self.overlap()
+        for name,(start,end) in sorted(self.timings.items(),key=lambda timing: timing[1][0]):
+            dag_logger.info(f"DAGNode: {name} started +{start - self.started:.2f}s took {end - start:.2f}s, overlapped {overlaps[name]:.2f}s")
+        path,seconds = self.critical_path()
+        dag_logger.info(f"DAGCriticalPath: {' -> '.join(path)} ({seconds:.2f}s)")
+
+        if len(self.timings) != 0:
+            busy = sum([end - start for start,end in self.timings.values()])
+            wall = max([end for _,end in self.timings.values()]) - min([start for start,_ in self.timings.values()])
+            dag_logger.info(f"DAGOverlap: {busy:.2f}s of node time in {wall:.2f}s wall time, {busy/wall if wall > 0 else 1.0:.2f} nodes running on average")
@@ -0,0 +1,249 @@
+# imports
+import os
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+from functools import wraps
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then reported as None
+    resource = None
+
+# Setup Logging
+metrics_logger = logging.getLogger(__name__)
+metrics_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/main.log",delay=True)
+file_handler.setFormatter(formatter)
+metrics_logger.addHandler(file_handler)
+
+# Stages profiled with cProfile, comma separated stage names or "all", unset profiles nothing
+METRICS_PROFILE = os.getenv("METRICS_PROFILE","")
+
+# Folder the per stage .prof files are written to
+METRICS_PROFILE_DIR = os.getenv("METRICS_PROFILE_DIR","log_files/profiles")
+
+# Prefix of every metric name in the Prometheus textfile
+METRICS_PREFIX = "pipeline"
+
+
+# Peak Resident Set Size
+def peak_rss() -> int:
+    """
+    Returns the process' peak RSS in bytes, None where the resource module is missing
+    """
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak*1024
+
+
+class registry():
+    """
+    In process metrics for one run, safe to update from any thread
+    counters: Running totals such as rows written or bytes transferred
+    summaries: count, sum and max of observations such as query latencies
+    stages: wall and CPU seconds and the peak RSS seen at the end of each pipeline stage
+    Labels are passed as keyword arguments, keep their values to a small set (table names, query shapes)
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+        self.stages = {}
+        self.descriptions = {}
+        self.started = time.time()
+        self.started_cpu = time.process_time()
+
+
+    # Series Key
+    def key(self,name,labels) -> tuple:
+        return (name,tuple(sorted((label,str(value)) for label,value in labels.items())))
+
+
+    # Counter
+    def inc(self,name,value=1,**labels):
+        key = self.key(name,labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key,0) + value
+
+
+    # Summary
+    def observe(self,name,value,**labels):
+        key = self.key(name,labels)
+        with self.lock:
+            summary = self.summaries.setdefault(key,{"count":0,"sum":0.0,"max":None})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = value if summary["max"] == None else max(summary["max"],value)
+
+
+    # Describe A Label Value
+    def describe(self,label,value,text):
+        """
+        Keeps the text behind a short label value (e.g. the SQL of a query shape) for the JSON report
+        """
+        with self.lock:
+            self.descriptions.setdefault(label,{})[str(value)] = text
+
+
+    # Timer Context
+    @contextmanager
+    def timer(self,name,**labels):
+        """
+        Observes the seconds spent in the block as {name}_seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds",time.perf_counter() - start,**labels)
+
+
+    # Timer Decorator
+    def timed(self,name,**labels):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args,**kwargs):
+                with self.timer(name,**labels):
+                    return func(*args,**kwargs)
+            return wrapper
+        return decorator
+
+
+    # Stage Context
+    @contextmanager
+    def stage(self,name,profile=None):
+        """
+        name: Stage name, e.g. a pipeline node
+        profile: Capture a cProfile of the stage, defaults to whether METRICS_PROFILE names it or is "all"
+        Records wall seconds, CPU seconds of the thread running the stage and the peak RSS once it ended.
+        Work the stage hands to other threads or processes is not in its CPU seconds
+        """
+        if profile == None:
+            profile = (METRICS_PROFILE == "all") or (name in METRICS_PROFILE.split(","))
+        profiler = self.start_profile(name) if profile == True else None
+
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            record = {"wall_seconds":time.perf_counter() - start,"cpu_seconds":time.thread_time() - start_cpu,"peak_rss_bytes":peak_rss(),"failed":failed}
+            if profiler != None:
+                record["profile"] = self.stop_profile(name,profiler)
+            with self.lock:
+                self.stages[name] = record
+
+    def start_profile(self,name):
+        # Only one cProfile can be enabled at a time, concurrent stages are left unprofiled
+        if self.profile_lock.acquire(blocking=False) == False:
+            metrics_logger.warning(f"MetricsProfile: {name} not profiled, another stage is being profiled")
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profile(self,name,profiler) -> str:
+        try:
+            profiler.disable()
+            os.makedirs(METRICS_PROFILE_DIR,exist_ok=True)
+            path = os.path.join(METRICS_PROFILE_DIR,f"{name}.prof")
+            stats = pstats.Stats(profiler)
+            stats.dump_stats(path)
+            metrics_logger.info(f"MetricsProfile: {name} profile saved to {path}, {stats.total_tt:.2f}s profiled")
+            return path
+
+        except Exception as e:
+            metrics_logger.warning(f"MetricsProfileError: failed to save the {name} profile, {e}")
+
+        finally:
+            self.profile_lock.release()
+
+
+    # Run Report
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "started":datetime.utcfromtimestamp(self.started).isoformat(),
+                "wall_seconds":time.time() - self.started,
+                "cpu_seconds":time.process_time() - self.started_cpu,
+                "peak_rss_bytes":peak_rss(),
+                "stages":{name:dict(record) for name,record in self.stages.items()},
+                "counters":[{"name":name,"labels":dict(labels),"value":value} for (name,labels),value in sorted(self.counters.items())],
+                "summaries":[{"name":name,"labels":dict(labels),**summary} for (name,labels),summary in sorted(self.summaries.items())],
+                "descriptions":{label:dict(texts) for label,texts in self.descriptions.items()}
+            }
+
+
+    # JSON Report
+    def write_json(self,path) -> str:
+        report = self.report()
+        self.write_atomic(path,json.dumps(report,indent=2,default=str))
+        return path
+
+
+    # Prometheus Textfile
+    def write_prometheus(self,path) -> str:
+        """
+        Writes the metrics in the Prometheus text format for the node_exporter textfile collector
+        """
+        report = self.report()
+        lines = []
+
+        def series(name,labels,value,kind,family=None):
+            # Every series of a family is written together under one TYPE line, e.g. a summary's _sum and _count
+            family = f"{METRICS_PREFIX}_{family if family != None else name}"
+            if family not in typed:
+                lines.append(f"# TYPE {family} {kind}")
+                typed.add(family)
+            label_text = ",".join([f'{label}="{self.escape(value)}"' for label,value in labels.items()])
+            metric = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"{metric}{{{label_text}}} {value}" if label_text != "" else f"{metric} {value}")
+
+        typed = set()
+        series("run_wall_seconds",{},report["wall_seconds"],"gauge")
+        series("run_cpu_seconds",{},report["cpu_seconds"],"gauge")
+        if report["peak_rss_bytes"] != None:
+            series("peak_rss_bytes",{},report["peak_rss_bytes"],"gauge")
+        for field in ("wall_seconds","cpu_seconds","failed"):
+            for name,record in sorted(report["stages"].items()):
+                series(f"stage_{field}",{"stage":name},int(record[field]) if field == "failed" else record[field],"gauge")
+        for counter in report["counters"]:
+            series(f"{counter['name']}_total",counter["labels"],counter["value"],"counter")
+        # The quantile 1 series of a summary is the largest observation
+        for summary in report["summaries"]:
+            series(summary["name"],{**summary["labels"],"quantile":"1"},summary["max"],"summary")
+            series(f"{summary['name']}_sum",summary["labels"],summary["sum"],"summary",family=summary["name"])
+            series(f"{summary['name']}_count",summary["labels"],summary["count"],"summary",family=summary["name"])
+
+        self.write_atomic(path,"\n".join(lines) + "\n")
+        return path
+
+    def escape(self,value) -> str:
+        return str(value).replace("\\","\\\\").replace("\n","\\n").replace('"','\\"')
+
+    def write_atomic(self,path,text):
+        # The textfile collector may read at any moment, so the file is replaced in one step
+        folder = os.path.dirname(path)
+        if folder != "":
+            os.makedirs(folder,exist_ok=True)
+        with open(f"{path}.tmp","w") as out:
+            out.write(text)
+        os.replace(f"{path}.tmp",path)
+
+
+# Registry shared by the whole run
+metrics = registry()
@@ -0,0 +1,96 @@
+# imports
+import os
+import time
+import queue
+import logging
+import threading
+
+# Setup Logging
+prefetch_logger = logging.getLogger(__name__)
+prefetch_logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+file_handler = logging.FileHandler("log_files/main.log",delay=True)
+file_handler.setFormatter(formatter)
+prefetch_logger.addHandler(file_handler)
+
+# Items produced ahead of the consumer, bounds memory to this many chunks per prefetch
+LOAD_QUEUE_DEPTH = int(os.getenv("LOAD_QUEUE_DEPTH",2))
+
+class prefetch():
+    """
+    Runs a producer iterable (e.g. read_csv chunks) on a background thread and hands its items out in order,
+    so parsing the next chunk overlaps writing the current one. At most depth items wait in the bounded queue,
+    a slow consumer blocks the producer instead of letting parsed chunks pile up in memory
+    iterable: Producer, consumed on the background thread
+    depth: Queue size, defaults to LOAD_QUEUE_DEPTH
+    name: Label used when logging how much producing and consuming overlapped
+    """
+
+    def __init__(self,iterable,depth=None,name="prefetch") -> None:
+        self.iterable = iterable
+        self.depth = depth if depth != None else LOAD_QUEUE_DEPTH
+        self.name = name
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.produce_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.items = 0
+
+
+    # Producer Thread
+    def produce(self):
+        try:
+            iterator = iter(self.iterable)
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.produce_seconds += time.perf_counter() - start
+                self.put(("item",item))
+            self.put(("done",None))
+
+        except Exception as e:
+            self.put(("error",e))
+
+
+    # Blocking Put That Gives Up Once The Consumer Stopped
+    def put(self,message):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(message,timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    # Consume In Order
+    def __iter__(self):
+        started = time.perf_counter()
+        producer = threading.Thread(target=self.produce,name=f"prefetch_{self.name}",daemon=True)
+        producer.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                kind,item = self.queue.get()
+                self.wait_seconds += time.perf_counter() - start
+                if kind == "done":
+                    break
+                if kind == "error":
+                    raise item
+                self.items += 1
+                yield item
+
+        finally:
+            self.stopped.set()
+            producer.join()
+            self.report(time.perf_counter() - started)
+
+
+    # Report Overlap
+    def report(self,wall):
+        consume_seconds = max(wall - self.wait_seconds,0.0)
+        overlap = max(self.produce_seconds + consume_seconds - wall,0.0)
+        share = overlap/min(self.produce_seconds,consume_seconds)*100 if min(self.produce_seconds,consume_seconds) > 0 else 0.0
+        prefetch_logger.info(f"PrefetchOverlap: {self.name} {self.items} items, produce {self.produce_seconds:.2f}s, consume {consume_seconds:.2f}s, wall {wall:.2f}s, overlapped {overlap:.2f}s ({share:.0f}% of the shorter stage)")
@@ -1,25 +1,100 @@
 # Imorts
 from concurrent.futures.process import _ExceptionWithTraceback
 import os
+import json
+import time
 import boto3
 import logging
+import threading
 from botocore import UNSIGNED
 from botocore.client import Config
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline.metrics import metrics
 
 # Setup Logging
 s3_logger = logging.getLogger(__name__)
 s3_logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s:%(name)s:%(levelname)s:%(message)s")
-file_handler = logging.FileHandler("log_files/s3.log")
+file_handler = logging.FileHandler("log_files/s3.log",delay=True)
 file_handler.setFormatter(formatter)
 s3_logger.addHandler(file_handler)
 
+class counted_stream():
+    """
+    Wraps an object's StreamingBody so the bytes read from it are recorded as s3_bytes like a download,
+    the total and the seconds since the stream was opened are recorded once, at the end of the body or on close
+    body: StreamingBody returned by get_object
+    key: Object key used as the metrics label
+    """
+
+    def __init__(self,body,key) -> None:
+        self.body = body
+        self.key = key
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self.recorded = False
+
+    def read(self,amt=None):
+        data = self.body.read(amt)
+        self.bytes += len(data)
+        if (len(data) == 0) or (amt == None):
+            self.record()
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(64*1024),b"")
+
+    def __getattr__(self,name):
+        return getattr(self.body,name)
+
+    def close(self):
+        self.record()
+        self.body.close()
+
+    def record(self):
+        if self.recorded == True:
+            return
+        self.recorded = True
+        seconds = time.perf_counter() - self.start
+        s3_logger.info(f"TransferStats: {self.key} {self.bytes} bytes streamed in {seconds:.2f}s")
+        metrics.inc("s3_bytes",self.bytes,direction="stream",key=self.key)
+        metrics.observe("s3_transfer_seconds",seconds,direction="stream",key=self.key)
+
+
 class bucket():
 
-    def __init__(self):
+    def __init__(self,transfer_config=None,endpoint_url=None,max_workers=None):
+        """
+        transfer_config: boto3 TransferConfig used for every transfer, defaults to make_transfer_config()
+        endpoint_url: Optional S3 compatible endpoint (moto server, MinIO), defaults to S3_ENDPOINT_URL
+        max_workers: Number of files moved at once by download_many/upload_many, defaults to S3_MAX_WORKERS or 4
+        """
         self.bucket_name = os.getenv("BUCKET_NAME")
         self.signature_version = UNSIGNED
-        self.s3 = boto3.client('s3', config=Config(signature_version=self.signature_version))
+        self.endpoint_url = endpoint_url if endpoint_url != None else os.getenv("S3_ENDPOINT_URL")
+        self.transfer_config = transfer_config if transfer_config != None else self.make_transfer_config()
+        self.max_workers = max_workers if max_workers != None else int(os.getenv("S3_MAX_WORKERS",4))
+        self.manifest_lock = threading.Lock()
+
+        # One client shared by every transfer thread, sized for concurrent files and parts
+        pool_size = self.max_workers * self.transfer_config.max_request_concurrency
+        self.s3 = boto3.client('s3', endpoint_url=self.endpoint_url, config=Config(signature_version=self.signature_version,max_pool_connections=max(pool_size,10)))
+
+    def make_transfer_config(self,multipart_threshold=None,multipart_chunksize=None,max_concurrency=None):
+        """
+        multipart_threshold: Size in bytes above which multipart transfers are used, defaults to S3_MULTIPART_THRESHOLD or 8MB
+        multipart_chunksize: Size in bytes of each part, defaults to S3_MULTIPART_CHUNKSIZE or 8MB
+        max_concurrency: Parts moved at once per file, defaults to S3_MAX_CONCURRENCY or 10
+        """
+        if multipart_threshold == None:
+            multipart_threshold = int(os.getenv("S3_MULTIPART_THRESHOLD",8*1024*1024))
+        if multipart_chunksize == None:
+            multipart_chunksize = int(os.getenv("S3_MULTIPART_CHUNKSIZE",8*1024*1024))
+        if max_concurrency == None:
+            max_concurrency = int(os.getenv("S3_MAX_CONCURRENCY",10))
+        return TransferConfig(multipart_threshold=multipart_threshold,multipart_chunksize=multipart_chunksize,max_concurrency=max_concurrency)
 
     def fetch(self,file_category):
         try:
@@ -30,18 +105,148 @@ class bucket():
             s3_logger.critical(f"FetchBucketError: failed to fetch bucket content, {e}")
 
 
+    def transfer_stats(self,key,path,start,direction):
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(path)
+        rate = (size/(1024*1024))/seconds if seconds > 0 else 0.0
+        s3_logger.info(f"TransferStats: {key} {size} bytes in {seconds:.2f}s ({rate:.2f} MB/s)")
+        metrics.inc("s3_bytes",size,direction=direction,key=key)
+        metrics.observe("s3_transfer_seconds",seconds,direction=direction,key=key)
+        return {"key":key,"path":path,"bytes":size,"seconds":seconds,"mb_per_s":rate}
+
+
     def download(self,file_category,src_name="",dst_name=""):
         try:
-            self.s3.download_file(self.bucket_name, f"{file_category}_data/{src_name}", f"{dst_name}")
+            key = f"{file_category}_data/{src_name}"
+            start = time.perf_counter()
+            self.s3.download_file(self.bucket_name, key, f"{dst_name}", Config=self.transfer_config)
+            return self.transfer_stats(key,dst_name,start,"download")
         
         except Exception as e:
             s3_logger.warning(f"DownloadBucketError: failed to download file from bucket, {e}")
 
+    def stream(self,file_category,src_name=""):
+        """
+        Returns the object's StreamingBody, wrapped in a counted_stream, so it can be read without writing it to disk
+        """
+        try:
+            key = f"{file_category}_data/{src_name}"
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+            s3_logger.info(f"StreamObject: {key} {response['ContentLength']} bytes")
+            return counted_stream(response["Body"],key)
+
+        except Exception as e:
+            s3_logger.warning(f"StreamBucketError: failed to stream file from bucket, {e}")
+
+    def download_many(self,files,max_workers=None):
+        """
+        files: (file_category, src_name, dst_name) for each file to download
+        Returns the per file transfer stats, None for files that failed
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            stats = list(executor.map(lambda file: self.download(*file),files))
+        self.log_batch("Download",stats)
+        return stats
+
+    def object_info(self,file_category,src_name,listing=None):
+        """
+        listing: Optional fetch() response to look the object up in, fetched when not given
+        Returns the ETag, size and LastModified of the object, None when it is not in the bucket
+        """
+        if listing == None:
+            listing = self.fetch(file_category) or {}
+        key = f"{file_category}_data/{src_name}"
+        for content in listing.get("Contents",[]):
+            if content["Key"] == key:
+                return {"etag":content["ETag"].strip('"'),"size":content["Size"],"last_modified":content["LastModified"].isoformat()}
+
+    def load_manifest(self,manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                return json.load(manifest_file)
+
+        except FileNotFoundError:
+            return {}
+
+        except Exception as e:
+            s3_logger.warning(f"ManifestError: failed to read download manifest {manifest_path}, ignoring it, {e}")
+            return {}
+
+    def save_manifest(self,manifest_path,manifest):
+        try:
+            with open(f"{manifest_path}.tmp","w") as manifest_file:
+                json.dump(manifest,manifest_file,indent=2,sort_keys=True)
+            os.replace(f"{manifest_path}.tmp",manifest_path)
+
+        except Exception as e:
+            s3_logger.warning(f"ManifestError: failed to write download manifest {manifest_path}, {e}")
+
+    def sync_many(self,files,manifest_path=None,max_workers=None):
+        """
+        files: (file_category, src_name, dst_name) for each file to download
+        manifest_path: Local record of each object's ETag, size and LastModified, defaults to S3_MANIFEST or downloads/.manifest.json
+        Only downloads objects that changed since the last sync or are missing locally
+        Returns {dst_name: changed} so later stages can skip unchanged inputs
+        """
+        if manifest_path == None:
+            manifest_path = os.getenv("S3_MANIFEST","downloads/.manifest.json")
+        manifest = self.load_manifest(manifest_path)
+
+        listings = {}
+        current = {}
+        pending = []
+        for file_category,src_name,dst_name in files:
+            if file_category not in listings:
+                listings[file_category] = self.fetch(file_category) or {}
+            info = self.object_info(file_category,src_name,listings[file_category])
+            current[dst_name] = info
+            if (info == None) or (manifest.get(dst_name) != info) or (not os.path.exists(dst_name)):
+                pending.append((file_category,src_name,dst_name))
+
+        stats = self.download_many(pending,max_workers) if len(pending) != 0 else []
+
+        # Concurrent syncs of different files share the manifest, re-read it so their entries are kept
+        changed = {dst_name:False for _,_,dst_name in files}
+        with self.manifest_lock:
+            manifest = self.load_manifest(manifest_path)
+            for (file_category,src_name,dst_name),stat in zip(pending,stats):
+                changed[dst_name] = True
+                if (stat != None) and (current[dst_name] != None):
+                    manifest[dst_name] = current[dst_name]
+                else:
+                    manifest.pop(dst_name,None)
+            self.save_manifest(manifest_path,manifest)
+
+        s3_logger.info(f"SyncBatch: {len(pending)}/{len(files)} files changed, {changed}")
+        return changed
+
+    def upload_file(self,file_path,key):
+        try:
+            start = time.perf_counter()
+            self.s3.upload_file(file_path,self.bucket_name,key,Config=self.transfer_config)
+            return self.transfer_stats(key,file_path,start,"upload")
+
+        except Exception as e:
+            s3_logger.warning(f"ExportBucketError: failed to upload {file_path} to bucket, {e}")
+
+    def upload_many(self,files,max_workers=None):
+        """
+        files: (file_path, key) for each file to upload
+        Returns the per file transfer stats, None for files that failed
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            stats = list(executor.map(lambda file: self.upload_file(*file),files))
+        self.log_batch("Upload",stats)
+        return stats
+
     def upload(self,user_id,src_folder=None,dst_name=None):
         try:
             files = os.listdir(src_folder)
-            for file in files:
-                file_path = f"{src_folder}/{file}"
-                self.s3.upload_file(file_path,self.bucket_name,f"{dst_name}/{user_id}/{file}")
+            return self.upload_many([(f"{src_folder}/{file}",f"{dst_name}/{user_id}/{file}") for file in files])
         except Exception as e:
             s3_logger.warning(f"ExportBucketError: failed to upload files to bucket, {e}")
+
+    def log_batch(self,action,stats):
+        done = [stat for stat in stats if stat != None]
+        size = sum([stat["bytes"] for stat in done])
+        s3_logger.info(f"{action}Batch: {len(done)}/{len(stats)} files, {size} bytes")
@@ -0,0 +1,13 @@
+# imports
+import os
+import sys
+import tempfile
+
+# The modules open log_files/*.log relative to the working directory, tests log into a scratch folder instead
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+os.chdir(tempfile.mkdtemp(prefix="pipeline_tests_"))
+os.makedirs("log_files",exist_ok=True)
+
+# Sample inputs shipped with the repo
+DOWNLOADS = os.path.join(ROOT,"downloads")
@@ -0,0 +1,27 @@
+# imports
+import sys
+import runpy
+import logging
+import pytest
+
+from conftest import ROOT
+from cli import parse_args, targets
+
+
+def test_commands_select_their_nodes():
+    assert targets(parse_args(["run"])) == None
+    assert targets(parse_args(["download"])) == ["download_orders","download_reviews","download_shipment_deliveries"]
+    assert targets(parse_args(["load","reviews"])) == ["load_reviews","index_reviews"]
+    assert targets(parse_args(["analytics","agg_shipments"])) == ["agg_shipments"]
+    with pytest.raises(SystemExit):
+        parse_args(["analytics","unknown"])
+
+
+def test_main_script_hands_off_to_the_cli_once(monkeypatch,capsys):
+    monkeypatch.setattr(sys,"argv",["main.py","plan"])
+    with pytest.raises(SystemExit) as exited:
+        runpy.run_path(f"{ROOT}/main.py",run_name="__main__")
+    assert exited.value.code == 0
+    assert "wave 1:" in capsys.readouterr().out
+    # Only the "main" module imported by the CLI set up the logger
+    assert len(logging.getLogger("main").handlers) == 1
@@ -0,0 +1,113 @@
+# imports
+import pytest
+import pandas as pd
+
+from database.db import database
+from pipeline.metrics import metrics
+
+
+class recording_cursor():
+    """
+    Records every statement, COPY fails so copy_data falls back to inserts
+    """
+
+    def __init__(self) -> None:
+        self.statements = []
+
+    def execute(self,query,params=None):
+        self.statements.append(query)
+
+    def copy_expert(self,query,buffer):
+        raise RuntimeError("COPY rejected")
+
+
+class recording_connection():
+    def __init__(self) -> None:
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def rows():
+    return pd.DataFrame({"review":[1,2,3],"product_id":[4,5,6]})
+
+
+def test_failed_copy_inside_a_transaction_only_undoes_its_batch(monkeypatch):
+    inserted = []
+    monkeypatch.setattr("database.db.execute_values",lambda cursor,Query,values,page_size: inserted.extend(values))
+    cursor,connect = recording_cursor(),recording_connection()
+
+    assert database().copy_data(cursor,connect,rows(),"reviews","staging",commit=False) == 3
+    assert connect.rollbacks == 0 and connect.commits == 0
+    assert cursor.statements == ["SAVEPOINT copy_batch;","ROLLBACK TO SAVEPOINT copy_batch;"]
+    assert len(inserted) == 3
+
+
+def test_failed_copy_with_commits_falls_back_per_batch(monkeypatch):
+    inserted = []
+    monkeypatch.setattr("database.db.execute_values",lambda cursor,Query,values,page_size: inserted.extend(values))
+    cursor,connect = recording_cursor(),recording_connection()
+
+    assert database().copy_data(cursor,connect,rows(),"reviews","staging",batch_size=2) == 3
+    assert connect.rollbacks == 1 and connect.commits == 2
+    assert cursor.statements == []
+    assert len(inserted) == 3
+
+
+class fake_pool():
+    maxconn = 3
+
+
+def test_pooled_write_splits_contiguous_ranges_and_surfaces_errors(monkeypatch,caplog):
+    db = database()
+    db.pool = fake_pool()
+    ranges = []
+
+    def pooled_write(columns_data,tablename,schemaname):
+        ranges.append([row["id"] for row in columns_data])
+        if columns_data[0]["id"] == 4:
+            raise RuntimeError("CheckoutError: no connection")
+
+    monkeypatch.setattr(db,"pooled_write",pooled_write)
+    db.write_data(None,None,[{"id":i} for i in range(10)],"orders","staging",check=False)
+    assert sorted(ranges) == [[0,1,2,3],[4,5,6,7],[8,9]]
+    assert "WriteDataError" in caplog.text
+
+
+def test_resumed_write_runs_in_order_on_one_connection(monkeypatch):
+    db = database()
+    db.pool = fake_pool()
+    written = []
+    monkeypatch.setattr(db,"fetch_data",lambda *args,**kwargs: (2,))
+    monkeypatch.setattr(db,"pooled_write",lambda *args: pytest.fail("resumed writes must not be spread over the pool"))
+    monkeypatch.setattr(db,"Thread_write",lambda cursor,connect,dict_data,tablename,schemaname: written.append(dict_data["id"]))
+    db.write_data(None,None,[{"id":i} for i in range(5)],"orders","staging")
+    assert written == [2,3,4]
+
+
+class copy_out_cursor():
+    """
+    Binds values like psycopg2 and copies out a one row result
+    """
+
+    def mogrify(self,query,params):
+        return (query % tuple(repr(value) for value in params)).encode()
+
+    def copy_expert(self,query,buffer):
+        buffer.write("product_id\n1\n")
+
+
+def test_fetch_dataframe_shares_one_query_shape_across_values():
+    db = database()
+    Query = "SELECT product_id FROM staging.reviews WHERE product_id = %s;"
+    for product_id in (1,2,3):
+        db.fetch_dataframe(copy_out_cursor(),Query,(product_id,),dtype={"product_id":"int64"})
+    shape = db.query_shape(Query)
+    report = metrics.report()
+    assert report["descriptions"]["query"][shape] == Query
+    assert [entry["count"] for entry in report["summaries"] if (entry["name"] == "db_fetch_dataframe_seconds") and (entry["labels"]["query"] == shape)] == [3]
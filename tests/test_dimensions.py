@@ -0,0 +1,47 @@
+# imports
+import os
+import time
+import numpy as np
+
+from database.dimensions import dimensions
+
+
+def cached_dimensions(snapshot_path):
+    dims = dimensions(snapshot_path=snapshot_path)
+    # 2022-01-03 is a Monday holiday, 2022-01-04 a working Tuesday and 2022-01-08 a Saturday
+    dims.build_dates(
+        np.array(["2022-01-03","2022-01-04","2022-01-08"],dtype="datetime64[D]"),
+        np.array([1,2,6],dtype=np.int8),
+        np.array([False,True,False],dtype=bool),
+        np.array([1,1,1],dtype=np.int8))
+    dims.product_names = {23:"Product 23"}
+    dims.version = [3,"2022-01-08",1,23]
+    return dims
+
+
+def test_snapshot_path_without_extension_is_restored(tmp_path):
+    path = str(tmp_path/"dims")
+    cached_dimensions(path).save_snapshot()
+    assert os.path.exists(f"{path}.npz")
+
+    restored = dimensions(snapshot_path=path)
+    assert restored.snapshot_path == f"{path}.npz"
+    assert restored.restore() == True
+    assert restored.version == [3,"2022-01-08",1,23]
+    assert restored.product_name(23) == "Product 23"
+    assert list(restored.holiday_mask(np.array(["2022-01-03","2022-01-04","2022-01-08","2023-01-01"],dtype="datetime64[D]"))) == [True,False,False,False]
+
+
+def test_snapshot_older_than_the_ttl_is_not_restored(tmp_path):
+    path = str(tmp_path/"dims.npz")
+    cached_dimensions(path).save_snapshot()
+    checked = time.time() - 7200
+    os.utime(path,(checked,checked))
+    assert dimensions(snapshot_path=path,ttl=3600).restore() == False
+    assert dimensions(snapshot_path=path,ttl=86400).restore() == True
+
+
+def test_snapshot_path_with_extension_is_kept(tmp_path):
+    path = str(tmp_path/"dims.npz")
+    assert dimensions(snapshot_path=path).snapshot_path == path
+    assert dimensions(snapshot_path=path).restore() == False
@@ -0,0 +1,145 @@
+# imports
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from contextlib import contextmanager
+
+import database.snapshots
+from conftest import DOWNLOADS
+from analytics.engine import memory_engine
+from analytics.products import rank_products
+from analytics.shipments import join_orders_shipments, shipment_counts, shipment_timeliness
+from database.state import analytics_state, STAR_NAMES
+from database.dimensions import dimensions
+
+
+def sample_engine():
+    return memory_engine().load(*[os.path.join(DOWNLOADS,f"{name}.csv") for name in ("orders","reviews","shipment_deliveries")])
+
+
+def sample_frames():
+    return [pd.read_csv(os.path.join(DOWNLOADS,f"{name}.csv")) for name in ("orders","reviews","shipment_deliveries")]
+
+
+# Row by row reference for the best performing product, most reviews then highest review sum
+def loop_best_product(reviews):
+    counts = {}
+    for row in reviews.dropna().itertuples():
+        count,total = counts.get(int(row.product_id),(0,0))
+        counts[int(row.product_id)] = (count + 1,total + int(row.review))
+    return sorted(counts,key=lambda product_id: (-counts[product_id][0],-counts[product_id][1],product_id))[0]
+
+
+def test_engine_matches_the_vectorized_analytics():
+    engine = sample_engine()
+    orders,reviews,shipments = sample_frames()
+    joined = join_orders_shipments(orders,shipments)
+    today = datetime.utcnow().date()
+
+    ranking = engine.rank_products(None)
+    pd.testing.assert_frame_equal(ranking,rank_products(reviews))
+    best = int(ranking.iloc[0]["product_id"])
+    assert best == loop_best_product(reviews) == 23
+
+    assert engine.shipment_counts(None,today) == shipment_counts(joined,today) == (175,1046)
+    assert engine.shipment_timeliness(None,best) == shipment_timeliness(joined,best)
+
+
+def test_engine_largest_order_and_orders_per_day():
+    engine = sample_engine()
+    orders = sample_frames()[0]
+    product = orders[orders["product_id"] == 23]
+    largest = product.sort_values(["quantity","order_date"],ascending=[False,False]).iloc[0]
+    assert str(engine.largest_order_date(None,23)) == largest["order_date"]
+
+    per_day = dict(engine.orders_per_day(None,"2000-01-01"))
+    expected = orders["order_date"].value_counts()
+    assert len(per_day) == len(expected)
+    assert all(per_day[datetime.strptime(day,"%Y-%m-%d").date()] == count for day,count in expected.items())
+
+
+def test_engine_reads_the_same_from_snapshots(tmp_path,monkeypatch):
+    monkeypatch.setattr(database.snapshots,"STAGING_SNAPSHOTS",str(tmp_path))
+    parsed = sample_engine()
+    assert os.path.exists(os.path.join(tmp_path,"orders","meta.json"))
+    mapped = sample_engine()
+    today = datetime.utcnow().date()
+    pd.testing.assert_frame_equal(mapped.rank_products(None),parsed.rank_products(None))
+    assert mapped.shipment_counts(None,today) == parsed.shipment_counts(None,today)
+    assert mapped.largest_order_date(None,23) == parsed.largest_order_date(None,23)
+
+
+class fake_state_db():
+    """
+    Answers the analytics_state lookups from state tables built from the sample CSVs the way its apply_* statements
+    build them, standing in for Postgres. The cursor arguments are ignored
+    """
+
+    def __init__(self,orders,reviews,shipments) -> None:
+        orders = orders.assign(order_date=pd.to_datetime(orders["order_date"]).dt.date)
+        self.orders_per_day = orders.dropna(subset=["order_date"]).groupby("order_date").size().to_dict()
+        largest = orders.dropna(subset=["product_id","quantity","order_date"]).sort_values(["quantity","order_date"],ascending=False).drop_duplicates("product_id")
+        self.product_orders = {int(row.product_id):row.order_date for row in largest.itertuples()}
+
+        reviews = reviews.dropna()
+        self.product_reviews = pd.DataFrame({
+            "product_id":reviews.groupby("product_id").size().index,
+            "review_count":reviews.groupby("product_id").size().to_numpy(),
+            "review_sum":reviews.groupby("product_id")["review"].sum().to_numpy()})
+        for star,name in enumerate(STAR_NAMES,start=1):
+            self.product_reviews[name] = self.product_reviews["product_id"].map(reviews[reviews["review"] == star].groupby("product_id").size()).fillna(0).astype(int)
+
+        joined = orders.merge(shipments,on="order_id",how="inner")
+        shipped = joined[joined["shipment_date"].notna()].assign(shipment_date=lambda frame: pd.to_datetime(frame["shipment_date"]).dt.date)
+        shipped = shipped.assign(late=[(shipment - order).days >= 6 for shipment,order in zip(shipped["shipment_date"],shipped["order_date"])])
+        self.open_shipments = shipped[shipped["delivery_date"].isna()]
+        self.product_shipments = {int(product_id):(int((~group["late"]).sum()),int(group["late"].sum())) for product_id,group in shipped.groupby("product_id")}
+
+    @contextmanager
+    def pooled(self):
+        yield None,None
+
+    def query(self,cursor,Query,params=None,all=True,one=False,prepared=True):
+        if "state_orders_per_day" in Query:
+            return [(day,count) for day,count in self.orders_per_day.items() if day >= params[0]]
+        if "state_open_shipments" in Query:
+            late = int(self.open_shipments["late"].sum())
+            undelivered = sum([(params[0] - order).days >= 15 for order in self.open_shipments["order_date"]])
+            return late,undelivered
+        if "state_product_orders" in Query:
+            return (self.product_orders[params[0]],) if params[0] in self.product_orders else None
+        if "state_product_shipments" in Query:
+            return self.product_shipments.get(params[0])
+
+    def fetch_dataframe(self,cursor,Query,params=None,dtype=None,parse_dates=None):
+        return self.product_reviews.copy()
+
+
+def sample_dimensions():
+    # Every first of the month that falls on a weekday is a public holiday
+    days = np.arange(np.datetime64("2020-01-01"),np.datetime64(datetime.utcnow().date()) + 1)
+    day_of_week = ((days.astype(np.int64) + 3) % 7 + 1).astype(np.int8)
+    month = (days.astype("datetime64[M]").astype(np.int64) % 12 + 1).astype(np.int8)
+    first = days == days.astype("datetime64[M]").astype("datetime64[D]")
+    dims = dimensions(snapshot_path=None)
+    dims.build_dates(days,day_of_week,~first,month)
+    return dims
+
+
+def test_state_and_memory_engines_answer_the_same(monkeypatch):
+    from main import check_parity, public_holiday_months
+    db = fake_state_db(*sample_frames())
+    state = analytics_state(db,"staging","analytics")
+    monkeypatch.setattr(state,"update",lambda cursor,connect,source: 0)
+    engine = sample_engine()
+
+    dims = sample_dimensions()
+    assert check_parity(db,state,engine,dims) == []
+    # check_parity only looks back a year, the sample orders are older than that
+    months = [public_holiday_months(source,None,dims,datetime(2020,1,1).date()) for source in (state,engine)]
+    assert months[0] == months[1] and sum(months[0].values()) > 0
+    # A product without orders or shipments has the same answer from both
+    for source in (state,engine):
+        assert source.largest_order_date(None,999) == None
+        assert source.shipment_timeliness(None,999) == (0.0,0.0)
@@ -0,0 +1,163 @@
+# imports
+import pytest
+import pandas as pd
+
+from database.db import database
+from database.incremental import watermarks
+
+
+class fake_cursor():
+    def __init__(self,store):
+        self.store = store
+
+    def execute(self,query,params=None):
+        if query.startswith("TRUNCATE"):
+            self.store.table.clear()
+
+
+class fake_connection():
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class fake_store():
+    """
+    Staging table and watermark row kept in memory, copy_data fails on the chunks listed in fail_on
+    """
+
+    def __init__(self):
+        self.table = []
+        self.mark = None
+        self.saves = []
+        self.fail_on = set()
+        self.calls = 0
+        self.cleaner = database()
+
+    def copy_data(self,cursor,connect,dataframe,tablename,schemaname,batch_size=5000,use_copy=True,commit=True):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            return None
+        self.table.extend(dataframe.to_dict(orient="records"))
+        return len(dataframe)
+
+    def clean_frame(self,dataframe):
+        return self.cleaner.clean_frame(dataframe)
+
+
+@pytest.fixture
+def store():
+    return fake_store()
+
+
+@pytest.fixture
+def marks(store,monkeypatch):
+    instance = watermarks(store,"staging")
+
+    def save(cursor,connect,tablename,source,high_water,rows_loaded,source_hash,prefix_hash):
+        store.mark = {"high_water":high_water,"rows_loaded":rows_loaded,"source_hash":source_hash,"prefix_hash":str(prefix_hash)}
+        store.saves.append(dict(store.mark))
+
+    monkeypatch.setattr(instance,"get",lambda connect,tablename: store.mark)
+    monkeypatch.setattr(instance,"save",save)
+    monkeypatch.setattr(instance,"row_count",lambda cursor,tablename: len(store.table))
+    monkeypatch.setattr(instance,"is_empty",lambda cursor,tablename: len(store.table) == 0)
+    monkeypatch.setattr(instance,"bump_generation",lambda cursor,tablename: None)
+    monkeypatch.setattr(instance,"high_water",lambda cursor,tablename,key: max([int(row[key]) for row in store.table],default=0))
+
+    # The anti join insert, only rows whose key is not in the table are written
+    def insert_missing(cursor,connect,cleaned,tablename,key):
+        loaded = set(str(row[key]) for row in store.table)
+        written = store.copy_data(cursor,connect,cleaned[~cleaned[key].astype(str).isin(loaded)],tablename,"staging",commit=False)
+        if written == None:
+            raise RuntimeError(f"failed to stage {len(cleaned)} rows of {tablename}")
+        return written
+
+    monkeypatch.setattr(instance,"insert_missing",insert_missing)
+    return instance
+
+
+@pytest.fixture
+def reviews_csv(tmp_path):
+    path = tmp_path / "reviews.csv"
+    pd.DataFrame({"review":[1,2,3,4,5,1,2,3,4,5],"product_id":list(range(1,11))}).to_csv(path,index=False)
+    return str(path)
+
+
+def write_orders(path,order_ids):
+    pd.DataFrame({
+        "order_id":order_ids,
+        "customer_id":range(1,8),
+        "order_date":["2022-01-01"]*7,
+        "product_id":[1]*7,
+        "unit_price":[10]*7,
+        "quantity":[1]*7,
+        "total_price":[10]*7
+    }).to_csv(path,index=False)
+    return str(path)
+
+
+@pytest.fixture
+def orders_csv(tmp_path):
+    return write_orders(tmp_path / "orders.csv",list(range(1,8)))
+
+
+def test_failed_copy_does_not_mark_the_file_loaded(marks,store,orders_csv):
+    store.fail_on = {2}
+    with pytest.raises(RuntimeError):
+        marks.ingest(fake_cursor(store),fake_connection(),"orders",orders_csv,chunksize=3,shards=1)
+    assert store.saves == []
+
+    # The next run loads the missing rows instead of skipping the file
+    store.fail_on = set()
+    marks.ingest(fake_cursor(store),fake_connection(),"orders",orders_csv,chunksize=3,shards=1)
+    assert sorted(int(row["order_id"]) for row in store.table) == list(range(1,8))
+    assert store.mark["source_hash"] != ""
+
+
+def test_failed_load_of_an_unsorted_file_loads_every_row_on_retry(marks,store,tmp_path):
+    path = write_orders(tmp_path / "orders.csv",[7,1,2,3,4,5,6])
+    store.fail_on = {2}
+    with pytest.raises(RuntimeError):
+        marks.ingest(fake_cursor(store),fake_connection(),"orders",path,chunksize=3,shards=1)
+    assert sorted(int(row["order_id"]) for row in store.table) == [1,2,7]
+
+    # 3 to 6 are below the highest loaded key, they must still be written
+    store.fail_on = set()
+    assert marks.ingest(fake_cursor(store),fake_connection(),"orders",path,chunksize=3,shards=1) == 4
+    assert sorted(int(row["order_id"]) for row in store.table) == list(range(1,8))
+    assert store.mark["high_water"] == 7
+    assert marks.ingest(fake_cursor(store),fake_connection(),"orders",path,chunksize=3,shards=1) == 0
+    assert len(store.table) == 7
+
+
+def test_positional_load_resumes_after_the_last_committed_chunk(marks,store,reviews_csv):
+    store.fail_on = {2}
+    with pytest.raises(RuntimeError):
+        marks.ingest(fake_cursor(store),fake_connection(),"reviews",reviews_csv,chunksize=3,shards=1)
+
+    # Only the first chunk committed, its watermark covers it but does not claim the file
+    assert len(store.table) == 3
+    assert store.mark["rows_loaded"] == 3
+    assert store.mark["source_hash"] == ""
+
+    store.fail_on = set()
+    marks.ingest(fake_cursor(store),fake_connection(),"reviews",reviews_csv,chunksize=3,shards=1)
+    assert [row["product_id"] for row in store.table] == list(range(1,11))
+    assert store.mark["rows_loaded"] == 10
+
+    # Unchanged file, nothing written
+    assert marks.ingest(fake_cursor(store),fake_connection(),"reviews",reviews_csv,chunksize=3,shards=1) == 0
+    assert len(store.table) == 10
+
+
+def test_positional_load_reloads_when_the_table_disagrees_with_the_watermark(marks,store,reviews_csv):
+    marks.ingest(fake_cursor(store),fake_connection(),"reviews",reviews_csv,chunksize=4,shards=1)
+
+    # Rows written without a watermark covering them, e.g. by a crashed run of an older loader
+    store.table.extend(store.table[:2])
+    store.mark["source_hash"] = "stale"
+    marks.ingest(fake_cursor(store),fake_connection(),"reviews",reviews_csv,chunksize=4,shards=1)
+    assert [row["product_id"] for row in store.table] == list(range(1,11))
@@ -0,0 +1,99 @@
+# imports
+import json
+import boto3
+import pytest
+from moto import mock_aws
+
+import pipeline.metrics
+from s3.s3 import bucket
+from pipeline.metrics import registry, metrics
+
+
+def counter(report,name,**labels):
+    return sum([entry["value"] for entry in report["counters"] if (entry["name"] == name) and (all(entry["labels"].get(label) == str(value) for label,value in labels.items()))])
+
+
+def test_counters_and_summaries_are_keyed_by_labels():
+    run = registry()
+    run.inc("db_rows_written",3,table="orders")
+    run.inc("db_rows_written",4,table="orders")
+    run.inc("db_rows_written",5,table="reviews")
+    run.observe("db_query_seconds",0.5,query="stmt_a")
+    run.observe("db_query_seconds",1.5,query="stmt_a")
+
+    report = run.report()
+    assert counter(report,"db_rows_written",table="orders") == 7
+    assert counter(report,"db_rows_written",table="reviews") == 5
+    assert report["summaries"] == [{"name":"db_query_seconds","labels":{"query":"stmt_a"},"count":2,"sum":2.0,"max":1.5}]
+
+
+def test_timer_and_stage_record_failures(monkeypatch):
+    monkeypatch.setattr(pipeline.metrics,"METRICS_PROFILE","")
+    run = registry()
+
+    @run.timed("work",step="one")
+    def work():
+        return "done"
+
+    assert work() == "done"
+    with run.stage("load_orders"):
+        pass
+    with pytest.raises(ValueError):
+        with run.stage("load_reviews"):
+            raise ValueError("bad row")
+
+    report = run.report()
+    assert report["summaries"][0]["name"] == "work_seconds" and report["summaries"][0]["count"] == 1
+    assert report["stages"]["load_orders"]["failed"] == False
+    assert report["stages"]["load_reviews"]["failed"] == True
+    assert report["stages"]["load_orders"]["wall_seconds"] >= 0
+
+
+def test_reports_are_written_as_json_and_prometheus_text(tmp_path):
+    run = registry()
+    run.inc("s3_bytes",10,direction="download",key='orders_data/"odd".csv')
+    run.observe("db_query_seconds",0.25,query="stmt_a")
+    run.describe("query","stmt_a","SELECT 1;")
+    with run.stage("export"):
+        pass
+
+    report = json.load(open(run.write_json(str(tmp_path/"report"/"metrics.json"))))
+    assert report["descriptions"] == {"query":{"stmt_a":"SELECT 1;"}}
+
+    lines = open(run.write_prometheus(str(tmp_path/"metrics.prom"))).read().splitlines()
+    assert '# TYPE pipeline_s3_bytes_total counter' in lines
+    assert 'pipeline_s3_bytes_total{direction="download",key="orders_data/\\"odd\\".csv"} 10' in lines
+    assert 'pipeline_db_query_seconds{query="stmt_a",quantile="1"} 0.25' in lines
+    assert 'pipeline_db_query_seconds_count{query="stmt_a"} 1' in lines
+    assert 'pipeline_stage_failed{stage="export"} 0' in lines
+    # One TYPE line per family, a summary's _sum and _count share it
+    assert len([line for line in lines if line.startswith("# TYPE pipeline_db_query_seconds ")]) == 1
+
+
+def test_streamed_bytes_are_counted(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID","testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY","testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION","us-east-1")
+    monkeypatch.setenv("S3_ENDPOINT_URL","https://s3.amazonaws.com")
+    monkeypatch.setenv("BUCKET_NAME","pipeline-tests")
+    with mock_aws():
+        admin = boto3.client("s3",region_name="us-east-1")
+        admin.create_bucket(Bucket="pipeline-tests")
+        payload = b"review,product_id\n" + b"5,23\n"*1000
+        admin.put_object(Bucket="pipeline-tests",Key="orders_data/reviews.csv",Body=payload,ACL="public-read")
+        admin.put_object(Bucket="pipeline-tests",Key="orders_data/orders.csv",Body=payload,ACL="public-read")
+
+        before = metrics.report()
+        body = bucket().stream("orders","reviews.csv")
+        while body.read(100) != b"":
+            pass
+        body.close()
+
+        # A stream closed part way through records what was read
+        partial = bucket().stream("orders","orders.csv")
+        partial.read(10)
+        partial.close()
+
+    after = metrics.report()
+    assert counter(after,"s3_bytes",direction="stream",key="orders_data/reviews.csv") - counter(before,"s3_bytes",direction="stream",key="orders_data/reviews.csv") == len(payload)
+    assert counter(after,"s3_bytes",direction="stream",key="orders_data/orders.csv") - counter(before,"s3_bytes",direction="stream",key="orders_data/orders.csv") == 10
@@ -0,0 +1,74 @@
+# imports
+import time
+import threading
+import pytest
+
+import database.db as db_module
+from database.db import database
+
+
+class fake_pool():
+    created = 0
+
+    def __init__(self,minconn,maxconn,**kwargs):
+        # Slow enough for racing threads to all see an empty pool
+        time.sleep(0.05)
+        fake_pool.created += 1
+        self.fail = False
+
+    def getconn(self):
+        if self.fail == True:
+            raise RuntimeError("pool exhausted")
+        return object()
+
+    def putconn(self,connect,close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake_pool.created = 0
+    monkeypatch.setattr(db_module.pool,"ThreadedConnectionPool",fake_pool)
+    instance = database()
+    monkeypatch.setattr(instance,"is_healthy",lambda connect: True)
+    monkeypatch.setattr(instance,"create_cursor",lambda connect: None)
+    monkeypatch.setattr(instance,"close",lambda connect=None,cursor=None: None)
+    monkeypatch.setattr(instance,"checkin",lambda connect,discard=False: instance.pool_slots.release())
+    return instance
+
+
+def test_concurrent_checkouts_share_one_pool(db):
+    errors = []
+
+    def work():
+        try:
+            with db.pooled() as (connect,cursor):
+                assert connect != None
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert fake_pool.created == 1
+
+
+def test_failed_checkout_raises_and_releases_its_slot_once(db,monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE","2")
+    db.create_pool()
+    db.pool.fail = True
+    with pytest.raises(RuntimeError):
+        with db.pooled():
+            pass
+
+    # Both slots are free again and none was released twice
+    assert db.pool_slots.acquire(blocking=False) == True
+    assert db.pool_slots.acquire(blocking=False) == True
+    assert db.pool_slots.acquire(blocking=False) == False
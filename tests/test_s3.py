@@ -0,0 +1,81 @@
+# imports
+import os
+import boto3
+import pytest
+from moto import mock_aws
+
+from s3.s3 import bucket
+from pipeline.metrics import metrics
+
+PART_SIZE = 5*1024*1024
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID","testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY","testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION","us-east-1")
+    monkeypatch.setenv("S3_ENDPOINT_URL","https://s3.amazonaws.com")
+    monkeypatch.setenv("BUCKET_NAME","pipeline-tests")
+    with mock_aws():
+        admin = boto3.client("s3",region_name="us-east-1")
+        admin.create_bucket(Bucket="pipeline-tests")
+        yield admin
+
+
+def put(admin,key,body):
+    admin.put_object(Bucket="pipeline-tests",Key=key,Body=body,ACL="public-read")
+
+
+def test_sync_many_only_downloads_changed_objects(s3_bucket,tmp_path):
+    put(s3_bucket,"orders_data/orders.csv",b"order_id\n1\n")
+    put(s3_bucket,"orders_data/reviews.csv",b"review\n5\n")
+    files = [("orders","orders.csv",str(tmp_path/"orders.csv")),("orders","reviews.csv",str(tmp_path/"reviews.csv"))]
+    manifest = str(tmp_path/"manifest.json")
+    source = bucket()
+
+    assert source.sync_many(files,manifest) == {path:True for _,_,path in files}
+    assert source.sync_many(files,manifest) == {path:False for _,_,path in files}
+
+    # A changed object and a deleted local copy are both downloaded again
+    put(s3_bucket,"orders_data/orders.csv",b"order_id\n1\n2\n")
+    os.remove(tmp_path/"reviews.csv")
+    assert source.sync_many(files,manifest) == {path:True for _,_,path in files}
+    assert open(tmp_path/"orders.csv","rb").read() == b"order_id\n1\n2\n"
+
+
+def test_missing_object_is_retried_on_the_next_sync(s3_bucket,tmp_path):
+    files = [("orders","orders.csv",str(tmp_path/"orders.csv"))]
+    manifest = str(tmp_path/"manifest.json")
+    source = bucket()
+    source.sync_many(files,manifest)
+    assert not os.path.exists(tmp_path/"orders.csv")
+
+    put(s3_bucket,"orders_data/orders.csv",b"order_id\n1\n")
+    assert source.sync_many(files,manifest) == {files[0][2]:True}
+    assert os.path.exists(tmp_path/"orders.csv")
+
+
+def test_multipart_transfers_with_concurrent_parts(s3_bucket,tmp_path):
+    source = bucket(max_workers=2)
+    source.transfer_config = source.make_transfer_config(multipart_threshold=PART_SIZE,multipart_chunksize=PART_SIZE,max_concurrency=3)
+    assert source.transfer_config.max_request_concurrency == 3
+    payloads = {f"file_{i}.bin":os.urandom(2*PART_SIZE + 1 + i) for i in range(2)}
+    for name,payload in payloads.items():
+        (tmp_path/name).write_bytes(payload)
+
+    uploaded = source.upload_many([(str(tmp_path/name),f"orders_data/{name}") for name in payloads])
+    assert [stat["bytes"] for stat in uploaded] == [len(payload) for payload in payloads.values()]
+    # Objects above the threshold are stored as multipart uploads, their ETag carries the part count
+    assert s3_bucket.head_object(Bucket="pipeline-tests",Key="orders_data/file_0.bin")["ETag"].strip('"').endswith("-3")
+
+    downloaded = source.download_many([("orders",name,str(tmp_path/f"copy_{name}")) for name in payloads])
+    assert all(stat != None for stat in downloaded)
+    for name,payload in payloads.items():
+        assert (tmp_path/f"copy_{name}").read_bytes() == payload
+
+
+def test_failed_download_returns_none(s3_bucket,tmp_path):
+    before = metrics.report()["counters"]
+    assert bucket().download_many([("orders","missing.csv",str(tmp_path/"missing.csv"))]) == [None]
+    assert metrics.report()["counters"] == before
@@ -0,0 +1,72 @@
+# imports
+import os
+import pandas as pd
+from datetime import datetime, timedelta
+
+from conftest import DOWNLOADS
+from analytics.shipments import join_orders_shipments, shipment_counts, shipment_timeliness, days_between
+
+
+def sample_join():
+    orders = pd.read_csv(os.path.join(DOWNLOADS,"orders.csv"))
+    shipments = pd.read_csv(os.path.join(DOWNLOADS,"shipment_deliveries.csv"))
+    return orders,shipments,join_orders_shipments(orders,shipments)
+
+
+# Row by row reference, the loops the pipeline ran before the metrics were vectorized
+def loop_counts(orders,shipments,today):
+    joined = orders.merge(shipments,on="order_id",how="inner")
+    late = 0
+    undelivered = 0
+    for row in joined.itertuples():
+        if isinstance(row.shipment_date,str) and not isinstance(row.delivery_date,str):
+            order_date = datetime.strptime(row.order_date,"%Y-%m-%d").date()
+            if datetime.strptime(row.shipment_date,"%Y-%m-%d").date() - order_date >= timedelta(days=6):
+                late += 1
+            if today - order_date >= timedelta(days=15):
+                undelivered += 1
+    return late,undelivered
+
+
+def loop_timeliness(orders,shipments,product_id):
+    joined = orders.merge(shipments,on="order_id",how="inner")
+    late = 0
+    early = 0
+    for row in joined[joined["product_id"] == product_id].itertuples():
+        if isinstance(row.shipment_date,str):
+            diff = datetime.strptime(row.shipment_date,"%Y-%m-%d") - datetime.strptime(row.order_date,"%Y-%m-%d")
+            if diff >= timedelta(days=6):
+                late += 1
+            else:
+                early += 1
+    return early/(early + late)*100,late/(early + late)*100
+
+
+def test_shipment_counts_match_the_row_by_row_counts():
+    orders,shipments,joined = sample_join()
+    today = datetime.utcnow().date()
+    assert shipment_counts(joined,today) == loop_counts(orders,shipments,today)
+    assert shipment_counts(joined,today) == (175,1046)
+
+
+def test_shipment_timeliness_matches_the_row_by_row_percentages():
+    orders,shipments,joined = sample_join()
+    for product_id in (1,23):
+        early,late = shipment_timeliness(joined,product_id)
+        expected_early,expected_late = loop_timeliness(orders,shipments,product_id)
+        assert abs(early - expected_early) < 1e-9
+        assert abs(late - expected_late) < 1e-9
+
+
+def test_missing_dates_are_nan_and_never_late():
+    frame = pd.DataFrame({
+        "order_id":[1,2],
+        "product_id":[1,1],
+        "order_date":pd.to_datetime([None,"2022-01-01"]),
+        "shipment_date":pd.to_datetime(["2022-01-10","2022-01-10"]),
+        "delivery_date":pd.to_datetime([None,None])
+    })
+    days = days_between(frame["order_date"],frame["shipment_date"])
+    assert pd.isna(days[0]) and days[1] == 9
+    assert shipment_counts(frame,datetime(2022,2,1).date()) == (1,1)
+    assert shipment_timeliness(frame,product_id=2) == (0.0,0.0)
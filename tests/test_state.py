@@ -0,0 +1,33 @@
+# imports
+import datetime
+
+from database.state import analytics_state
+
+
+class fake_db():
+    """
+    Answers every lookup with the row it was given, None for a product the state tables have no row for
+    """
+
+    def __init__(self,row) -> None:
+        self.row = row
+
+    def query(self,cursor,Query,params=None,all=True,one=False,prepared=True):
+        return self.row
+
+
+def test_product_without_shipments_has_zero_timeliness():
+    state = analytics_state(fake_db(None),"staging","analytics")
+    assert state.shipment_timeliness(None,23) == (0.0,0.0)
+    assert analytics_state(fake_db((0,0)),"staging","analytics").shipment_timeliness(None,23) == (0.0,0.0)
+
+
+def test_shipment_timeliness_percentages():
+    state = analytics_state(fake_db((3,1)),"staging","analytics")
+    assert state.shipment_timeliness(None,23) == (75.0,25.0)
+
+
+def test_product_without_orders_has_no_largest_order_date():
+    assert analytics_state(fake_db(None),"staging","analytics").largest_order_date(None,23) == None
+    day = datetime.date(2022,1,1)
+    assert analytics_state(fake_db((day,)),"staging","analytics").largest_order_date(None,23) == day